@@ -1,145 +1,51 @@
 #!/bin/python
 import argparse
-import json
 import logging
 import os
+import subprocess
+import sys
 import time
 import uuid
-from os.path import expanduser
-from random import randint
-
-import boto3
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# ecs_common.py, shared with the microservices script, lives in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ecs_common import (CLIENT_SETTINGS, CONTAINER_PROFILE_KEYS, HEALTH_PROFILES, ListenerRules, RegionExecutor,
+                        SharedDeployment, api_limiter, configure_clients, configure_service_scaling, create_ecs_cluster,
+                        create_load_balancer, create_roles, create_target_group, delete_ecs_cluster,
+                        delete_load_balancer, delete_roles, delete_target_groups, desired_scaling, docker_login_config,
+                        file_lock, find_load_balancer_arn, find_repositories, format_timing_table, get_client,
+                        get_stack_resources, index_project_target_groups, parse_rate_limits, read_service_config,
+                        region_scope, run_timed, service_profile, shared_resources_in_use, teardown_service, telemetry,
+                        wait_for_stack, write_json_atomically)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-
-def delete_ecs_cluster(stack_name):
-    cf_client = boto3.client('cloudformation')
-    ec2_client = boto3.client('ec2')
-
-    try:
-        response = cf_client.delete_stack(StackName=stack_name)
-        stack_delete_status = cf_client.describe_stacks(StackName=stack_name)
-        logger.info("Delete stack: " + json.dumps(response))
-        while stack_delete_status['Stacks'][0]['StackStatus'] == 'DELETE_IN_PROGRESS':
-            time.sleep(10)
-            stack_delete_status = cf_client.describe_stacks(StackName=stack_name)
-            logger.info("Delete stack status: " + stack_delete_status['Stacks'][0]['StackStatus'])
-            if stack_delete_status['Stacks'][0]['StackStatus'] == 'DELETE_FAILED':
-                logger.warning('Delete failed. Retry delete')
-                resources = cf_client.delete_stack(StackName=stack_name)
-                return resources
-            elif stack_delete_status['Stacks'][0]['StackStatus'] == 'DELETE_IN_PROGRESS':
-                continue
-            else:
-                logger.info("Delete cluster complete")
-    except Exception as e:
-        logger.error(e)
-
-    try:
-        response = ec2_client.delete_key_pair(KeyName=stack_name + 'key')
-        logger.info("Delete key: " + json.dumps(response))
-    except Exception as e:
-        logger.error(e)
-
-
-def create_ecs_cluster(stack_name):
-    cf_client = boto3.client('cloudformation')
-    ec2_client = boto3.client('ec2')
-
-    filename = './ecs-cluster.cf'
-    with open(filename, 'r+') as f:
-        cloudformation_json = json.load(f)
-
-    describe_images_response = ec2_client.describe_images(
-        DryRun=False,
-        Owners=[
-            'amazon',
-        ],
-        Filters=[
-            {
-                'Name': 'name',
-                'Values': [
-                    'amzn-ami-2016.09.f-amazon-ecs-optimized',
-                ]
-            },
-        ]
-    )
-    try:
-        ec2_client.create_key_pair(
-            DryRun=False,
-            KeyName=stack_name + 'key'
-        )
-    except Exception as e:
-        pass
-
-    try:
-        response = cf_client.create_stack(
-            StackName=stack_name,
-            TemplateBody=json.dumps(cloudformation_json),
-            Parameters=[
-                {
-                    'ParameterKey': 'AsgMaxSize',
-                    'ParameterValue': '2',
-                    'UsePreviousValue': True
-                },
-                {
-                    'ParameterKey': 'EcsAmiId',
-                    'ParameterValue': describe_images_response['Images'][0]['ImageId'],
-                    'UsePreviousValue': True
-                },
-                {
-                    'ParameterKey': 'EcsClusterName',
-                    'ParameterValue': stack_name,
-                    'UsePreviousValue': True
-                },
-                {
-                    'ParameterKey': 'KeyName',
-                    'ParameterValue': stack_name + 'key',
-                    'UsePreviousValue': True
-                },
-                {
-                    'ParameterKey': 'EcsInstanceType',
-                    'ParameterValue': 'm4.large',
-                    'UsePreviousValue': True
-                },
-                {
-                    'ParameterKey': 'DBUsername',
-                    'ParameterValue': 'PetClinicDB'
-                },
-                {
-                    'ParameterKey': 'DBPassword',
-                    'ParameterValue': 'PetClinicPassw0rd'
-                }
-            ],
-            TimeoutInMinutes=123,
-            Capabilities=[
-                'CAPABILITY_IAM',
-            ],
-            OnFailure='DELETE',
-            Tags=[
-                {
-                    'Key': 'Name',
-                    'Value': stack_name
-                },
-            ]
-        )
-
-    except cf_client.exceptions.AlreadyExistsException:
-        logger.warning("CF Stack already exists")
-        pass
-
-    stack_create_status = cf_client.describe_stacks(StackName=stack_name)
-
-    resources = cf_client.describe_stack_resources(StackName=stack_name)
-    return resources
+MAVEN_BUILD_COMMAND = ['mvn', 'package', 'docker:build', '-DpushImage', '-Dmaven.test.skip=true']
+# Resource profile of the application, overridden by the fields set in ecs-service-config.json; memory is the hard
+# limit in MiB and memoryReservation the soft one that placement packs instances by. minCount defaults to count and
+# a maxCount equal to minCount turns auto scaling off; a null cpuTarget or requestsPerTarget drops that policy
+DEFAULT_SERVICE_PROFILE = {'cpu': 500, 'memory': 1024, 'memoryReservation': None, 'count': 2, 'ulimits': [],
+                           'minCount': None, 'maxCount': 10, 'cpuTarget': 60, 'requestsPerTarget': 1000,
+                           'placementStrategy': ['spread:attribute:ecs.availability-zone'], 'placementConstraints': [],
+                           'healthProfile': 'default'}
+# Container instances the cluster stack launches, as its EcsInstanceType and AsgMaxSize parameters
+CLUSTER_INSTANCE_TYPE = 'm4.large'
+CLUSTER_SIZE = 2
+# IAM roles of the project, under the keys create_roles() returns their ARNs by
+ROLE_NAMES = OrderedDict([('ecsrolearn', 'PetECSServiceRole'), ('taskrolearn', 'PetECSTaskRole'),
+                          ('ecsagentrolearn', 'PetECSAgentRole')])
+# Roles and repositories every project set up from here uses, by .deploy-state/<region>/<project>.json; cleanup keeps
+# them while another project's file records them
+STATE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.deploy-state')
 
 
 def create_ecs_cluster_mysql(stack_name, stack_name_ecs_cluster, vpc_id, subnet1, subnet2, role_arns, region):
-    cf_client = boto3.client('cloudformation')
-    elb_client = boto3.client('elb')
-    ecs_client  = boto3.client('ecs')
+    cf_client = get_client('cloudformation')
+    elb_client = get_client('elb')
+    ecs_client  = get_client('ecs')
 
     filename = './ecs-cluster-mysql.yaml'
     with open(filename, 'r+') as f:
@@ -196,28 +102,13 @@ def create_ecs_cluster_mysql(stack_name, stack_name_ecs_cluster, vpc_id, subnet1
         logger.warning("CF Stack already exists")
         pass
 
-    time.sleep(10)
+    stack_create_status = wait_for_stack(stack_name)
+    if stack_create_status is None or stack_create_status['StackStatus'] not in ('CREATE_COMPLETE', 'UPDATE_COMPLETE'):
+        raise Exception("Failed to create cluster")
 
-    stack_create_status = cf_client.describe_stacks(StackName=stack_name)
-
-    while stack_create_status['Stacks'][0]['StackStatus'] == 'CREATE_IN_PROGRESS':
-        time.sleep(10)
-        stack_create_status = cf_client.describe_stacks(StackName=stack_name)
-        logger.info("Create stack status: " + stack_create_status['Stacks'][0]['StackStatus'])
-        if stack_create_status['Stacks'][0]['StackStatus'] == 'CREATE_COMPLETE':
-            pass
-        elif stack_create_status['Stacks'][0]['StackStatus'] == 'CREATE_IN_PROGRESS':
-            continue
-        else:
-            raise Exception("Failed to create cluster")
-
-    ecs_cluster = cf_client.describe_stack_resources(StackName=stack_name)
-    for resource in ecs_cluster['StackResources']:
-        if resource['ResourceType'] == 'AWS::ECS::Cluster':
-            ecs_cluster_name = resource['PhysicalResourceId']
-        if resource['ResourceType'] == 'AWS::EC2::SecurityGroup':
-            if resource['LogicalResourceId'] == 'ELBSecurityGroup':
-                elb_security_group = resource['PhysicalResourceId']
+    ecs_cluster = get_stack_resources(stack_name, stack=stack_create_status, refresh=True)
+    ecs_cluster_name = ecs_cluster.physical_ids('AWS::ECS::Cluster')[0]
+    elb_security_group = ecs_cluster.physical_id('ELBSecurityGroup')
 
     try:
         elb_name = stack_name+'-elb'
@@ -340,483 +231,309 @@ def create_ecs_cluster_mysql(stack_name, stack_name_ecs_cluster, vpc_id, subnet1
     return my_sql_options
 
 
-def delete_roles(task_role_policy=None, ecs_role_policy='arn:aws:iam::aws:policy/AmazonEC2ContainerServiceFullAccess',
-                 ecs_agent_role_policy='arn:aws:iam::aws:policy/service-role/AmazonEC2ContainerServiceforEC2Role'):
-    iam_client = boto3.client('iam')
-    iam_client.detach_role_policy(
-        RoleName='PetECSServiceRole',
-        PolicyArn=ecs_role_policy
-    )
-    iam_client.delete_role(RoleName='PetECSServiceRole')
-
-    if (task_role_policy != None):
-        iam_client.detach_role_policy(
-            RoleName='PetECSTaskRole',
-            PolicyArn=task_role_policy
-        )
-    iam_client.delete_role(RoleName='PetECSTaskRole')
-
-    iam_client.detach_role_policy(
-        RoleName='PetECSAgentRole',
-        PolicyArn=ecs_agent_role_policy
-    )
-
-    iam_client.delete_role(RoleName='PetECSAgentRole')
-
-    logger.info("Roles deleted")
-
-
-def create_roles(task_role_policy=None, ecs_role_policy='arn:aws:iam::aws:policy/AmazonEC2ContainerServiceFullAccess',
-                 ecs_agent_role_policy='arn:aws:iam::aws:policy/service-role/AmazonEC2ContainerServiceforEC2Role'):
-    iam_client = boto3.client('iam')
-    # Create task role using an empty policy
-    try:
-        task_assume_policy = {
-            'Statement': [
-                {
-                    'Principal': {
-                        'Service': ['ecs-tasks.amazonaws.com']
-                    },
-                    'Effect': 'Allow',
-                    'Action': ['sts:AssumeRole']
-                },
-            ]
-        }
 
-        ecs_assume_policy = {
-            'Statement': [
-                {
-                    'Principal': {
-                        'Service': ['ecs.amazonaws.com']
-                    },
-                    'Effect': 'Allow',
-                    'Action': ['sts:AssumeRole']
-                },
-            ]
-        }
+def build_image(service, registry_host):
+    """Compile, package, bake the image of service and push it to registry_host."""
+    logger.info('Compile project, package, bake image, and push to registry for ' + service)
+    # Set repository host URL in pom.xml for this build only
+    env = dict(os.environ)
+    env['docker_registry_host'] = registry_host
+    return subprocess.call(MAVEN_BUILD_COMMAND, env=env)
 
-        ecsagent_assume_policy = {
-            'Statement': [
-                {
-                    'Principal': {
-                        'Service': ['ec2.amazonaws.com']
-                    },
-                    'Effect': 'Allow',
-                    'Action': ['sts:AssumeRole']
-                },
-            ]
-        }
 
-        create_ecs_role_response = iam_client.create_role(
-            Path='/',
-            RoleName='PetECSServiceRole',
-            AssumeRolePolicyDocument=json.dumps(ecs_assume_policy)
-        )
-        ecs_role_arn = create_ecs_role_response['Role']['Arn']
-        iam_client.attach_role_policy(
-            RoleName='PetECSServiceRole',
-            PolicyArn=ecs_role_policy
-        )
-        logger.info("ECS Service Role Create: " + ecs_role_arn)
-        time.sleep(1)
+def build_images(repository_uris, image_tags, max_workers=1):
+    """Builds the image of every service, one after another, and raises at the first failed build."""
+    for service, repository_uri in repository_uris.items():
+        if build_image(service, repository_uri.split('/')[0]) != 0:
+            raise Exception('Failed to build ' + service)
 
-        create_task_role_response = iam_client.create_role(
-            Path='/',
-            RoleName='PetECSTaskRole',
-            AssumeRolePolicyDocument=json.dumps(task_assume_policy)
-        )
-        time.sleep(1)
-        task_role_arn = create_task_role_response['Role']['Arn']
-        if task_role_policy:
-            iam_client.attach_role_policy(
-                RoleName='PetECSTaskRole',
-                PolicyArn=task_role_policy
-            )
-        logger.info("Task Role Create: " + task_role_arn)
-        time.sleep(1)
 
-        create_ecsagent_role_response = iam_client.create_role(
-            Path='/',
-            RoleName='PetECSAgentRole',
-            AssumeRolePolicyDocument=json.dumps(ecsagent_assume_policy)
-        )
-        ecsagent_role_arn = create_ecsagent_role_response['Role']['Arn']
-        iam_client.attach_role_policy(
-            RoleName='PetECSAgentRole',
-            PolicyArn=ecs_agent_role_policy
-        )
-        logger.info("ECS Agent Role Create: " + ecsagent_role_arn)
+def state_filename(project_name, region):
+    return os.path.join(STATE_DIRECTORY, region, project_name + '.json')
 
-        role_arns = {'taskrolearn': task_role_arn, 'ecsrolearn': ecs_role_arn, 'ecsagentrolearn': ecsagent_role_arn}
-        return role_arns
-    except Exception as e:
-        logger.error(e)
 
-        response = iam_client.get_role(
-            RoleName='PetECSServiceRole'
-        )
-        ecs_role_arn = response['Role']['Arn']
+def record_shared_resources(project_name, region, role_arns, repository_uris):
+    """Records the roles and repositories the project uses, so the cleanup of another project keeps them."""
+    filename = state_filename(project_name, region)
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    with file_lock(filename):
+        write_json_atomically(filename, {'roles': dict((ROLE_NAMES[key], arn) for key, arn in role_arns.items()),
+                                         'repositories': dict(repository_uris)})
 
-        response = iam_client.get_role(
-            RoleName='PetECSTaskRole'
-        )
-        task_role_arn = response['Role']['Arn']
 
-        response = iam_client.get_role(
-            RoleName='PetECSAgentRole'
-        )
-        ecsagent_role_arn = response['Role']['Arn']
-        role_arns = {'taskrolearn': task_role_arn, 'ecsrolearn': ecs_role_arn, 'ecsagentrolearn': ecsagent_role_arn}
-        return role_arns
+def forget_shared_resources(project_name, region):
+    # The .lock file stays: another run may hold or be waiting on it, and a new one would not exclude that run
+    filename = state_filename(project_name, region)
+    with file_lock(filename):
+        if os.path.exists(filename):
+            os.remove(filename)
 
 
-def docker_login_config():
-    ecr_client = boto3.client('ecr')
-    # Get latest authorization token and put it in ~/.docker/config.json
-    ecr_login_token = ecr_client.get_authorization_token().get('authorizationData')[0].get('authorizationToken').encode(
-        'utf-8')
-    hostname = ecr_client.get_authorization_token().get('authorizationData')[0]['proxyEndpoint'].encode('utf-8')[8:]
+def setup(project_name='spring-petclinic-rest', service_list={'spring-petclinic-rest': '8080'}, region='us-west-2',
+          shared=None):
+    """Creates the project in the current region_scope(); with shared, as one region of a multi-region run."""
+    ecr_client = get_client('ecr')
+    ecs_client = get_client('ecs')
+    ec2_client = get_client('ec2')
+    # Read every profile up front so a bad ecs-service-config.json fails before anything is created
+    profiles = dict((service, service_profile(service, DEFAULT_SERVICE_PROFILE, '.')) for service in service_list)
 
-    home = expanduser("~")
-    filename = home + '/.docker/config.json'
-    with open(filename, 'r+') as f:
-        data = json.load(f)
-        data['auths'] = {
-            hostname: {
-                "auth": ecr_login_token
-            }
-        }
-        #data['auths'][hostname]['auth'] = ecr_login_token
-        # logger.info('Writing docker configuration as '+str(data)
-        f.seek(0)
-        f.write(json.dumps(data))
-        f.truncate()
-
-
-def setup_securitygroups_permission(ecs_security_group, elb_security_group):
-    client = boto3.client('ec2')
-    logger.info('Security Group allow internet access to ELB port 80')
-    # Allow internet access to ELB:80
-    client.authorize_security_group_ingress(
-        GroupId=elb_security_group,
-        IpProtocol='tcp',
-        FromPort=80,
-        ToPort=80,
-        CidrIp='0.0.0.0/0'
-    )
-    logger.info('Security Group allow ELB to access ECS ports 31000-61000')
-    # Allow ECS allows inbound from ELB
-    client.authorize_security_group_ingress(
-        GroupId=ecs_security_group,
-        IpPermissions=[
-            {'IpProtocol': 'tcp',
-             'FromPort': 31000,
-             'ToPort': 61000,
-             'UserIdGroupPairs': [{'GroupId': elb_security_group}]}
-        ],
-    )
-
-
-def setup(project_name='spring-petclinic-rest', service_list={'spring-petclinic-rest': '8080'}, region='us-west-2'):
-    ecr_client = boto3.client('ecr')
-    elb_client = boto3.client('elbv2')
-    ecs_client = boto3.client('ecs')
-    ec2_client = boto3.client('ec2')
-
-    role_arns = create_roles()
-    docker_login_config()
-    elb_subnets = []
+    with telemetry.span('roles'):
+        role_arns = shared.roles() if shared else create_roles(ROLE_NAMES)
+    with telemetry.span('docker-login'):
+        docker_login_config()
     logger.info('Creating ECS Cluster')
-    create_ecs_cluster(project_name)
-    repository_uri = []
+    with telemetry.span('cluster'):
+        create_ecs_cluster(project_name, CLUSTER_INSTANCE_TYPE, CLUSTER_SIZE)
+    repository_uris = OrderedDict()
 
-    for service in service_list:
-        logger.info("Create resources for service: " + service)
+    with telemetry.span('builds'):
+        for service in service_list:
+            logger.info("Create resources for service: " + service)
 
-        # Create repository ignore repository exists error
-        create_repository_response = ecr_client.create_repository(repositoryName=service)
-        logger.info("Create ECR repository")
-        uri = create_repository_response['repository']['repositoryUri'].encode('utf-8')
-        repository_uri.append({service: uri})
-
-        # Set repository host URL in pom.xml
-        os.environ["docker_registry_host"] = uri.split('/')[0]
-        logger.info('Compile project, package, bake image, and push to registry for ' + service)
-        # Compile project, package, bake image, and push to registry
-        os.system('mvn package docker:build -DpushImage -Dmaven.test.skip=true')
-
-    cf_client = boto3.client('cloudformation')
-    stack_create_status = cf_client.describe_stacks(StackName=project_name)
-    resources = cf_client.describe_stack_resources(StackName=project_name)
-
-    while stack_create_status['Stacks'][0]['StackStatus'] == 'CREATE_IN_PROGRESS':
-        time.sleep(10)
-        stack_create_status = cf_client.describe_stacks(StackName=project_name)
-        logger.info("Create stack status: " + stack_create_status['Stacks'][0]['StackStatus'])
-        if stack_create_status['Stacks'][0]['StackStatus'] == 'CREATE_COMPLETE':
-            resources = cf_client.describe_stack_resources(StackName=project_name)
-        elif stack_create_status['Stacks'][0]['StackStatus'] == 'CREATE_IN_PROGRESS':
-            continue
+            # Create repository ignore repository exists error
+            try:
+                create_repository_response = ecr_client.create_repository(repositoryName=service)
+                logger.info("Create ECR repository")
+                repository_uris[service] = create_repository_response['repository']['repositoryUri']
+            except ecr_client.exceptions.RepositoryAlreadyExistsException:
+                logger.info("ECR repository already exists")
+                repository_uris[service] = find_repositories([service])[service]
+        record_shared_resources(project_name, region, role_arns, repository_uris)
+
+        image_tags = dict((service, 'latest') for service in service_list)
+        if shared:
+            shared.builds(region, repository_uris, image_tags)
         else:
-            raise Exception("Failed to create cluster")
+            build_images(repository_uris, image_tags)
 
-    for resource in resources['StackResources']:
-        if resource['LogicalResourceId'] == 'EcsSecurityGroup':
-            ecs_security_group = resource['PhysicalResourceId']
-        if resource['LogicalResourceId'] == 'ElbSecurityGroup':
-            elb_security_group = resource['PhysicalResourceId']
-        if resource['LogicalResourceId'] == 'PubELBSubnetAz1':
-            elb_subnets.append(resource['PhysicalResourceId'])
-        if resource['LogicalResourceId'] == 'PubELBSubnetAz2':
-            elb_subnets.append(resource['PhysicalResourceId'])
-        if resource['LogicalResourceId'] == 'PubELBSubnetAz3':
-            elb_subnets.append(resource['PhysicalResourceId'])
-        if resource['LogicalResourceId'] == 'Vpc':
-            vpc_id = resource['PhysicalResourceId']
-
-    stack_create_status = cf_client.describe_stacks(StackName=project_name)
-    dns_name = stack_create_status['Stacks'][0]['Outputs'][0]['OutputValue'].encode('utf-8')
+    with telemetry.span('stack'):
+        stack_create_status = wait_for_stack(project_name)
+        if stack_create_status is None or \
+                stack_create_status['StackStatus'] not in ('CREATE_COMPLETE', 'UPDATE_COMPLETE'):
+            raise Exception("Failed to create cluster")
+        resources = get_stack_resources(project_name, stack=stack_create_status, refresh=True)
+    dns_name = resources.output('JDBCConnectionString')
 
     my_sql_options = {'dns_name': dns_name, 'username': 'PetClinicDB', 'password': 'PetClinicPassw0rd'}
 
-    logger.info("Creating ELB")
-    elb_name = project_name + '-elb'
-    # Create an ELBv2
-    create_elb_response = elb_client.create_load_balancer(
-        Name=elb_name,
-        Subnets=elb_subnets,
-        SecurityGroups=[elb_security_group],
-        Scheme='internet-facing',
-        Tags=[
-            {
-                'Key': 'Name',
-                'Value': project_name + '-rest-monolithic'
-            },
-        ],
-        IpAddressType='ipv4'
-    )
-    elb_arn = create_elb_response['LoadBalancers'][0]['LoadBalancerArn'].encode('utf-8')
-    elb_dns = create_elb_response['LoadBalancers'][0]['DNSName'].encode('utf-8')
-
-    # Create default / target group
-    create_target_group_response = elb_client.create_target_group(
-        Name=project_name + '-elb-tg',
-        Protocol='HTTP',
-        Port=80,
-        VpcId=vpc_id,
-        HealthCheckPath='/',
-        HealthCheckIntervalSeconds=30,
-        HealthCheckTimeoutSeconds=5,
-        HealthyThresholdCount=5,
-        UnhealthyThresholdCount=2,
-        Matcher={
-            'HttpCode': '200'
-        }
-    )
-    target_group_arn = create_target_group_response['TargetGroups'][0]['TargetGroupArn'].encode('utf-8')
-    logger.info("ELB Target Group created: " + json.dumps(create_target_group_response))
-    # Create ELB listener for port 80
-    create_listener_response = elb_client.create_listener(
-        LoadBalancerArn=elb_arn,
-        Protocol='HTTP',
-        Port=80,
-        DefaultActions=[
-            {
-                'Type': 'forward',
-                'TargetGroupArn': target_group_arn
-            },
-        ]
-    )
-    listener_arn = create_listener_response['Listeners'][0]['ListenerArn'].encode('utf-8')
-    logger.info("ELB Listener Created: " + json.dumps(create_listener_response))
+    with telemetry.span('load-balancer'):
+        # Create the ELBv2 with its default / target group, with the health profile every service reads from
+        # ecs-service-config.json
+        load_balancer = create_load_balancer(project_name, resources,
+                                             HEALTH_PROFILES[profiles[list(service_list)[0]]['healthProfile']],
+                                             project_name + '-rest-monolithic')
+        elb_arn = load_balancer['arn']
+        elb_dns = load_balancer['dns_name']
+        listener_arn = load_balancer['listener_arn']
+        # create_load_balancer() reuses the listener of an earlier run and ListenerRules reads its rules, so on a
+        # rerun the /* rule keeps its priority
+        listener_rules = ListenerRules(listener_arn)
+        priority = read_service_config('.').get('priority')
+        priority = int(priority) if priority else None
 
     for service in service_list:
         logger.info("Create resources for service: " + service)
 
-        # Create target group for service
-        create_target_group_response = elb_client.create_target_group(
-            Name=project_name + str(service_list.keys().index(service)) + '-tg',
-            Protocol='HTTP',
-            Port=int(service_list[service]),
-            VpcId=vpc_id,
-            HealthCheckPath='/',
-            HealthCheckIntervalSeconds=60,
-            HealthCheckTimeoutSeconds=25,
-            HealthyThresholdCount=5,
-            UnhealthyThresholdCount=3,
-            Matcher={
-                'HttpCode': '200'
-            }
-        )
-        target_group_arn = create_target_group_response['TargetGroups'][0]['TargetGroupArn'].encode('utf-8')
-        logger.info("ELB Target Group created: ")
-        # Create routing rule to application
-        create_rule_response = elb_client.create_rule(
-            ListenerArn=listener_arn,
-            Conditions=[
-                {
-                    'Field': 'path-pattern',
-                    'Values': [
-                        '/*'
-                    ]
-                },
-            ],
-            Priority=randint(1, 1000),
-            Actions=[
-                {
-                    'Type': 'forward',
-                    'TargetGroupArn': target_group_arn
-                },
-            ]
-        )
+        with telemetry.span('service:' + service):
+            health = HEALTH_PROFILES[profiles[service]['healthProfile']]
+            # Create target group for service
+            target_group_arn = create_target_group(project_name,
+                                                   project_name + str(list(service_list).index(service)) + '-tg',
+                                                   service_list[service], load_balancer['vpc_id'], health)
+            # Create routing rule to application, at the configured priority or the lowest free one
+            listener_rules.apply(OrderedDict([('/*', priority)]), {'/*': target_group_arn})
 
-        containerDefinitions = [
-            {
-                'name': service,
-                'image': repository_uri[service_list.keys().index(service)][service] + ':latest',
-                'essential': True,
-                'portMappings': [
-                    {
-                        'containerPort': int(service_list[service]),
-                        'hostPort': 0
-                    }
-                ],
-                'memory': 1024,
-                'cpu': 500,
-                'environment': [
-                    {
-                        'name': 'SPRING_PROFILES_ACTIVE',
-                        'value': 'mysql'
-                    },
-                    {
-                        'name': 'SPRING_DATASOURCE_URL',
-                        'value': my_sql_options['dns_name']
-                    },
-                    {
-                        'name': 'SPRING_DATASOURCE_USERNAME',
-                        'value': my_sql_options['username']
+            containerDefinitions = [
+                {
+                    'name': service,
+                    'image': repository_uris[service] + ':latest',
+                    'essential': True,
+                    'portMappings': [
+                        {
+                            'containerPort': int(service_list[service]),
+                            'hostPort': 0
+                        }
+                    ],
+                    'environment': [
+                        {
+                            'name': 'SPRING_PROFILES_ACTIVE',
+                            'value': 'mysql'
+                        },
+                        {
+                            'name': 'SPRING_DATASOURCE_URL',
+                            'value': my_sql_options['dns_name']
+                        },
+                        {
+                            'name': 'SPRING_DATASOURCE_USERNAME',
+                            'value': my_sql_options['username']
+                        },
+                        {
+                            'name': 'SPRING_DATASOURCE_PASSWORD',
+                            'value': my_sql_options['password']
+                        }
+                    ],
+                    'dockerLabels': {
+                        'string': 'string'
                     },
-                    {
-                        'name': 'SPRING_DATASOURCE_PASSWORD',
-                        'value': my_sql_options['password']
-                    }
-                ],
-                'dockerLabels': {
-                    'string': 'string'
-                },
-                'logConfiguration': {
-                    'logDriver': 'awslogs',
-                    'options': {
-                        'awslogs-group': "ECSLogGroup-" + project_name,
-                        'awslogs-region': region,
-                        'awslogs-stream-prefix': project_name
+                    'logConfiguration': {
+                        'logDriver': 'awslogs',
+                        'options': {
+                            'awslogs-group': "ECSLogGroup-" + project_name,
+                            'awslogs-region': region,
+                            'awslogs-stream-prefix': project_name
+                        }
                     }
                 }
-            }
-        ]
-
-        register_task_response = ecs_client.register_task_definition(
-            family=service,
-            taskRoleArn=role_arns['taskrolearn'],
-            networkMode='bridge',
-            containerDefinitions=containerDefinitions
-        )
-
-        create_service_response = ecs_client.create_service(
-            cluster=project_name,
-            serviceName=service,
-            taskDefinition=service,
-            loadBalancers=[
-                {
-                    'targetGroupArn': target_group_arn,
-                    'containerName': service,
-                    'containerPort': int(service_list[service])
-                },
-            ],
-            desiredCount=2,
-            clientToken=str(uuid.uuid4()),
-            role=role_arns['ecsrolearn'],
-            deploymentConfiguration={
-                'maximumPercent': 600,
-                'minimumHealthyPercent': 100
-            },
-            placementStrategy=[
-                {
-                    'type': 'spread',
-                    'field': 'attribute:ecs.availability-zone'
-                },
             ]
-        )
 
-    return elb_dns
+            profile = profiles[service]
+            for key in CONTAINER_PROFILE_KEYS:
+                if profile[key]:
+                    containerDefinitions[0][key] = profile[key]
 
+            register_task_response = ecs_client.register_task_definition(
+                family=service,
+                taskRoleArn=role_arns['taskrolearn'],
+                networkMode='bridge',
+                containerDefinitions=containerDefinitions
+            )
 
-def cleanup(project_name='spring-petclinic-rest', service_list={'spring-petclinic-rest': '8080'}, region='us-west-2'):
-    ecr_client = boto3.client('ecr')
-    ecs_client = boto3.client('ecs')
-    elbv2_client = boto3.client('elbv2')
+            create_service_response = ecs_client.create_service(
+                cluster=project_name,
+                serviceName=service,
+                taskDefinition=service,
+                loadBalancers=[
+                    {
+                        'targetGroupArn': target_group_arn,
+                        'containerName': service,
+                        'containerPort': int(service_list[service])
+                    },
+                ],
+                desiredCount=profile['count'],
+                clientToken=str(uuid.uuid4()),
+                role=role_arns['ecsrolearn'],
+                deploymentConfiguration={
+                    'maximumPercent': 600,
+                    'minimumHealthyPercent': 100
+                },
+                placementStrategy=profile['placementStrategy'],
+                placementConstraints=profile['placementConstraints'],
+                healthCheckGracePeriodSeconds=health['healthCheckGracePeriodSeconds']
+            )
+            configure_service_scaling(project_name, service, desired_scaling(service, profile, elb_arn,
+                                                                             target_group_arn))
 
-    for service in service_list:
-        try:
-            ecr_client.delete_repository(repositoryName=service, force=True)
-        except Exception as e:
-            logger.error(e)
-        try:
-            task_definition = ecs_client.describe_task_definition(taskDefinition=service)
-            ecs_client.deregister_task_definition(
-                taskDefinition=task_definition['taskDefinition']['family'].encode('utf-8') + ':' + str(
-                    task_definition['taskDefinition']['revision']))
-        except Exception as e:
-            logger.error(e)
-        try:
-            ecs_client.update_service(cluster=project_name, service=service, desiredCount=0)
-            ecs_client.delete_service(cluster=project_name, service=service)
-            logger.info('Deleted service: '+service)
+    return elb_dns
 
-        except Exception as e:
-            logger.error(e)
 
+def cleanup(project_name='spring-petclinic-rest', service_list={'spring-petclinic-rest': '8080'}, region='us-west-2',
+            roles=True):
+    """Deletes the project in the current region_scope().
+
+    IAM roles are global, so a multi-region run keeps them until every region is done. Roles and repositories are
+    kept while another project still records them, see record_shared_resources(). Raises when a resource could not
+    be deleted, keeping that record for a retry.
+    """
+    timings = {}
+    roles_in_use, repositories_in_use = shared_resources_in_use(STATE_DIRECTORY, {(project_name, region)})
+    repositories_in_use = repositories_in_use.get(region, set())
+    if repositories_in_use.intersection(service_list):
+        logger.info('Keeping repositories used by other projects: ' +
+                    ', '.join(sorted(repositories_in_use.intersection(service_list))))
+    load_balancer_arn = find_load_balancer_arn(project_name)
+    target_groups = index_project_target_groups(project_name, service_list, load_balancer_arn)
+    logger.info('Found %d target groups to delete' % len(target_groups))
+
+    # Services drain while the load balancer is being deleted; both wait until AWS reports them gone
     logger.info('Draining services traffics')
+    with RegionExecutor(max_workers=len(service_list) + 1) as executor:
+        futures = [executor.submit(teardown_service, project_name, service, timings,
+                                   repository=service not in repositories_in_use)
+                   for service in service_list]
+        if load_balancer_arn:
+            futures.append(executor.submit(run_timed, timings, 'load-balancer:' + project_name + '-elb',
+                                           delete_load_balancer, load_balancer_arn))
+        for future in futures:
+            future.result()
+
+    delete_target_groups(target_groups, timings)
+
+    run_timed(timings, 'stack:' + project_name, delete_ecs_cluster, project_name)
+
+    # Groups still referenced by the stack's resources can only be removed once it is gone
+    delete_target_groups(target_groups, timings)
+    if roles and roles_in_use.intersection(ROLE_NAMES.values()):
+        logger.info('Keeping roles used by other projects')
+    elif roles:
+        logger.info("Deleting roles")
+        run_timed(timings, 'roles', delete_roles, ROLE_NAMES)
+
+    logger.info('Cleanup timings:\n' + format_timing_table(timings))
+    failed = sorted(name for name, (status, seconds) in timings.items() if status == 'error')
+    if failed:
+        raise Exception('Failed to delete ' + ', '.join(failed))
+    forget_shared_resources(project_name, region)
+    return timings
+
+
+def run_region(mode, project_name, service_list, region, shared=None):
+    """Runs setup or cleanup for one region of a multi-region run and returns its one line result."""
     try:
-        load_balancer = elbv2_client.describe_load_balancers(Names=[project_name + '-elb'])
-        elbv2_client.delete_load_balancer(LoadBalancerArn=load_balancer['LoadBalancers'][0]['LoadBalancerArn'])
-        time.sleep(10)
-    except Exception as e:
-        logger.error(e)
-    target_groups = elbv2_client.describe_target_groups()['TargetGroups']
-    for target_group in target_groups:
-        target_group_name = target_group['TargetGroupName'][0:len(project_name)]
-        if target_group_name == project_name:
-            try:
-                logger.info('Deleting target group ' + target_group_name)
-                elbv2_client.delete_target_group(TargetGroupArn=target_group['TargetGroupArn'])
-            except Exception as e:
-                logger.error(e)
-        else:
-            logger.warn('No target group found: '+target_group_name)
-    logger.info('Deleting ELBv2')
+        with region_scope(region), telemetry.span('region:' + region):
+            if mode == 'setup':
+                return 'http://' + setup(project_name=project_name, service_list=service_list, region=region,
+                                         shared=shared)
+            elif mode == 'cleanup':
+                cleanup(project_name=project_name, service_list=service_list, region=region, roles=False)
+                return 'deleted'
+            raise Exception("Not supported mode")
+    finally:
+        if shared:
+            shared.deployment_done(region)
+
+
+def format_region_table(results):
+    lines = ['%-16s %-8s %10s  %s' % ('Region', 'Status', 'Seconds', 'Result')]
+    for region, result in results.items():
+        lines.append('%-16s %-8s %10.1f  %s' % (region, result['status'], result['seconds'], result['result']))
+    return '\n'.join(lines)
+
+
+def deploy_regions(mode, project_name, service_list, regions):
+    """Runs mode in every region at once and reports them together.
+
+    The image is built once, in the first region, and the IAM roles, which are global, are created once and deleted
+    after every region is cleaned up.
+    """
+    shared = SharedDeployment(regions, ROLE_NAMES, build_images)
+
+    def run(region):
+        started = time.time()
+        try:
+            result = run_region(mode, project_name, service_list, region, shared)
+            return {'status': 'ok', 'seconds': time.time() - started, 'result': result}
+        except Exception as e:
+            logger.error(region + ': ' + str(e))
+            return {'status': 'failed', 'seconds': time.time() - started, 'result': str(e)}
 
-    try:
-        delete_ecs_cluster(project_name)
-    except Exception as e:
-        logger.error(e)
+    with ThreadPoolExecutor(max_workers=len(regions)) as executor:
+        results = OrderedDict(zip(regions, executor.map(run, regions)))
 
-    target_groups = elbv2_client.describe_target_groups()['TargetGroups']
-    for target_group in target_groups:
-        target_group_name = target_group['TargetGroupName'][0:len(project_name)]
-        if target_group_name == project_name:
-            try:
-                logger.info('Deleting target group ' + target_group_name)
-                elbv2_client.delete_target_group(TargetGroupArn=target_group['TargetGroupArn'])
-            except Exception as e:
-                logger.error(e)
+    failed = [region for region, result in results.items() if result['status'] == 'failed']
+    if mode == 'cleanup' and not failed:
+        roles_in_use = shared_resources_in_use(STATE_DIRECTORY, set((project_name, region) for region in regions))[0]
+        if roles_in_use.intersection(ROLE_NAMES.values()):
+            logger.info('Keeping roles used by other projects')
         else:
-            logger.warn('No target group found: '+target_group_name)
-    logger.info("Deleting roles")
-    try:
-        delete_roles()
-    except Exception as e:
-        logger.error(e)
+            logger.info("Deleting roles")
+            with region_scope(regions[0]):
+                delete_roles(ROLE_NAMES)
+    logger.info('Region results:\n' + format_region_table(results))
+    if failed:
+        raise Exception('Failed in ' + ', '.join(failed))
+    return results
 
 
 def main():
@@ -824,27 +541,58 @@ def main():
     parser.add_argument('-m', '--mode', required=True, help="execution mode -m cleanup or -m setup")
     parser.add_argument('-p', '--project_name', required=False, default='spring-petclinic-rest',
                         help="Name of the project")
-    parser.add_argument('-r', '--region', required=True, default='us-west-2', help="Region. Default 'us-west-2'")
+    parser.add_argument('-r', '--region', required=False, help="Region. Required unless --regions is given")
+    parser.add_argument('--rate_limits', required=False,
+                        help="Comma separated calls per second per region for service.Operation, service or *, "
+                             "e.g. ecs.CreateService=2,iam=3. Limits adapt down on throttling errors and back up as "
+                             "calls succeed")
+    parser.add_argument('--health_profile', required=False, choices=sorted(HEALTH_PROFILES),
+                        help="Health checks, deregistration delay, slow start and grace period of the application "
+                             "when ecs-service-config.json sets no healthProfile. Default default")
+    parser.add_argument('--regions', required=False,
+                        help="Comma separated regions deployed at once, e.g. us-west-2,eu-west-1. The image is built "
+                             "in the first one")
+    parser.add_argument('--max_pool_connections', required=False, type=int, default=50,
+                        help="HTTP connections kept per AWS client. Default 50")
+    parser.add_argument('--api_timeout', required=False, type=int, default=60,
+                        help="Read timeout in seconds for AWS API calls. Default 60")
+    parser.add_argument('--trace_output', required=False, default='aws-trace.json',
+                        help="Chrome trace file of the AWS API calls and phases of the run. Default aws-trace.json")
     parser.add_argument('-s', '--service_list', required=False, default={'spring-petclinic-rest': '8080'},
                         help="Service list. Default {'spring-petclinic-rest': '8080'}")
     args = parser.parse_args()
 
     project_name = args.project_name
     service_list = args.service_list
-    region = args.region
+    regions = [region.strip() for region in (args.regions or args.region or '').split(',') if region.strip()]
+    if not regions:
+        parser.error('Region is required, use -r or --regions')
+    region = regions[0]
     mode = args.mode
-    os.environ["AWS_DEFAULT_REGION"] = region
+    rate_limits = dict(CLIENT_SETTINGS['rate_limits'])
+    rate_limits.update(parse_rate_limits(args.rate_limits))
+    configure_clients(max_pool_connections=args.max_pool_connections, read_timeout=args.api_timeout,
+                      rate_limits=rate_limits)
+    if args.health_profile:
+        DEFAULT_SERVICE_PROFILE['healthProfile'] = args.health_profile
 
     logger.info("Mode: " + mode)
 
-    if mode == 'setup':
-        setup_results = setup(project_name=project_name, service_list=service_list, region=region)
-        logger.info("Setup is complete your endpoint is http://"+setup_results)
-    elif mode == 'cleanup':
-        cleanup_results = cleanup(project_name=project_name, service_list=service_list, region=region)
-    else:
-        parser.print_help()
-        raise Exception("Not supported mode")
+    try:
+        with telemetry.span(mode), region_scope(region):
+            if len(regions) > 1 and mode in ('setup', 'cleanup'):
+                deploy_regions(mode, project_name, service_list, regions)
+            elif mode == 'setup':
+                setup_results = setup(project_name=project_name, service_list=service_list, region=region)
+                logger.info("Setup is complete your endpoint is http://"+setup_results)
+            elif mode == 'cleanup':
+                cleanup_results = cleanup(project_name=project_name, service_list=service_list, region=region)
+            else:
+                parser.print_help()
+                raise Exception("Not supported mode")
+    finally:
+        telemetry.finish(args.trace_output)
+        logger.info('AWS API rate limits:\n' + api_limiter.format_metrics())
 
 
 if __name__ == "__main__":
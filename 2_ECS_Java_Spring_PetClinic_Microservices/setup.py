@@ -1,608 +1,1712 @@
 #!/bin/python
-import boto3, json, os, logging, uuid, time, argparse, botocore
-from os.path import expanduser
-from random import randint
+import json, os, logging, uuid, time, argparse, botocore, subprocess, threading, hashlib, sys
+import asyncio, fnmatch, heapq, itertools, math, queue, ssl
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, as_completed, wait
+from datetime import datetime
+from urllib.parse import urlsplit
+from random import uniform
+
+# ecs_common.py, shared with the monolith, lives in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ecs_common import (CLIENT_SETTINGS, CONTAINER_PROFILE_KEYS, HEALTH_CHECK_KEYS, HEALTH_PROFILES, SCALABLE_DIMENSION,
+                        ListenerRules, RegionExecutor, SharedDeployment, StackResources, api_limiter,
+                        apply_health_profile, cache_stack_resources, configure_clients, configure_service_scaling,
+                        create_ecs_cluster, create_load_balancer, create_roles, create_target_group, delete_ecs_cluster,
+                        delete_load_balancer, delete_repository, delete_roles, delete_target_groups, desired_scaling,
+                        docker_login_config, file_lock, find_load_balancer_arn, find_repositories, format_build_table,
+                        format_timing_table, get_client, get_stack_resources, health_checks_match, image_digest,
+                        image_exists, index_project_target_groups, is_stack_in_progress, parse_rate_limits,
+                        read_listener_rules, read_service_config, region_scope, run_timed, scaling_matches,
+                        scaling_resource_id, service_profile, shared_resources_in_use, teardown_service, telemetry,
+                        wait_for_stack, write_json_atomically)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Task size, count and auto scaling of a service whose ecs-service-config.json does not set them; memory is the hard
+# limit in MiB and memoryReservation the soft one that placement packs instances by. minCount defaults to count and
+# a maxCount equal to minCount turns auto scaling off; a null cpuTarget or requestsPerTarget drops that policy
+DEFAULT_SERVICE_PROFILE = {'cpu': 1024, 'memory': 1024, 'memoryReservation': None, 'count': 2, 'ulimits': [],
+                           'minCount': None, 'maxCount': 10, 'cpuTarget': 60, 'requestsPerTarget': 1000,
+                           'placementStrategy': ['spread:attribute:ecs.availability-zone'], 'placementConstraints': [],
+                           'healthProfile': 'default'}
+# Container instances the cluster stack launches, as its EcsInstanceType and AsgMaxSize parameters
+CLUSTER_INSTANCE_TYPE = 'c4.xlarge'
+CLUSTER_SIZE = 3
+# IAM roles of the project, under the keys create_roles() returns their ARNs by
+ROLE_NAMES = OrderedDict([('ecsrolearn', 'MicroECSServiceRole'), ('taskrolearn', 'MicroECSTaskRole'),
+                          ('ecsagentrolearn', 'MicroECSAgentRole')])
+# CPU units and MiB of memory an ECS container instance registers, by instance type
+INSTANCE_RESOURCES = {'c4.large': (2048, 3768), 'c4.xlarge': (4096, 7481), 'c4.2xlarge': (8192, 15038),
+                      'c4.4xlarge': (16384, 30155), 'c4.8xlarge': (36864, 60388)}
+# Settings ECS adds to every container definition and port mapping it registers without them
+CONTAINER_DEFAULTS = {'cpu': 0, 'essential': True}
+PORT_MAPPING_DEFAULTS = {'protocol': 'tcp'}
+MAVEN_BUILD_COMMAND = ['mvn', 'package', 'docker:build', '-DpushImage', '-DpushImageTag', '-Dmaven.test.skip=true']
 
-def delete_ecs_cluster(stack_name):
-    cf_client = boto3.client('cloudformation')
-    ec2_client = boto3.client('ec2')
 
-    try:
-        response = cf_client.delete_stack(StackName=stack_name)
-        stack_delete_status = cf_client.describe_stacks(StackName=stack_name)
-        logger.info("Delete stack: " + json.dumps(response))
-        while stack_delete_status['Stacks'][0]['StackStatus'] == 'DELETE_IN_PROGRESS':
-            time.sleep(10)
-            stack_delete_status = cf_client.describe_stacks(StackName=stack_name)
-            logger.info("Delete stack status: " + stack_delete_status['Stacks'][0]['StackStatus'])
-            if stack_delete_status['Stacks'][0]['StackStatus'] == 'DELETE_FAILED':
-                logger.warning('Delete failed. Retry delete')
-                resources = cf_client.delete_stack(StackName=stack_name)
-                return resources
-            elif stack_delete_status['Stacks'][0]['StackStatus'] == 'DELETE_IN_PROGRESS':
-                continue
-            else:
-                logger.info("Delete cluster complete")
-    except Exception as e:
-        logger.error(e)
+def hash_service_tree(service):
+    """Returns a content hash of everything that goes into a service image: pom.xml and the src tree.
 
-    try:
-        response = ec2_client.delete_key_pair(KeyName=stack_name + 'key')
-        logger.info("Delete key: " + json.dumps(response))
-    except Exception as e:
-        logger.error(e)
+    The src tree includes src/main/docker, so Dockerfile changes produce a new hash as well.
+    """
+    paths = [os.path.join(service, 'pom.xml')]
+    for root, dirs, files in os.walk(os.path.join(service, 'src')):
+        dirs.sort()
+        paths.extend(os.path.join(root, name) for name in sorted(files))
 
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(os.path.relpath(path, service).replace(os.sep, '/').encode('utf-8') + b'\0')
+        with open(path, 'rb') as f:
+            digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()[:20]
 
-def create_ecs_cluster(stack_name):
-    cf_client = boto3.client('cloudformation')
-    ec2_client = boto3.client('ec2')
 
-    filename = './ecs-cluster.cf'
-    with open(filename, 'r+') as f:
-        cloudformation_json = json.load(f)
+def hash_services(service_list):
+    image_tags = OrderedDict((service, hash_service_tree(service)) for service in service_list)
+    for service, image_tag in image_tags.items():
+        logger.info('Image tag for ' + service + ': ' + image_tag)
+    return image_tags
 
-    describe_images_response = ec2_client.describe_images(
-        DryRun=False,
-        Owners=[
-            'amazon',
-        ],
-        Filters=[
-            {
-                'Name': 'name',
-                'Values': [
-                    'amzn-ami-2016.09.f-amazon-ecs-optimized',
-                ]
-            },
-        ]
-    )
-    try:
-        ec2_client.create_key_pair(
-            DryRun=False,
-            KeyName=stack_name + 'key'
-        )
-    except Exception as e:
-        pass
 
-    try:
-        response = cf_client.create_stack(
-            StackName=stack_name,
-            TemplateBody=json.dumps(cloudformation_json),
-            Parameters=[
-                {
-                    'ParameterKey': 'AsgMaxSize',
-                    'ParameterValue': '3',
-                    'UsePreviousValue': True
-                },
-                {
-                    'ParameterKey': 'EcsAmiId',
-                    'ParameterValue': describe_images_response['Images'][0]['ImageId'],
-                    'UsePreviousValue': True
-                },
-                {
-                    'ParameterKey': 'EcsClusterName',
-                    'ParameterValue': stack_name,
-                    'UsePreviousValue': True
-                },
-                {
-                    'ParameterKey': 'KeyName',
-                    'ParameterValue': stack_name + 'key',
-                    'UsePreviousValue': True
-                },
-                {
-                    'ParameterKey': 'EcsInstanceType',
-                    'ParameterValue': 'c4.xlarge',
-                    'UsePreviousValue': True
-                },
-                {
-                    'ParameterKey': 'DBUsername',
-                    'ParameterValue': 'PetClinicDB'
-                },
-                {
-                    'ParameterKey': 'DBPassword',
-                    'ParameterValue': 'PetClinicPassw0rd'
-                }
-            ],
-            TimeoutInMinutes=123,
-            Capabilities=[
-                'CAPABILITY_IAM',
-            ],
-            OnFailure='DELETE',
-            Tags=[
-                {
-                    'Key': 'Name',
-                    'Value': stack_name
-                },
-            ]
-        )
-
-    except cf_client.exceptions.AlreadyExistsException:
-        logger.warning("CF Stack already exists")
-        pass
-
-    resources = cf_client.describe_stack_resources(StackName=stack_name)
-    return resources
-
-
-def delete_roles(task_role_policy=None, ecs_role_policy='arn:aws:iam::aws:policy/AmazonEC2ContainerServiceFullAccess',
-                 ecs_agent_role_policy='arn:aws:iam::aws:policy/service-role/AmazonEC2ContainerServiceforEC2Role'):
-    iam_client = boto3.client('iam')
-    iam_client.detach_role_policy(
-        RoleName='MicroECSServiceRole',
-        PolicyArn=ecs_role_policy
-    )
-    iam_client.delete_role(RoleName='MicroECSServiceRole')
-
-    if (task_role_policy != None):
-        iam_client.detach_role_policy(
-            RoleName='MicroECSTaskRole',
-            PolicyArn=task_role_policy
-        )
-    iam_client.delete_role(RoleName='MicroECSTaskRole')
-
-    iam_client.detach_role_policy(
-        RoleName='MicroECSAgentRole',
-        PolicyArn=ecs_agent_role_policy
-    )
+def build_service(service, registry_host, image_tag, running, abort, lock):
+    """Compile, package, bake and push the image of one service from its own directory, tagged with image_tag."""
+    started = time.time()
+    result = {'service': service, 'status': 'cancelled', 'returncode': None, 'seconds': 0.0, 'output': ''}
+    # Set repository host URL in pom.xml for this build only
+    env = dict(os.environ)
+    env['docker_registry_host'] = registry_host
+    with lock:
+        if abort.is_set():
+            return result
+        process = subprocess.Popen(MAVEN_BUILD_COMMAND + ['-Ddocker.image.tag=' + image_tag], cwd=service, env=env,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        running[service] = process
+    output, _ = process.communicate()
+    with lock:
+        running.pop(service, None)
+        aborted = abort.is_set()
 
-    iam_client.delete_role(RoleName='MicroECSAgentRole')
+    result['output'] = output
+    result['returncode'] = process.returncode
+    result['seconds'] = time.time() - started
+    if process.returncode == 0:
+        result['status'] = 'ok'
+    elif aborted:
+        result['status'] = 'cancelled'
+    else:
+        result['status'] = 'failed'
+    return result
 
-    logger.info("Roles deleted")
 
+def build_services(repository_uris, image_tags, max_workers=5):
+    """Build and push, in parallel, every service image whose content hash tag is not in ECR yet.
 
-def create_roles(task_role_policy=None, ecs_role_policy='arn:aws:iam::aws:policy/AmazonEC2ContainerServiceFullAccess',
-                 ecs_agent_role_policy='arn:aws:iam::aws:policy/service-role/AmazonEC2ContainerServiceforEC2Role'):
-    iam_client = boto3.client('iam')
-    # Create task role using an empty policy
-    try:
-        task_assume_policy = {
-            'Statement': [
-                {
-                    'Principal': {
-                        'Service': ['ecs-tasks.amazonaws.com']
-                    },
-                    'Effect': 'Allow',
-                    'Action': ['sts:AssumeRole']
-                },
-            ]
-        }
+    Stops all builds at the first failure. Returns the per service results, slowest first, and raises once any
+    build fails.
+    """
+    running = {}
+    abort = threading.Event()
+    lock = threading.Lock()
+    results = []
 
-        ecs_assume_policy = {
-            'Statement': [
-                {
-                    'Principal': {
-                        'Service': ['ecs.amazonaws.com']
-                    },
-                    'Effect': 'Allow',
-                    'Action': ['sts:AssumeRole']
-                },
-            ]
-        }
+    with RegionExecutor(max_workers=len(repository_uris)) as executor:
+        digests = dict(zip(repository_uris, executor.map(lambda service: image_digest(service, image_tags[service]),
+                                                         repository_uris)))
+    for service in repository_uris:
+        if digests[service]:
+            logger.info('Image ' + service + ':' + image_tags[service] + ' already in ECR, skip build')
+            results.append({'service': service, 'status': 'skipped', 'returncode': None, 'seconds': 0.0,
+                            'output': '', 'digest': digests[service]})
+    to_build = [service for service in repository_uris if not digests[service]]
+    if not to_build:
+        logger.info('Build timings:\n' + format_build_table(results))
+        return results
 
-        ecsagent_assume_policy = {
-            'Statement': [
-                {
-                    'Principal': {
-                        'Service': ['ec2.amazonaws.com']
-                    },
-                    'Effect': 'Allow',
-                    'Action': ['sts:AssumeRole']
-                },
-            ]
-        }
+    logger.info('Compile project, package, bake image, and push to registry for ' + ', '.join(to_build))
+    with RegionExecutor(max_workers=max(1, min(max_workers, len(to_build)))) as executor:
+        futures = [executor.submit(build_service, service, repository_uris[service].split('/')[0],
+                                   image_tags[service], running, abort, lock)
+                   for service in to_build]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            logger.info('Build ' + result['status'] + ' for ' + result['service'] +
+                        ' in %.1fs' % result['seconds'])
+            if result['status'] == 'failed' and not abort.is_set():
+                with lock:
+                    abort.set()
+                    for process in running.values():
+                        process.terminate()
 
-        create_ecs_role_response = iam_client.create_role(
-            Path='/',
-            RoleName='MicroECSServiceRole',
-            AssumeRolePolicyDocument=json.dumps(ecs_assume_policy)
-        )
-        ecs_role_arn = create_ecs_role_response['Role']['Arn']
-        iam_client.attach_role_policy(
-            RoleName='MicroECSServiceRole',
-            PolicyArn=ecs_role_policy
-        )
-        logger.info("ECS Service Role Create: " + ecs_role_arn)
-        time.sleep(1)
-
-        create_task_role_response = iam_client.create_role(
-            Path='/',
-            RoleName='MicroECSTaskRole',
-            AssumeRolePolicyDocument=json.dumps(task_assume_policy)
-        )
-        time.sleep(1)
-        task_role_arn = create_task_role_response['Role']['Arn']
-        if task_role_policy:
-            iam_client.attach_role_policy(
-                RoleName='MicroECSTaskRole',
-                PolicyArn=task_role_policy
-            )
-        logger.info("Task Role Create: " + task_role_arn)
-        time.sleep(1)
-
-        create_ecsagent_role_response = iam_client.create_role(
-            Path='/',
-            RoleName='MicroECSAgentRole',
-            AssumeRolePolicyDocument=json.dumps(ecsagent_assume_policy)
-        )
-        ecsagent_role_arn = create_ecsagent_role_response['Role']['Arn']
-        iam_client.attach_role_policy(
-            RoleName='MicroECSAgentRole',
-            PolicyArn=ecs_agent_role_policy
-        )
-        logger.info("ECS Agent Role Create: " + ecsagent_role_arn)
-
-        role_arns = {'taskrolearn': task_role_arn, 'ecsrolearn': ecs_role_arn, 'ecsagentrolearn': ecsagent_role_arn}
-        return role_arns
-    except Exception as e:
-        logger.error(e)
-
-
-def docker_login_config():
-    ecr_client = boto3.client('ecr')
-    # Get latest authorization token and put it in ~/.docker/config.json
-    ecr_login_token = ecr_client.get_authorization_token().get('authorizationData')[0].get('authorizationToken').encode(
-        'utf-8')
-    hostname = ecr_client.get_authorization_token().get('authorizationData')[0]['proxyEndpoint'].encode('utf-8')[8:]
-
-    home = expanduser("~")
-    filename = home + '/.docker/config.json'
-    with open(filename, 'r+') as f:
-        data = json.load(f)
-        data['auths'][hostname]['auth'] = ecr_login_token
-        # logger.info('Writing docker configuration as '+str(data)
-        f.seek(0)
-        f.write(json.dumps(data))
-        f.truncate()
-
-
-def setup_securitygroups_permission(ecs_security_group, elb_security_group):
-    client = boto3.client('ec2')
-    logger.info('Security Group allow internet access to ELB port 80')
-    # Allow internet access to ELB:80
-    client.authorize_security_group_ingress(
-        GroupId=elb_security_group,
-        IpProtocol='tcp',
-        FromPort=80,
-        ToPort=80,
-        CidrIp='0.0.0.0/0'
-    )
-    logger.info('Security Group allow ELB to access ECS ports 31000-61000')
-    # Allow ECS allows inbound from ELB
-    client.authorize_security_group_ingress(
-        GroupId=ecs_security_group,
-        IpPermissions=[
-            {'IpProtocol': 'tcp',
-             'FromPort': 31000,
-             'ToPort': 61000,
-             'UserIdGroupPairs': [{'GroupId': elb_security_group}]}
-        ],
-    )
+    logger.info('Build timings:\n' + format_build_table(results))
+    failed = [result for result in results if result['status'] == 'failed']
+    for result in failed:
+        logger.error('Build output for ' + result['service'] + ':\n' + result['output'][-4000:])
+    if failed:
+        raise Exception('Failed to build ' + ', '.join(result['service'] for result in failed))
+    for result in results:
+        if 'digest' not in result:
+            result['digest'] = image_digest(result['service'], image_tags[result['service']])
+    return sorted(results, key=lambda r: r['seconds'], reverse=True)
 
 
-def setup(project_name='spring-petclinic-rest',
-          service_list={'spring-petclinic-rest-system': '8080','spring-petclinic-rest-owner': '8080', 'spring-petclinic-rest-pet': '8080','spring-petclinic-rest-vet': '8080','spring-petclinic-rest-visit': '8080'}
-          , region='us-west-2'):
-    ecr_client = boto3.client('ecr')
-    elb_client = boto3.client('elbv2')
-    ecs_client = boto3.client('ecs')
-    ec2_client = boto3.client('ec2')
-
-    role_arns = create_roles()
-    docker_login_config()
-    elb_subnets = []
-    logger.info('Creating ECS Cluster')
-    create_ecs_cluster(project_name)
-    repository_uri = []
+class TaskGraph(object):
+    """Runs named phases concurrently as soon as every phase they require has finished.
+
+    Each phase is called with a dict holding the results of the phases it requires.
+    """
+
+    def __init__(self, max_workers=16):
+        self.max_workers = max_workers
+        self.tasks = OrderedDict()
+        self.timings = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, func, requires=()):
+        if name in self.tasks:
+            raise Exception('Duplicate task: ' + name)
+        self.tasks[name] = (func, tuple(requires))
+
+    def _run_task(self, name, func, inputs):
+        started = time.time()
+        logger.info('Start phase: ' + name)
+        try:
+            with telemetry.span(name):
+                return func(inputs)
+        finally:
+            ended = time.time()
+            with self.lock:
+                self.timings[name] = (started, ended)
+            logger.info('End phase: ' + name + ' in %.1fs' % (ended - started))
+
+    def run(self, on_result=None):
+        """Runs every phase and returns their results by name; on_result(name, result) sees each as it lands.
+
+        Raises as soon as a phase fails. Phases still running, such as a stack wait, are abandoned rather than waited
+        for: their results are dropped, although the process still lets their threads finish before it exits.
+        """
+        for name, (func, requires) in self.tasks.items():
+            for required in requires:
+                if required not in self.tasks:
+                    raise Exception('Task ' + name + ' requires unknown task ' + required)
+
+        results = {}
+        pending = OrderedDict(self.tasks)
+        running = {}
+        executor = RegionExecutor(max_workers=self.max_workers)
+        try:
+            while pending or running:
+                for name in [n for n, (f, requires) in pending.items() if all(r in results for r in requires)]:
+                    func, requires = pending.pop(name)
+                    inputs = dict((required, results[required]) for required in requires)
+                    running[executor.submit(self._run_task, name, func, inputs)] = name
+                if not running:
+                    raise Exception('Dependency cycle between tasks: ' + ', '.join(pending))
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception:
+                        logger.error('Phase failed: ' + name)
+                        if running:
+                            logger.info('Abandoning phases still running: ' + ', '.join(sorted(running.values())))
+                        raise
+                    if on_result is not None:
+                        on_result(name, results[name])
+        except Exception:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        executor.shutdown()
+        return results
+
+    def critical_path(self):
+        """Returns the chain of phases, ending with the last one to finish, that determined the total run time."""
+        with self.lock:
+            timings = dict(self.timings)
+        if not timings:
+            return []
+        path = [max(timings, key=lambda name: timings[name][1])]
+        while True:
+            requires = [r for r in self.tasks[path[-1]][1] if r in timings]
+            if not requires:
+                break
+            path.append(max(requires, key=lambda name: timings[name][1]))
+        return list(reversed(path))
 
+    def format_critical_path(self):
+        path = self.critical_path()
+        # Timings only ever grow, so this later copy holds every phase on the path
+        with self.lock:
+            timings = dict(self.timings)
+        if not path:
+            return 'Critical path: none'
+        total = timings[path[-1]][1] - min(started for started, ended in timings.values())
+        steps = ['%s (%.1fs)' % (name, timings[name][1] - timings[name][0]) for name in path]
+        return 'Critical path (%.1fs): ' % total + ' -> '.join(steps)
+
+
+def create_repositories(service_list, existing=None):
+    ecr_client = get_client('ecr')
+    repository_uris = OrderedDict()
     for service in service_list:
+        if existing and existing.get(service):
+            repository_uris[service] = existing[service]
+            continue
         logger.info("Create resources for service: " + service)
 
         # Create repository ignore repository exists error
-        create_repository_response = ecr_client.create_repository(repositoryName=service)
-        logger.info("Create ECR repository")
-        uri = create_repository_response['repository']['repositoryUri']
-        repository_uri.append({service: uri})
-
-        # Set repository host URL in pom.xml
-        os.environ["docker_registry_host"] = uri.split('/')[0]
-        logger.info('Compile project, package, bake image, and push to registry for ' + service)
-        # Compile project, package, bake image, and push to registry
-        os.chdir(service)
-        os.system('mvn package docker:build -DpushImage -Dmaven.test.skip=true')
-        os.chdir('..')
-
-    cf_client = boto3.client('cloudformation')
-    stack_create_status = cf_client.describe_stacks(StackName=project_name)
-    resources = cf_client.describe_stack_resources(StackName=project_name)
-
-    while stack_create_status['Stacks'][0]['StackStatus'] == 'CREATE_IN_PROGRESS':
-        time.sleep(10)
-        stack_create_status = cf_client.describe_stacks(StackName=project_name)
-        logger.info("Create stack status: " + stack_create_status['Stacks'][0]['StackStatus'])
-        if stack_create_status['Stacks'][0]['StackStatus'] == 'CREATE_COMPLETE':
-            resources = cf_client.describe_stack_resources(StackName=project_name)
-        elif stack_create_status['Stacks'][0]['StackStatus'] == 'CREATE_IN_PROGRESS':
+        try:
+            repository = ecr_client.create_repository(repositoryName=service)['repository']
+            logger.info("Create ECR repository")
+        except ecr_client.exceptions.RepositoryAlreadyExistsException:
+            # Repositories are named after the service, so every project in a region shares them
+            repository = ecr_client.describe_repositories(repositoryNames=[service])['repositories'][0]
+        repository_uris[service] = repository['repositoryUri']
+    return repository_uris
+
+
+def wait_for_ecs_cluster(stack_name):
+    stack_create_status = wait_for_stack(stack_name)
+    if stack_create_status is None or stack_create_status['StackStatus'] not in ('CREATE_COMPLETE', 'UPDATE_COMPLETE'):
+        raise Exception("Failed to create cluster")
+    return get_stack_resources(stack_name, stack=stack_create_status, refresh=True)
+
+
+def service_path_pattern(service):
+    return '/' + service[22:] + '*'
+
+
+def create_service_target_group(project_name, service, index, port, load_balancer, state=None):
+    state = state or empty_state()
+
+    health = health_profile(service)
+    # Create target group for service
+    if service == 'spring-petclinic-rest-system':
+        target_group_arn = load_balancer['default_target_group_arn']
+        if not state['load_balancer']:
+            # Created in this run by create_load_balancer(), already with this health profile
+            return target_group_arn
+    else:
+        target_group_name = project_name + str(index) + '-tg'
+        target_group_arn = state['target_groups'].get(target_group_name)
+        if target_group_arn is None:
+            return create_target_group(project_name, target_group_name, port, load_balancer['vpc_id'], health)
+    if not health_checks_match(state['health_checks'].get(target_group_arn), health):
+        logger.info('Apply ' + service_profile(service, DEFAULT_SERVICE_PROFILE)['healthProfile'] +
+                    ' health profile for: ' + service)
+        apply_health_profile(target_group_arn, health)
+    return target_group_arn
+
+
+def health_profile(service):
+    return HEALTH_PROFILES[service_profile(service, DEFAULT_SERVICE_PROFILE)['healthProfile']]
+
+
+def desired_rules(service_list):
+    """Returns {path pattern: configured priority or None} for every service routed by a listener rule."""
+    rules = OrderedDict()
+    for service in service_list:
+        if service == 'spring-petclinic-rest-system':
             continue
-        else:
-            raise Exception("Failed to create cluster")
-
-    for resource in resources['StackResources']:
-        if resource['LogicalResourceId'] == 'EcsSecurityGroup':
-            ecs_security_group = resource['PhysicalResourceId']
-        if resource['LogicalResourceId'] == 'ElbSecurityGroup':
-            elb_security_group = resource['PhysicalResourceId']
-        if resource['LogicalResourceId'] == 'PubELBSubnetAz1':
-            elb_subnets.append(resource['PhysicalResourceId'])
-        if resource['LogicalResourceId'] == 'PubELBSubnetAz2':
-            elb_subnets.append(resource['PhysicalResourceId'])
-        if resource['LogicalResourceId'] == 'PubELBSubnetAz3':
-            elb_subnets.append(resource['PhysicalResourceId'])
-        if resource['LogicalResourceId'] == 'Vpc':
-            vpc_id = resource['PhysicalResourceId']
-
-    # my_sql_options = create_ecs_cluster_mysql(project_name+'-mysql', project_name, vpc_id, subnets[0], subnets[1], role_arns, region)
-
-    # print my_sql_options
-
-    stack_create_status = cf_client.describe_stacks(StackName=project_name)
-    dns_name = stack_create_status['Stacks'][0]['Outputs'][0]['OutputValue'].encode('utf-8')
-
-    my_sql_options = {'dns_name': dns_name, 'username': 'PetClinicDB', 'password': 'PetClinicPassw0rd'}
-
-    logger.info("Creating ELB")
-    elb_name = project_name + '-elb'
-    # Create an ELBv2
-    create_elb_response = elb_client.create_load_balancer(
-        Name=elb_name,
-        Subnets=elb_subnets,
-        SecurityGroups=[elb_security_group],
-        Scheme='internet-facing',
-        Tags=[
+        priority = read_service_config(service).get('priority')
+        rules[service_path_pattern(service)] = int(priority) if priority else None
+    return rules
+
+
+def apply_listener_rules(service_list, load_balancer, target_groups, state=None):
+    """Brings the listener's path rules in line with service_list; target_groups maps service to group ARN."""
+    state = state or empty_state()
+    rules = state['rules'] if state['load_balancer'] else None
+    manager = ListenerRules(load_balancer['listener_arn'], rules)
+    desired = desired_rules(service_list)
+    return manager.apply(desired, dict((service_path_pattern(service), target_groups[service])
+                                       for service in service_list if service_path_pattern(service) in desired))
+
+
+def service_my_sql_options(stack):
+    return {'dns_name': stack.output('JDBCConnectionString'), 'username': 'PetClinicDB',
+            'password': 'PetClinicPassw0rd'}
+
+
+def service_container_definitions(project_name, service, port, image, elb_dns, my_sql_options, region):
+    container = {
+        'name': service,
+        'image': image,
+        'essential': True,
+        'portMappings': [
+            {
+                'containerPort': int(port),
+                'hostPort': 0
+            }
+        ],
+        'environment': [
+            {
+                'name': 'SERVICE_ENDPOINT',
+                'value': elb_dns
+            },
+            {
+                'name': 'SPRING_PROFILES_ACTIVE',
+                'value': 'mysql'
+            },
+            {
+                'name': 'SPRING_DATASOURCE_URL',
+                'value': my_sql_options['dns_name']
+            },
             {
-                'Key': 'Name',
-                'Value': project_name + '-rest-micro'
+                'name': 'SPRING_DATASOURCE_USERNAME',
+                'value': my_sql_options['username']
             },
+            {
+                'name': 'SPRING_DATASOURCE_PASSWORD',
+                'value': my_sql_options['password']
+            }
         ],
-        IpAddressType='ipv4'
-    )
-    elb_arn = create_elb_response['LoadBalancers'][0]['LoadBalancerArn'].encode('utf-8')
-    elb_dns = create_elb_response['LoadBalancers'][0]['DNSName'].encode('utf-8')
-
-    # Create default / target group
-    create_default_target_group_response = elb_client.create_target_group(
-        Name=project_name + '-elb-tg',
-        Protocol='HTTP',
-        Port=80,
-        VpcId=vpc_id,
-        HealthCheckPath='/',
-        HealthCheckIntervalSeconds=30,
-        HealthCheckTimeoutSeconds=5,
-        HealthyThresholdCount=5,
-        UnhealthyThresholdCount=2,
-        Matcher={
-            'HttpCode': '200'
+        'dockerLabels': {
+            'string': 'string'
+        },
+        'logConfiguration': {
+            'logDriver': 'awslogs',
+            'options': {
+                'awslogs-group': "ECSLogGroup-" + project_name,
+                'awslogs-region': region,
+                'awslogs-stream-prefix': project_name
+            }
         }
+    }
+    profile = service_profile(service, DEFAULT_SERVICE_PROFILE)
+    for key in CONTAINER_PROFILE_KEYS:
+        if profile[key]:
+            container[key] = profile[key]
+    return [container]
+
+
+def normalize_container_definition(container):
+    """Returns container as ECS describes it after registration: with its defaults and without empty settings."""
+    normalized = dict(CONTAINER_DEFAULTS)
+    for key, value in container.items():
+        if value not in (None, [], {}):
+            normalized[key] = value
+    if 'portMappings' in normalized:
+        normalized['portMappings'] = [dict(PORT_MAPPING_DEFAULTS, **mapping) for mapping in normalized['portMappings']]
+    if 'environment' in normalized:
+        normalized['environment'] = sorted(normalized['environment'], key=lambda e: e['name'])
+    return normalized
+
+
+def task_definition_matches(current, task_role_arn, container_definitions):
+    """True when a registered task definition already carries every setting of the desired one.
+
+    Only the settings the desired definition makes, plus the profile keys, are compared; the rest is whatever ECS
+    filled in.
+    """
+    if not current or current.get('taskRoleArn') != task_role_arn:
+        return False
+    if len(current['containerDefinitions']) != len(container_definitions):
+        return False
+    for registered, desired in zip(current['containerDefinitions'], container_definitions):
+        registered = normalize_container_definition(registered)
+        desired = normalize_container_definition(desired)
+        # A setting dropped from the profile is still on the registered definition
+        for key in set(desired) | set(CONTAINER_PROFILE_KEYS):
+            if registered.get(key) != desired.get(key):
+                return False
+    return True
+
+
+def register_service_task_definition(project_name, service, port, image, task_role_arn, elb_dns, my_sql_options,
+                                     region, current=None):
+    ecs_client = get_client('ecs')
+
+    containerDefinitions = service_container_definitions(project_name, service, port, image, elb_dns, my_sql_options,
+                                                         region)
+    if task_definition_matches(current, task_role_arn, containerDefinitions):
+        logger.info('Task Definition unchanged for: ' + service)
+        return current
+
+    logger.info('Create Task Definition for: ' + service)
+    register_task_response = ecs_client.register_task_definition(
+        family=service,
+        taskRoleArn=task_role_arn,
+        networkMode='bridge',
+        containerDefinitions=containerDefinitions
     )
-    default_target_group_arn = create_default_target_group_response['TargetGroups'][0]['TargetGroupArn'].encode('utf-8')
-    logger.info("ELB Target Group created: " + json.dumps(create_default_target_group_response))
-    # Create ELB listener for port 80
-    create_listener_response = elb_client.create_listener(
-        LoadBalancerArn=elb_arn,
-        Protocol='HTTP',
-        Port=80,
-        DefaultActions=[
+    return register_task_response['taskDefinition']
+
+
+def create_ecs_service(project_name, service, port, task_definition, target_group_arn, ecs_role_arn, current=None):
+    ecs_client = get_client('ecs')
+
+    profile = service_profile(service, DEFAULT_SERVICE_PROFILE)
+    if current and current['status'] == 'ACTIVE':
+        changes = {}
+        if current['taskDefinition'] != task_definition:
+            changes['taskDefinition'] = task_definition
+        # An auto scaled service keeps the count Application Auto Scaling gave it
+        if profile['minCount'] == profile['maxCount'] and current['desiredCount'] != profile['count']:
+            changes['desiredCount'] = profile['count']
+        for key in ('placementStrategy', 'placementConstraints'):
+            if current.get(key, []) != profile[key]:
+                changes[key] = profile[key]
+        grace_period = HEALTH_PROFILES[profile['healthProfile']]['healthCheckGracePeriodSeconds']
+        if current.get('healthCheckGracePeriodSeconds') != grace_period:
+            changes['healthCheckGracePeriodSeconds'] = grace_period
+        if changes:
+            logger.info('Update service for: ' + service)
+            ecs_client.update_service(cluster=project_name, service=service, **changes)
+        return current['serviceArn']
+
+    logger.info('Create service for: ' + service)
+    create_service_response = ecs_client.create_service(
+        cluster=project_name,
+        serviceName=service,
+        taskDefinition=task_definition,
+        loadBalancers=[
             {
-                'Type': 'forward',
-                'TargetGroupArn': default_target_group_arn
+                'targetGroupArn': target_group_arn,
+                'containerName': service,
+                'containerPort': int(port)
             },
-        ]
+        ],
+        desiredCount=profile['count'],
+        clientToken=str(uuid.uuid4()),
+        role=ecs_role_arn,
+        deploymentConfiguration={
+            'maximumPercent': 600,
+            'minimumHealthyPercent': 100
+        },
+        placementStrategy=profile['placementStrategy'],
+        placementConstraints=profile['placementConstraints'],
+        healthCheckGracePeriodSeconds=HEALTH_PROFILES[profile['healthProfile']]['healthCheckGracePeriodSeconds']
     )
-    listener_arn = create_listener_response['Listeners'][0]['ListenerArn'].encode('utf-8')
-    logger.info("ELB Listener Created: " + json.dumps(create_listener_response))
+    return create_service_response['service']['serviceArn']
 
-    for service in service_list:
-        # Create target group for service
-        if service == 'spring-petclinic-rest-system':
-            target_group_arn = default_target_group_arn
-        else:
-            create_target_group_response = elb_client.create_target_group(
-                Name=project_name + str(service_list.keys().index(service)) + '-tg',
-                Protocol='HTTP',
-                Port=int(service_list[service]),
-                VpcId=vpc_id,
-                HealthCheckPath='/',
-                HealthCheckIntervalSeconds=60,
-                HealthCheckTimeoutSeconds=30,
-                HealthyThresholdCount=5,
-                UnhealthyThresholdCount=3,
-                Matcher={
-                    'HttpCode': '200'
-                }
-            )
-            target_group_arn = create_target_group_response['TargetGroups'][0]['TargetGroupArn'].encode('utf-8')
-            logger.info("ELB Target Group created: ")
-            # Create routing rule to application
-            create_rule_response = elb_client.create_rule(
-                ListenerArn=listener_arn,
-                Conditions=[
-                    {
-                        'Field': 'path-pattern',
-                        'Values': [
-                            '/' + service[22:]+'*'
-                        ]
-                    },
-                ],
-                Priority=randint(1, 1000),
-                Actions=[
-                    {
-                        'Type': 'forward',
-                        'TargetGroupArn': target_group_arn
-                    },
-                ]
-            )
-        logger.info('Create Task Definition for: ' + service_list[service])
-        containerDefinitions = [
-            {
-                'name': service,
-                'image': repository_uri[service_list.keys().index(service)][service] + ':latest',
-                'essential': True,
-                'portMappings': [
-                    {
-                        'containerPort': int(service_list[service]),
-                        'hostPort': 0
-                    }
-                ],
-                'memory': 1024,
-                'cpu': 1024,
-                'environment': [
-                    {
-                        'name': 'SERVICE_ENDPOINT',
-                        'value': elb_dns
-                    },
-                    {
-                        'name': 'SPRING_PROFILES_ACTIVE',
-                        'value': 'mysql'
-                    },
-                    {
-                        'name': 'SPRING_DATASOURCE_URL',
-                        'value': my_sql_options['dns_name']
-                    },
-                    {
-                        'name': 'SPRING_DATASOURCE_USERNAME',
-                        'value': my_sql_options['username']
-                    },
-                    {
-                        'name': 'SPRING_DATASOURCE_PASSWORD',
-                        'value': my_sql_options['password']
-                    }
-                ],
-                'dockerLabels': {
-                    'string': 'string'
-                },
-                'logConfiguration': {
-                    'logDriver': 'awslogs',
-                    'options': {
-                        'awslogs-group': "ECSLogGroup-" + project_name,
-                        'awslogs-region': region,
-                        'awslogs-stream-prefix': project_name
-                    }
-                }
-            }
-        ]
-        register_task_response = ecs_client.register_task_definition(
-            family=service,
-            taskRoleArn=role_arns['taskrolearn'],
-            networkMode='bridge',
-            containerDefinitions=containerDefinitions
-        )
-        logger.info('Create service for: ' + service_list[service])
-        create_service_response = ecs_client.create_service(
-            cluster=project_name,
-            serviceName=service,
-            taskDefinition=service,
-            loadBalancers=[
-                {
-                    'targetGroupArn': target_group_arn,
-                    'containerName': service,
-                    'containerPort': int(service_list[service])
-                },
-            ],
-            desiredCount=2,
-            clientToken=str(uuid.uuid4()),
-            role=role_arns['ecsrolearn'],
-            deploymentConfiguration={
-                'maximumPercent': 600,
-                'minimumHealthyPercent': 100
-            },
-            placementStrategy=[
-                {
-                    'type': 'spread',
-                    'field': 'attribute:ecs.availability-zone'
-                },
-            ]
-        )
 
-    return elb_dns
+def describe_services_batched(cluster, services, executor):
+    """Returns {service name: service} with one describe_services call per 10 services, made concurrently."""
+    ecs_client = get_client('ecs')
+    batches = [services[i:i + 10] for i in range(0, len(services), 10)]
+    described = {}
+    for response in executor.map(lambda batch: ecs_client.describe_services(cluster=cluster, services=batch),
+                                 batches):
+        for service in response['services']:
+            described[service['serviceName']] = service
+    return described
 
 
-def cleanup(project_name='spring-petclinic-rest',
-            service_list={'spring-petclinic-rest-system': '8080','spring-petclinic-rest-owner': '8080', 'spring-petclinic-rest-pet': '8080','spring-petclinic-rest-vet': '8080','spring-petclinic-rest-visit': '8080'}, region='us-west-2'):
-    ecr_client = boto3.client('ecr')
-    ecs_client = boto3.client('ecs')
-    elbv2_client = boto3.client('elbv2')
+def count_healthy_targets(target_group_arn):
+    health = get_client('elbv2').describe_target_health(TargetGroupArn=target_group_arn)
+    return len([target for target in health['TargetHealthDescriptions']
+                if target['TargetHealth']['State'] == 'healthy'])
 
-    for service in service_list:
-        try:
-            ecr_client.delete_repository(repositoryName=service, force=True)
-        except Exception as e:
-            logger.error(e)
+
+def service_readiness(service, healthy_targets):
+    """Returns (running, healthy, steady) for a described ECS service and its count of healthy targets.
+
+    While an outgoing deployment is still registered its tasks count among the healthy targets, so the service is
+    only healthy once the primary deployment's rollout has completed.
+    """
+    primary = next((deployment for deployment in service['deployments'] if deployment['status'] == 'PRIMARY'),
+                   None)
+    if primary is None:
+        return False, False, False
+    running = primary['runningCount'] >= primary['desiredCount']
+    rolled_out = len(service['deployments']) == 1 or primary.get('rolloutState') == 'COMPLETED'
+    healthy = running and rolled_out and healthy_targets >= primary['desiredCount']
+    return running, healthy, healthy and len(service['deployments']) == 1
+
+
+def wait_for_services_ready(project_name, target_groups, started=None, min_delay=5, max_delay=30, timeout=1800):
+    """Watches every service until it reaches steady state and returns how long each one took.
+
+    target_groups maps service name to target group ARN and started maps service name to the time its
+    create_service or update_service call returned. Returns readiness dicts (service, status, running, healthy) with
+    the seconds it took each service to run all its tasks and to pass health checks on all of them.
+    """
+    started = started or {}
+    now = time.time()
+    readiness = OrderedDict((service, {'service': service, 'status': 'pending', 'running': None, 'healthy': None})
+                            for service in target_groups)
+    deadline = now + timeout
+    delay = min_delay
+    with RegionExecutor(max_workers=min(len(target_groups), 10) or 1) as executor:
+        while True:
+            waiting = [service for service in readiness if readiness[service]['status'] == 'pending']
+            if not waiting:
+                break
+            described = describe_services_batched(project_name, waiting, executor)
+            health = dict(zip(waiting, executor.map(lambda service: count_healthy_targets(target_groups[service]),
+                                                    waiting)))
+            now = time.time()
+            progressed = False
+            for service in waiting:
+                current = readiness[service]
+                if service not in described:
+                    current['status'] = 'missing'
+                    continue
+                if any(d.get('rolloutState') == 'FAILED' for d in described[service]['deployments']):
+                    current['status'] = 'failed'
+                    continue
+                running, healthy, steady = service_readiness(described[service], health[service])
+                if running and current['running'] is None:
+                    current['running'] = now - started.get(service, now)
+                    progressed = True
+                if healthy and current['healthy'] is None:
+                    current['healthy'] = now - started.get(service, now)
+                    progressed = True
+                if steady:
+                    current['status'] = 'steady'
+                    logger.info(service + ' is steady, healthy in %.1fs' % current['healthy'])
+            if not [service for service in readiness if readiness[service]['status'] == 'pending']:
+                break
+            if now > deadline:
+                break
+            delay = min_delay if progressed else min(delay * 2, max_delay)
+            time.sleep(uniform(delay / 2.0, delay))
+
+    results = list(readiness.values())
+    logger.info('Service readiness:\n' + format_readiness_table(results))
+    not_ready = [result['service'] + ' (' + result['status'] + ')' for result in results
+                 if result['status'] != 'steady']
+    if not_ready:
+        raise Exception('Services did not reach steady state: ' + ', '.join(not_ready))
+    return results
+
+
+def format_readiness_table(results):
+    def seconds(value):
+        return '-' if value is None else '%.1f' % value
+
+    width = max(len('service'), max(len(result['service']) for result in results))
+    lines = ['%-*s  %-8s  %10s  %10s' % (width, 'service', 'status', 'running s', 'healthy s')]
+    for result in sorted(results, key=lambda r: (r['healthy'] is None, r['healthy']), reverse=True):
+        lines.append('%-*s  %-8s  %10s  %10s' % (width, result['service'], result['status'],
+                                                 seconds(result['running']), seconds(result['healthy'])))
+    return '\n'.join(lines)
+
+
+def add_service_tasks(graph, project_name, service, index, port, region, state):
+    graph.add('target-group:' + service,
+              lambda inputs: create_service_target_group(project_name, service, index, port,
+                                                         inputs['load-balancer'], state),
+              requires=['load-balancer'])
+    graph.add('task-definition:' + service,
+              lambda inputs: register_service_task_definition(
+                  project_name, service, port, inputs['repositories'][service] + ':' + inputs['image-tags'][service],
+                  inputs['roles']['taskrolearn'], inputs['load-balancer']['dns_name'],
+                  service_my_sql_options(inputs['stack']), region, state['task_definitions'].get(service)),
+              requires=['roles', 'repositories', 'image-tags', 'stack', 'load-balancer'])
+    graph.add('service:' + service,
+              lambda inputs: create_ecs_service(project_name, service, port,
+                                                inputs['task-definition:' + service]['taskDefinitionArn'],
+                                                inputs['target-group:' + service], inputs['roles']['ecsrolearn'],
+                                                state['services'].get(service)),
+              requires=['roles', 'builds', 'target-group:' + service, 'listener-rules',
+                        'task-definition:' + service])
+    # The system service's target group is the listener's default one, which carries a request count as well
+    graph.add('auto-scaling:' + service,
+              lambda inputs: configure_service_scaling(
+                  project_name, service,
+                  desired_scaling(service, service_profile(service, DEFAULT_SERVICE_PROFILE),
+                                  inputs['load-balancer']['arn'], inputs['target-group:' + service]),
+                  state['scaling'].get(service)),
+              requires=['load-balancer', 'target-group:' + service, 'service:' + service])
+
+
+def setup(project_name='spring-petclinic-rest',
+          service_list={'spring-petclinic-rest-system': '8080','spring-petclinic-rest-owner': '8080', 'spring-petclinic-rest-pet': '8080','spring-petclinic-rest-vet': '8080','spring-petclinic-rest-visit': '8080'}
+          , region='us-west-2', build_workers=5, state=None, cache=None, readiness_timeout=1800, shared=None):
+    """Creates the project. With a state from collect_state(), resources that already exist are reused.
+
+    Every phase's result is saved to the DeploymentState cache as soon as it finishes. Returns once every service
+    is steady with all its targets healthy, or right after the services are created when readiness_timeout is 0.
+    In a multi-region run, shared creates the IAM roles and builds the images once for all regions.
+    """
+    state = state or empty_state()
+    cache = cache or DeploymentState(project_name, region)
+    role_arns = existing_role_arns(state)
+
+    # IAM roles, ECR repositories and image builds run while the CloudFormation stack is still being created
+    graph = TaskGraph()
+    graph.add('roles', lambda inputs: role_arns or (shared.roles() if shared else create_roles(ROLE_NAMES)))
+    graph.add('docker-login', lambda inputs: docker_login_config())
+    graph.add('cluster', lambda inputs: None if state['stack'] else create_ecs_cluster(project_name, CLUSTER_INSTANCE_TYPE,
+                                                                                        CLUSTER_SIZE))
+    graph.add('repositories', lambda inputs: create_repositories(service_list, state['repositories']))
+    graph.add('image-tags', lambda inputs: hash_services(service_list))
+    graph.add('builds',
+              lambda inputs: shared.builds(region, inputs['repositories'], inputs['image-tags'], build_workers)
+              if shared else build_services(inputs['repositories'], inputs['image-tags'], max_workers=build_workers),
+              requires=['repositories', 'image-tags', 'docker-login'])
+    graph.add('stack', lambda inputs: wait_for_ecs_cluster(project_name), requires=['cluster'])
+    graph.add('load-balancer',
+              lambda inputs: state['load_balancer'] or create_load_balancer(
+                  project_name, inputs['stack'], health_profile('spring-petclinic-rest-system'),
+                  project_name + '-rest-micro'),
+              requires=['stack'])
+    for index, service in enumerate(service_list):
+        add_service_tasks(graph, project_name, service, index, service_list[service], region, state)
+    # Every path rule is placed in one pass once all target groups exist, so priorities are assigned together
+    graph.add('listener-rules',
+              lambda inputs: apply_listener_rules(service_list, inputs['load-balancer'],
+                                                  dict((service, inputs['target-group:' + service])
+                                                       for service in service_list), state),
+              requires=['load-balancer'] + ['target-group:' + service for service in service_list])
+    if readiness_timeout:
+        graph.add('readiness',
+                  lambda inputs: wait_for_services_ready(
+                      project_name, dict((service, inputs['target-group:' + service]) for service in service_list),
+                      started=dict((service, graph.timings['service:' + service][1]) for service in service_list),
+                      timeout=readiness_timeout),
+                  requires=['target-group:' + service for service in service_list] +
+                           ['service:' + service for service in service_list])
+
+    with region_scope(region):
+        results = graph.run(on_result=lambda name, result: cache.record_phase(project_name, name, result))
+    logger.info(graph.format_critical_path())
+    return results['load-balancer']['dns_name']
+
+
+def empty_state():
+    """State of a project that has nothing deployed yet; see collect_state()."""
+    return {'stack': None, 'roles': {}, 'repositories': {}, 'load_balancer': None, 'target_groups': {},
+            'rules': {}, 'task_definitions': {}, 'services': {}, 'scaling': {}, 'health_checks': {}}
+
+
+def existing_role_arns(state):
+    if all(state['roles'].get(name) for name in ROLE_NAMES.values()):
+        return dict((key, state['roles'][name]) for key, name in ROLE_NAMES.items())
+
+
+STATE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.deploy-state')
+
+
+class DeploymentState(object):
+    """What the last run created for a project, kept in .deploy-state/<region>/<project>.json.
+
+    Lets plan, apply and cleanup skip the lookups whose answers cannot have changed; every cached id is still
+    checked against AWS before it is trusted, see collect_state().
+    """
+
+    def __init__(self, project_name, region):
+        self.filename = os.path.join(STATE_DIRECTORY, region, project_name + '.json')
+        self.lock = threading.Lock()
+        self.data = self.load()
+
+    def load(self):
         try:
-            task_definition = ecs_client.describe_task_definition(taskDefinition=service)
-            ecs_client.deregister_task_definition(
-                taskDefinition=task_definition['taskDefinition']['family'].encode('utf-8') + ':' + str(
-                    task_definition['taskDefinition']['revision']))
-        except Exception as e:
-            logger.error(e)
+            with open(self.filename) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def record(self, section, value, name=None):
+        """Saves value as section, or as section[name], merging with what other runs wrote meanwhile."""
+        with self.lock:
+            if not os.path.isdir(os.path.dirname(self.filename)):
+                os.makedirs(os.path.dirname(self.filename))
+            with file_lock(self.filename):
+                self.data = self.load()
+                if name is None:
+                    self.data[section] = value
+                else:
+                    self.data.setdefault(section, {})[name] = value
+                write_json_atomically(self.filename, self.data)
+
+    def record_phase(self, project_name, phase, result):
+        """Saves the result of a setup() phase."""
+        if phase == 'roles':
+            self.record('roles', dict((ROLE_NAMES[key], arn) for key, arn in result.items()))
+        elif phase == 'repositories':
+            self.record('repositories', dict(result))
+        elif phase == 'image-tags':
+            self.record('image_tags', dict(result))
+        elif phase == 'builds':
+            self.record('image_digests', dict((build['service'], build['digest']) for build in result))
+        elif phase == 'stack':
+            self.record('stack', {'stack_id': result.stack_id, 'outputs': result.outputs,
+                                  'resources': [dict((key, resource.get(key)) for key in
+                                                     ('LogicalResourceId', 'PhysicalResourceId', 'ResourceType',
+                                                      'ResourceStatus'))
+                                                for resource in result.by_logical_id.values()]})
+        elif phase == 'load-balancer':
+            self.record('load_balancer', result)
+        elif phase.startswith('target-group:'):
+            self.record('target_groups', result, phase[len('target-group:'):])
+        elif phase.startswith('task-definition:'):
+            self.record('task_definitions', dict((key, result.get(key)) for key in
+                                                 ('taskDefinitionArn', 'revision', 'taskRoleArn',
+                                                  'containerDefinitions')),
+                        phase[len('task-definition:'):])
+        elif phase.startswith('service:'):
+            self.record('services', result, phase[len('service:'):])
+
+    def delete(self):
+        # The .lock file stays: another run may hold or be waiting on it, and a new one would not exclude that run
+        with self.lock, file_lock(self.filename):
+            self.data = {}
+            if os.path.exists(self.filename):
+                os.remove(self.filename)
+
+
+def describe_stack_or_none(stack_name):
+    try:
+        return get_client('cloudformation').describe_stacks(StackName=stack_name)['Stacks'][0]
+    except botocore.exceptions.ClientError as e:
+        if 'does not exist' in str(e):
+            return None
+        raise
+
+
+def find_roles():
+    iam_client = get_client('iam')
+
+    def get_role_arn(role_name):
         try:
-            ecs_client.update_service(cluster=project_name, service=service, desiredCount=0)
-            ecs_client.delete_service(cluster=project_name, service=service)
-            logger.info('Deleted service: ' + service)
+            return iam_client.get_role(RoleName=role_name)['Role']['Arn']
+        except iam_client.exceptions.NoSuchEntityException:
+            return None
 
-        except Exception as e:
-            logger.error(e)
+    with RegionExecutor(max_workers=len(ROLE_NAMES)) as executor:
+        return dict(zip(ROLE_NAMES.values(), executor.map(get_role_arn, ROLE_NAMES.values())))
+
+
+def find_load_balancer(project_name, cached=None):
+    """Returns the load balancer with its listener, target groups, listener rules and the health check of each target
+    group by ARN, or (None, {}, {}, {}).
 
+    A cached load balancer is checked by ARN and keeps its cached listener instead of listing the listeners.
+    """
+    elb_client = get_client('elbv2')
     try:
-        load_balancer = elbv2_client.describe_load_balancers(Names=[project_name + '-elb'])
-        elbv2_client.delete_load_balancer(LoadBalancerArn=load_balancer['LoadBalancers'][0]['LoadBalancerArn'])
-        time.sleep(10)
-    except Exception as e:
-        logger.error(e)
-    logger.info('Draining services traffics')
-    target_groups = elbv2_client.describe_target_groups()['TargetGroups']
-    for target_group in target_groups:
-        target_group_name = target_group['TargetGroupName'][0:len(project_name)]
-        if target_group_name == project_name:
-            try:
-                logger.info('Deleting target group ' + target_group_name)
-                elbv2_client.delete_target_group(TargetGroupArn=target_group['TargetGroupArn'])
-            except Exception as e:
-                logger.error(e)
+        if cached:
+            load_balancer = elb_client.describe_load_balancers(LoadBalancerArns=[cached['arn']])['LoadBalancers'][0]
         else:
-            logger.warn('No target group found: ' + target_group_name)
-    logger.info('Deleting ELBv2')
+            load_balancer = elb_client.describe_load_balancers(Names=[project_name + '-elb'])['LoadBalancers'][0]
+    except elb_client.exceptions.LoadBalancerNotFoundException:
+        if cached:
+            return find_load_balancer(project_name)
+        return None, {}, {}, {}
+
+    target_groups = {}
+    health_checks = {}
+    for page in elb_client.get_paginator('describe_target_groups').paginate(
+            LoadBalancerArn=load_balancer['LoadBalancerArn']):
+        for target_group in page['TargetGroups']:
+            target_groups[target_group['TargetGroupName']] = target_group['TargetGroupArn']
+            health_checks[target_group['TargetGroupArn']] = dict((key, target_group.get(key))
+                                                                 for key in HEALTH_CHECK_KEYS)
+
+    if cached:
+        listener = {'ListenerArn': cached['listener_arn'],
+                    'DefaultActions': [{'TargetGroupArn': cached['default_target_group_arn']}]}
+    else:
+        listeners = elb_client.describe_listeners(LoadBalancerArn=load_balancer['LoadBalancerArn'])['Listeners']
+        listener = next((listener for listener in listeners if listener['Port'] == 80), None)
+        if listener is None:
+            return None, target_groups, {}, health_checks
 
     try:
-        delete_ecs_cluster(project_name)
-    except Exception as e:
-        logger.error(e)
-
-    target_groups = elbv2_client.describe_target_groups()['TargetGroups']
-    for target_group in target_groups:
-        target_group_name = target_group['TargetGroupName'][0:len(project_name)]
-        if target_group_name == project_name:
+        rules = read_listener_rules(listener['ListenerArn'])
+    except elb_client.exceptions.ListenerNotFoundException:
+        if cached:
+            return find_load_balancer(project_name)
+        raise
+
+    return ({'arn': load_balancer['LoadBalancerArn'], 'dns_name': load_balancer['DNSName'],
+             'listener_arn': listener['ListenerArn'],
+             'default_target_group_arn': listener['DefaultActions'][0]['TargetGroupArn'],
+             'vpc_id': load_balancer['VpcId']},
+            target_groups, rules, health_checks)
+
+
+def find_task_definitions(services, cached=None, ecs_services=None):
+    """Describes the latest task definition of each service.
+
+    A cached task definition is used as is when the service still runs exactly that revision.
+    """
+    ecs_client = get_client('ecs')
+    cached = cached or {}
+    ecs_services = ecs_services or {}
+
+    def describe(service):
+        current = ecs_services.get(service)
+        if cached.get(service) and current and current['taskDefinition'] == cached[service]['taskDefinitionArn']:
+            return cached[service]
+        try:
+            return ecs_client.describe_task_definition(taskDefinition=service)['taskDefinition']
+        except botocore.exceptions.ClientError:
+            return None
+
+    with RegionExecutor(max_workers=len(services)) as executor:
+        return dict(zip(services, executor.map(describe, services)))
+
+
+def find_services(project_name, services):
+    ecs_client = get_client('ecs')
+    found = {}
+    # describe_services accepts at most 10 services per call
+    for start in range(0, len(services), 10):
+        try:
+            response = ecs_client.describe_services(cluster=project_name, services=services[start:start + 10])
+        except ecs_client.exceptions.ClusterNotFoundException:
+            return {}
+        for service in response['services']:
+            found[service['serviceName']] = service
+    return found
+
+
+def find_scaling(project_name, services):
+    """Returns {service: {'min', 'max', 'policies'}} for the services registered with Application Auto Scaling."""
+    scaling_client = get_client('application-autoscaling')
+    resource_ids = dict((scaling_resource_id(project_name, service), service) for service in services)
+    found = {}
+    for page in scaling_client.get_paginator('describe_scalable_targets').paginate(
+            ServiceNamespace='ecs', ResourceIds=list(resource_ids), ScalableDimension=SCALABLE_DIMENSION):
+        for target in page['ScalableTargets']:
+            found[resource_ids[target['ResourceId']]] = {'min': target['MinCapacity'], 'max': target['MaxCapacity'],
+                                                         'policies': {}}
+    if found:
+        # Policy names are only unique per scalable target, so other projects' policies are filtered out
+        names = [service + suffix for service in found for suffix in ('-cpu', '-requests')]
+        for page in scaling_client.get_paginator('describe_scaling_policies').paginate(ServiceNamespace='ecs',
+                                                                                       PolicyNames=names):
+            for policy in page['ScalingPolicies']:
+                service = resource_ids.get(policy['ResourceId'])
+                if service in found:
+                    found[service]['policies'][policy['PolicyName']] = \
+                        policy.get('TargetTrackingScalingPolicyConfiguration', {})
+    return found
+
+
+def collect_state(project_name, service_list, cache=None):
+    """Reads what already exists for a project with a handful of batched, concurrent describe calls.
+
+    With a DeploymentState cache the cached IAM roles, stack resources, listener and task definitions are only
+    validated against the stack, load balancer and service descriptions instead of being looked up again.
+    """
+    services = list(service_list)
+    cached = cache.data if cache else {}
+    cached_roles = cached.get('roles', {})
+    state = empty_state()
+    with RegionExecutor(max_workers=6) as executor:
+        stack = executor.submit(describe_stack_or_none, project_name)
+        if all(cached_roles.get(name) for name in ROLE_NAMES.values()):
+            roles = None
+        else:
+            roles = executor.submit(find_roles)
+        repositories = executor.submit(find_repositories, services)
+        load_balancer = executor.submit(find_load_balancer, project_name, cached.get('load_balancer'))
+        ecs_services = executor.submit(find_services, project_name, services)
+        scaling = executor.submit(find_scaling, project_name, services)
+
+        state['stack'] = stack.result()
+        state['roles'] = roles.result() if roles else dict(cached_roles)
+        state['repositories'] = repositories.result()
+        state['load_balancer'], state['target_groups'], state['rules'], state['health_checks'] = \
+            load_balancer.result()
+        state['services'] = ecs_services.result()
+        state['scaling'] = scaling.result()
+    state['task_definitions'] = find_task_definitions(services, cached.get('task_definitions'), state['services'])
+
+    cached_stack = cached.get('stack')
+    if state['stack'] and cached_stack and cached_stack['stack_id'] == state['stack']['StackId'] \
+            and state['stack']['StackStatus'] in ('CREATE_COMPLETE', 'UPDATE_COMPLETE'):
+        cache_stack_resources(project_name, StackResources(state['stack'], cached_stack['resources']))
+    return state
+
+
+def plan_changes(project_name, service_list, state, image_tags, region):
+    """Returns the (action, resource type, name) changes that setup() needs to make on top of state."""
+    changes = []
+    stack = state['stack']
+    stack_resources = None
+    if stack is None:
+        changes.append(('create', 'stack', project_name))
+    elif is_stack_in_progress(stack['StackStatus']):
+        changes.append(('wait', 'stack', project_name + ' (' + stack['StackStatus'] + ')'))
+    elif stack['StackStatus'] in ('CREATE_COMPLETE', 'UPDATE_COMPLETE'):
+        stack_resources = get_stack_resources(project_name, stack=stack)
+    else:
+        raise Exception('Stack ' + project_name + ' is ' + stack['StackStatus'] + ', run cleanup first')
+
+    for role_name in ROLE_NAMES.values():
+        if not state['roles'].get(role_name):
+            changes.append(('create', 'role', role_name))
+    role_arns = existing_role_arns(state)
+
+    load_balancer = state['load_balancer']
+    if load_balancer is None:
+        changes.append(('create', 'load-balancer', project_name + '-elb'))
+
+    # One describe_images per repository, all at once
+    repositories = [service for service in service_list if state['repositories'].get(service)]
+    with RegionExecutor(max_workers=len(repositories) or 1) as executor:
+        images = dict(zip(repositories, executor.map(lambda service: image_exists(service, image_tags[service]),
+                                                     repositories)))
+    for index, service in enumerate(service_list):
+        port = service_list[service]
+        repository_uri = state['repositories'].get(service)
+        if not repository_uri:
+            changes.append(('create', 'repository', service))
+        if not images.get(service):
+            changes.append(('build', 'image', service + ':' + image_tags[service]))
+
+        if service != 'spring-petclinic-rest-system':
+            target_group_name = project_name + str(index) + '-tg'
+            if target_group_name not in state['target_groups']:
+                changes.append(('create', 'target-group', target_group_name))
+
+        matches = False
+        if repository_uri and load_balancer and stack_resources and role_arns:
+            container_definitions = service_container_definitions(
+                project_name, service, port, repository_uri + ':' + image_tags[service], load_balancer['dns_name'],
+                service_my_sql_options(stack_resources), region)
+            matches = task_definition_matches(state['task_definitions'].get(service), role_arns['taskrolearn'],
+                                              container_definitions)
+        if not matches:
+            changes.append(('register', 'task-definition', service))
+
+        current = state['services'].get(service)
+        if not current or current['status'] != 'ACTIVE':
+            changes.append(('create', 'service', service))
+        elif not matches:
+            changes.append(('update', 'service', service))
+        profile = service_profile(service, DEFAULT_SERVICE_PROFILE)
+        if current and current['status'] == 'ACTIVE' and profile['minCount'] == profile['maxCount'] \
+                and current['desiredCount'] != profile['count']:
+            changes.append(('scale', 'service',
+                            service + ' (%d -> %d tasks)' % (current['desiredCount'], profile['count'])))
+        if current and current['status'] == 'ACTIVE' and any(current.get(key, []) != profile[key] for key in
+                                                             ('placementStrategy', 'placementConstraints')):
+            changes.append(('update', 'placement', service))
+        target_group_arn = None
+        if service != 'spring-petclinic-rest-system':
+            target_group_arn = state['target_groups'].get(project_name + str(index) + '-tg')
+        elif load_balancer:
+            target_group_arn = load_balancer['default_target_group_arn']
+        scaling = desired_scaling(service, profile, load_balancer['arn'] if load_balancer else None,
+                                  target_group_arn)
+        if not scaling_matches(state['scaling'].get(service), scaling):
+            if scaling is None:
+                changes.append(('remove', 'auto-scaling', service))
+            else:
+                changes.append(('configure', 'auto-scaling', service + ' (%d-%d tasks)' % (scaling['min'],
+                                                                                           scaling['max'])))
+        health = HEALTH_PROFILES[profile['healthProfile']]
+        if target_group_arn and not health_checks_match(state['health_checks'].get(target_group_arn), health) \
+                or current and current['status'] == 'ACTIVE' \
+                and current.get('healthCheckGracePeriodSeconds') != health['healthCheckGracePeriodSeconds']:
+            changes.append(('update', 'health-check', service + ' (' + profile['healthProfile'] + ')'))
+
+    rules = ListenerRules(load_balancer['listener_arn'], state['rules']) if load_balancer else ListenerRules(None, {})
+    for action, path, priority in rules.changes(desired_rules(service_list)):
+        changes.append((action, 'rule', path + ' (priority ' + str(priority) + ')'))
+    return changes
+
+
+def format_changes(changes):
+    if not changes:
+        return 'No changes, the project is up to date'
+    return 'Planned changes:\n' + '\n'.join('  %-9s %-16s %s' % change for change in changes)
+
+
+def cluster_instances(project_name):
+    """Returns the container instances registered in the project cluster with their full CPU and memory."""
+    ecs_client = get_client('ecs')
+    try:
+        arns = [arn for page in ecs_client.get_paginator('list_container_instances').paginate(cluster=project_name)
+                for arn in page['containerInstanceArns']]
+    except ecs_client.exceptions.ClusterNotFoundException:
+        return []
+    instances = []
+    # describe_container_instances accepts at most 100 instances per call
+    for start in range(0, len(arns), 100):
+        response = ecs_client.describe_container_instances(cluster=project_name,
+                                                           containerInstances=arns[start:start + 100])
+        for instance in response['containerInstances']:
+            resources = dict((resource['name'], resource.get('integerValue')) for resource in
+                             instance['registeredResources'])
+            instances.append({'id': instance['ec2InstanceId'], 'cpu': resources['CPU'], 'memory': resources['MEMORY'],
+                              'attributes': dict((attribute['name'], attribute.get('value')) for attribute in
+                                                 instance.get('attributes', []))})
+    return instances
+
+
+def modelled_instances(region, instance_type=CLUSTER_INSTANCE_TYPE, count=CLUSTER_SIZE):
+    """Returns the container instances the cluster stack launches, one per availability zone in turn."""
+    cpu, memory = INSTANCE_RESOURCES[instance_type]
+    return [{'id': 'instance-%d' % (index + 1), 'cpu': cpu, 'memory': memory,
+             'attributes': {'ecs.availability-zone': region + 'abc'[index % 3], 'ecs.instance-type': instance_type}}
+            for index in range(count)]
+
+
+def instance_attribute(instance, field):
+    """Returns the value of a spread field or constraint attribute such as attribute:ecs.availability-zone."""
+    if field in ('instanceId', 'host'):
+        return instance['id']
+    return instance['attributes'].get(field[len('attribute:'):] if field.startswith('attribute:') else field)
+
+
+def matches_expression(instance, expression):
+    """Evaluates a memberOf expression made of 'attribute:<name> <op> <value>' terms joined by 'and'.
+
+    The operators are ==, !=, =~ (wildcard match), in [...] and not_in [...], which covers the expressions placement
+    is usually constrained with; anything else raises instead of being guessed.
+    """
+    for term in expression.split(' and '):
+        parts = term.strip().split(None, 2)
+        if len(parts) != 3 or parts[1] not in ('==', '!=', '=~', 'in', 'not_in'):
+            raise Exception('Placement simulation does not support the expression: ' + expression)
+        field, operator, operand = parts
+        value = instance_attribute(instance, field)
+        values = [item.strip() for item in operand.strip('[]').split(',')]
+        if operator == '==' and value != operand or operator == '!=' and value == operand \
+                or operator == '=~' and not fnmatch.fnmatchcase(value or '', operand) \
+                or operator == 'in' and value not in values or operator == 'not_in' and value in values:
+            return False
+    return True
+
+
+def simulate_placement(service_list, instances):
+    """Places the tasks of every service on instances the way the ECS scheduler does.
+
+    A task can go to an instance with enough CPU and memory left that meets the service's constraints. Each strategy
+    in turn narrows these candidates, and the first remaining one gets the task. Returns the tasks per service on
+    each instance, the CPU and memory left on each instance and the tasks per service that fit nowhere.
+    """
+    placed = OrderedDict((instance['id'], OrderedDict()) for instance in instances)
+    remaining = dict((instance['id'], {'cpu': instance['cpu'], 'memory': instance['memory']}) for instance in instances)
+    unplaced = OrderedDict()
+    for service in service_list:
+        profile = service_profile(service, DEFAULT_SERVICE_PROFILE)
+        cpu = profile['cpu'] or 0
+        memory = profile['memoryReservation'] or profile['memory']
+        for _ in range(profile['count']):
+            candidates = [instance for instance in instances
+                          if remaining[instance['id']]['cpu'] >= cpu and remaining[instance['id']]['memory'] >= memory
+                          and all(matches_expression(instance, constraint['expression'])
+                                  if constraint['type'] == 'memberOf' else service not in placed[instance['id']]
+                                  for constraint in profile['placementConstraints'])]
+            for strategy in profile['placementStrategy']:
+                if strategy['type'] == 'spread' and candidates:
+                    tasks = {}
+                    for instance in instances:
+                        value = instance_attribute(instance, strategy['field'])
+                        tasks[value] = tasks.get(value, 0) + placed[instance['id']].get(service, 0)
+                    fewest = min(tasks[instance_attribute(instance, strategy['field'])] for instance in candidates)
+                    candidates = [instance for instance in candidates
+                                  if tasks[instance_attribute(instance, strategy['field'])] == fewest]
+                elif strategy['type'] == 'binpack' and candidates:
+                    least = min(remaining[instance['id']][strategy['field']] for instance in candidates)
+                    candidates = [instance for instance in candidates
+                                  if remaining[instance['id']][strategy['field']] == least]
+            if not candidates:
+                unplaced[service] = unplaced.get(service, 0) + 1
+                continue
+            chosen = candidates[0]['id']
+            remaining[chosen]['cpu'] -= cpu
+            remaining[chosen]['memory'] -= memory
+            placed[chosen][service] = placed[chosen].get(service, 0) + 1
+    return placed, remaining, unplaced
+
+
+def format_placement(instances, placed, remaining, unplaced):
+    lines = ['%-21s %-12s %-11s %-11s %-13s %s' % ('Instance', 'Zone', 'Type', 'CPU', 'Memory', 'Tasks')]
+    for instance in instances:
+        used = remaining[instance['id']]
+        lines.append('%-21s %-12s %-11s %-11s %-13s %s' % (
+            instance['id'], instance['attributes'].get('ecs.availability-zone', ''),
+            instance['attributes'].get('ecs.instance-type', ''),
+            '%d/%d' % (instance['cpu'] - used['cpu'], instance['cpu']),
+            '%d/%d' % (instance['memory'] - used['memory'], instance['memory']),
+            ', '.join('%s x%d' % (service, tasks) for service, tasks in placed[instance['id']].items()) or '-'))
+    lines.append('Instances running tasks: %d of %d' % (len([tasks for tasks in placed.values() if tasks]),
+                                                          len(instances)))
+    for service, tasks in unplaced.items():
+        lines.append('Cannot place %d task(s) of %s' % (tasks, service))
+    return '\n'.join(lines)
+
+
+def placement(project_name='spring-petclinic-rest',
+              service_list={'spring-petclinic-rest-system': '8080','spring-petclinic-rest-owner': '8080', 'spring-petclinic-rest-pet': '8080','spring-petclinic-rest-vet': '8080','spring-petclinic-rest-visit': '8080'}
+              , region='us-west-2'):
+    """Shows how the tasks of every service would be placed on the cluster, without deploying anything.
+
+    Uses the container instances registered in the cluster, or the fleet the cluster stack launches when there are
+    none yet. Returns the tasks per service that fit nowhere.
+    """
+    with region_scope(region):
+        instances = cluster_instances(project_name)
+    if instances:
+        logger.info('Simulating placement on the %d container instances of %s' % (len(instances), project_name))
+    else:
+        instances = modelled_instances(region)
+        logger.info('No container instances registered yet, simulating placement on %d %s instances' %
+                    (CLUSTER_SIZE, CLUSTER_INSTANCE_TYPE))
+    placed, remaining, unplaced = simulate_placement(service_list, instances)
+    logger.info('Task placement:\n' + format_placement(instances, placed, remaining, unplaced))
+    return unplaced
+
+
+def plan(project_name='spring-petclinic-rest',
+         service_list={'spring-petclinic-rest-system': '8080','spring-petclinic-rest-owner': '8080', 'spring-petclinic-rest-pet': '8080','spring-petclinic-rest-vet': '8080','spring-petclinic-rest-visit': '8080'}
+         , region='us-west-2'):
+    """Compares the deployed project with the desired one and returns the changes apply would make."""
+    with region_scope(region):
+        state = collect_state(project_name, service_list, DeploymentState(project_name, region))
+        changes = plan_changes(project_name, service_list, state, hash_services(service_list), region)
+    logger.info(format_changes(changes))
+    return changes
+
+
+def apply(project_name='spring-petclinic-rest',
+          service_list={'spring-petclinic-rest-system': '8080','spring-petclinic-rest-owner': '8080', 'spring-petclinic-rest-pet': '8080','spring-petclinic-rest-vet': '8080','spring-petclinic-rest-visit': '8080'}
+          , region='us-west-2', build_workers=5, readiness_timeout=1800, shared=None):
+    """Makes only the changes plan() reports, reusing every resource that is already in place."""
+    cache = DeploymentState(project_name, region)
+    with region_scope(region):
+        state = collect_state(project_name, service_list, cache)
+        changes = plan_changes(project_name, service_list, state, hash_services(service_list), region)
+    logger.info(format_changes(changes))
+    if not changes:
+        return state['load_balancer']['dns_name']
+    return setup(project_name=project_name, service_list=service_list, region=region, build_workers=build_workers,
+                 state=state, cache=cache, readiness_timeout=readiness_timeout, shared=shared)
+
+
+def load_test_paths(service_list):
+    """Returns the request path of every listener rule, plus / for the system service behind the default rule."""
+    paths = []
+    for service in service_list:
+        if service == 'spring-petclinic-rest-system':
+            paths.insert(0, '/')
+        else:
+            paths.append(service_path_pattern(service).rstrip('*'))
+    return paths
+
+
+def load_test_endpoint(project_name, region):
+    """Returns http://<dns name> of the project's load balancer, from the deployment state if it is cached."""
+    load_balancer = DeploymentState(project_name, region).data.get('load_balancer')
+    if load_balancer:
+        return 'http://' + load_balancer['dns_name']
+    elb_client = get_client('elbv2', region)
+    load_balancer = elb_client.describe_load_balancers(Names=[project_name + '-elb'])['LoadBalancers'][0]
+    return 'http://' + load_balancer['DNSName']
+
+
+async def read_http_response(reader):
+    """Reads one HTTP/1.1 response and returns (status, whether the server closes the connection)."""
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('Connection closed by server')
+    status = int(status_line.split()[1])
+    length = None
+    chunked = False
+    close = False
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        name = name.strip().lower()
+        value = value.strip().lower()
+        if name == 'content-length':
+            length = int(value)
+        elif name == 'transfer-encoding' and 'chunked' in value:
+            chunked = True
+        elif name == 'connection' and value == 'close':
+            close = True
+    if chunked:
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                break
+            await reader.readexactly(size + 2)
+    elif length is not None:
+        await reader.readexactly(length)
+    else:
+        await reader.read()
+        close = True
+    return status, close
+
+
+async def load_test_worker(endpoint, paths, deadline, schedule, samples, timeout):
+    """Sends GET requests over one keep-alive connection until deadline, recording (latency, ok) per path.
+
+    With a schedule each request waits for the next free send slot, which caps the total request rate.
+    """
+    loop = asyncio.get_running_loop()
+    url = urlsplit(endpoint)
+    secure = url.scheme == 'https'
+    port = url.port or (443 if secure else 80)
+    connection = None
+    while True:
+        if schedule is not None:
+            slot = schedule['next']
+            schedule['next'] += schedule['interval']
+            if slot >= deadline:
+                break
+            await asyncio.sleep(max(0, slot - loop.time()))
+        if loop.time() >= deadline:
+            break
+        path = next(paths)
+        started = loop.time()
+        try:
+            if connection is None:
+                connection = await asyncio.wait_for(
+                    asyncio.open_connection(url.hostname, port, ssl=ssl.create_default_context() if secure else None),
+                    timeout)
+            reader, writer = connection
+            writer.write(('GET ' + path + ' HTTP/1.1\r\nHost: ' + url.netloc + '\r\nConnection: keep-alive\r\n\r\n')
+                         .encode('latin-1'))
+            status, close = await asyncio.wait_for(read_http_response(reader), timeout)
+            ok = status < 400
+        except (OSError, ValueError, IndexError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            ok = False
+            close = True
+        samples[path].append((loop.time() - started, ok))
+        if close and connection is not None:
+            connection[1].close()
+            connection = None
+    if connection is not None:
+        connection[1].close()
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, int(math.ceil(fraction * len(sorted_values))) - 1)]
+
+
+def summarize_load_test(samples, seconds):
+    """Returns {path: throughput, error rate and latency percentiles in milliseconds}, plus a 'total' entry."""
+    summary = OrderedDict()
+    everything = [sample for path_samples in samples.values() for sample in path_samples]
+    for path, path_samples in list(samples.items()) + [('total', everything)]:
+        latencies = sorted(latency * 1000 for latency, ok in path_samples)
+        errors = len([ok for latency, ok in path_samples if not ok])
+        summary[path] = {'requests': len(path_samples), 'errors': errors,
+                         'error_rate': float(errors) / len(path_samples) if path_samples else 0.0,
+                         'throughput': len(path_samples) / seconds if seconds else 0.0,
+                         'p50_ms': percentile(latencies, 0.50), 'p95_ms': percentile(latencies, 0.95),
+                         'p99_ms': percentile(latencies, 0.99)}
+    return summary
+
+
+def format_load_test_table(summary):
+    def milliseconds(value):
+        return '-' if value is None else '%.1f' % value
+
+    lines = ['%-20s %8s %8s %8s %10s %9s %9s %9s' % ('Path', 'Requests', 'Errors', 'Error %', 'Req/s', 'p50 ms',
+                                                     'p95 ms', 'p99 ms')]
+    for path, result in summary.items():
+        lines.append('%-20s %8d %8d %8.2f %10.1f %9s %9s %9s' % (
+            path, result['requests'], result['errors'], result['error_rate'] * 100, result['throughput'],
+            milliseconds(result['p50_ms']), milliseconds(result['p95_ms']), milliseconds(result['p99_ms'])))
+    return '\n'.join(lines)
+
+
+async def run_load_test_async(endpoint, paths, duration, concurrency, rate, timeout):
+    loop = asyncio.get_running_loop()
+    samples = OrderedDict((path, []) for path in paths)
+    started = loop.time()
+    schedule = {'next': started, 'interval': 1.0 / rate} if rate else None
+    path_cycle = itertools.cycle(paths)
+    await asyncio.gather(*[load_test_worker(endpoint, path_cycle, started + duration, schedule, samples, timeout)
+                           for _ in range(concurrency)])
+    return samples, loop.time() - started
+
+
+def load_test(endpoint, paths, duration=30, concurrency=10, rate=None, timeout=10, output=None):
+    """Sends GET requests to every path of endpoint for duration seconds and returns a summary per path.
+
+    concurrency is the number of keep-alive connections kept busy; rate, when set, caps the total requests per
+    second across all of them. The summary is also written as JSON to output when given.
+    """
+    logger.info('Load testing ' + endpoint + ' on ' + ', '.join(paths) + ' for %ds with %d connections'
+                % (duration, concurrency) + (' at %.1f req/s' % rate if rate else ''))
+    samples, seconds = asyncio.run(run_load_test_async(endpoint, paths, duration, concurrency, rate, timeout))
+    summary = summarize_load_test(samples, seconds)
+    logger.info('Load test results:\n' + format_load_test_table(summary))
+    if output:
+        with open(output, 'w') as f:
+            json.dump({'endpoint': endpoint, 'duration': seconds, 'concurrency': concurrency, 'rate': rate,
+                       'paths': summary}, f, indent=2)
+        logger.info('Load test results written to ' + output)
+    return summary
+
+
+class LogTail(object):
+    """Tails the awslogs streams of several services at once and merges them into one time-ordered output.
+
+    One poller per service pages through filter_log_events from where its last pass ended, so the number of calls
+    does not grow with the number of tasks, and every poller shares the rate limiter's logs.FilterLogEvents bucket.
+    A poller that finds nothing new backs off up to max_delay. Pollers hand events to a bounded queue and block when it
+    is full, so a slow output slows the polling down instead of growing memory. An event is written once every
+    poller has read past its timestamp, which keeps the output in order although services are polled at different
+    times; past max_pending held events the oldest are written anyway, so a stalled poller cannot grow memory either.
+    """
+
+    def __init__(self, log_group, prefixes, start_time, output=print, queue_size=1000, max_pending=10000,
+                 min_delay=1, max_delay=10, late_seconds=5):
+        self.log_group = log_group
+        # {label: log stream name prefix}
+        self.prefixes = prefixes
+        self.start_time = start_time
+        self.output = output
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.max_pending = max_pending
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        # Events can be ingested after events with a later timestamp, so each pass re-reads this many seconds
+        self.late_ms = int(late_seconds * 1000)
+        self.stopped = threading.Event()
+        self.pending = []
+        # Keeps events with the same timestamp in arrival order
+        self.order = itertools.count()
+        self.read_up_to = dict((label, start_time) for label in prefixes)
+        self.events = 0
+
+    def put(self, item):
+        while not self.stopped.is_set():
             try:
-                logger.info('Deleting target group ' + target_group_name)
-                elbv2_client.delete_target_group(TargetGroupArn=target_group['TargetGroupArn'])
-            except Exception as e:
-                logger.error(e)
+                self.queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def poll(self, label, prefix):
+        logs_client = get_client('logs')
+        start = self.start_time
+        seen = {}
+        delay = self.min_delay
+        while not self.stopped.is_set():
+            pass_started = int(time.time() * 1000)
+            kwargs = {'logGroupName': self.log_group, 'logStreamNamePrefix': prefix, 'startTime': start}
+            found = 0
+            while not self.stopped.is_set():
+                try:
+                    page = logs_client.filter_log_events(**kwargs)
+                except logs_client.exceptions.ResourceNotFoundException:
+                    # The log group only exists once the first task has started
+                    page = {'events': []}
+                for event in page['events']:
+                    if event['eventId'] in seen:
+                        continue
+                    seen[event['eventId']] = event['timestamp']
+                    found += 1
+                    if not self.put(('event', event['timestamp'], label, event['logStreamName'], event['message'])):
+                        return
+                if not page.get('nextToken'):
+                    break
+                kwargs['nextToken'] = page['nextToken']
+            start = max(start, pass_started - self.late_ms)
+            seen = dict((event_id, timestamp) for event_id, timestamp in seen.items() if timestamp >= start)
+            if not self.put(('read', label, start)):
+                return
+            delay = self.min_delay if found else min(self.max_delay, delay * 2)
+            self.stopped.wait(delay)
+
+    def write(self, up_to=None):
+        """Writes the pending events older than up_to, or all of them, and the oldest beyond max_pending."""
+        while self.pending and (up_to is None or self.pending[0][0] < up_to or len(self.pending) > self.max_pending):
+            timestamp, _, label, stream, message = heapq.heappop(self.pending)
+            # awslogs streams are named <prefix>/<container name>/<task id>
+            task = stream.rsplit('/', 1)[-1][:8]
+            self.output('%s %s %s %s' % (datetime.fromtimestamp(timestamp / 1000.0).strftime('%H:%M:%S.%f')[:-3],
+                                         label, task, message.rstrip('\n')))
+            self.events += 1
+
+    def handle(self, item):
+        if item[0] == 'event':
+            _, timestamp, label, stream, message = item
+            heapq.heappush(self.pending, (timestamp, next(self.order), label, stream, message))
+            if len(self.pending) > self.max_pending:
+                self.write(min(self.read_up_to.values()))
         else:
-            logger.warn('No target group found: ' + target_group_name)
-    logger.info("Deleting roles")
+            _, label, start = item
+            self.read_up_to[label] = start
+            self.write(min(self.read_up_to.values()))
+
+    def run(self, duration=None):
+        """Tails until duration seconds have passed, or until interrupted when duration is None."""
+        deadline = time.time() + duration if duration else None
+        with RegionExecutor(max_workers=len(self.prefixes)) as executor:
+            futures = [executor.submit(self.poll, label, prefix) for label, prefix in self.prefixes.items()]
+            try:
+                while deadline is None or time.time() < deadline:
+                    failed = [future for future in futures if future.done()]
+                    if failed:
+                        failed[0].result()
+                        break
+                    try:
+                        self.handle(self.queue.get(timeout=0.5))
+                    except queue.Empty:
+                        pass
+            except KeyboardInterrupt:
+                pass
+            finally:
+                self.stopped.set()
+                while not self.queue.empty():
+                    self.handle(self.queue.get())
+                self.write()
+        return self.events
+
+
+def tail_logs(project_name, service_list, region, since=60, duration=None, output=print):
+    """Writes the log events of every service from since seconds ago on, merged in time order, as they arrive."""
+    prefixes = OrderedDict((service, project_name + '/' + service + '/') for service in service_list)
+    width = max(len(service) for service in service_list)
+    tail = LogTail('ECSLogGroup-' + project_name, OrderedDict((service.ljust(width), prefix)
+                                                              for service, prefix in prefixes.items()),
+                   int((time.time() - since) * 1000), output=output)
+    logger.info('Tailing ' + tail.log_group + ' for %d services, Ctrl-C to stop' % len(prefixes))
+    with region_scope(region):
+        events = tail.run(duration)
+    logger.info('%d log events' % events)
+    return events
+
+
+def delete_repositories(services, timings):
+    """Deletes the ECR repositories of services in parallel."""
+    with RegionExecutor(max_workers=len(services) or 1) as executor:
+        futures = [executor.submit(run_timed, timings, 'ecr-repository:' + service, delete_repository, service)
+                   for service in services]
+        for future in futures:
+            future.result()
+
+
+def cleanup(project_name='spring-petclinic-rest',
+            service_list={'spring-petclinic-rest-system': '8080','spring-petclinic-rest-owner': '8080', 'spring-petclinic-rest-pet': '8080','spring-petclinic-rest-vet': '8080','spring-petclinic-rest-visit': '8080'}, region='us-west-2', roles=True, repositories=True):
+    """Deletes the project.
+
+    IAM roles are global and ECR repositories are shared by every project of a region, so a batch keeps them until
+    every deployment is cleaned up, and they are kept while another project's deployment state still records them.
+    Raises, keeping the deployment state, when a resource could not be deleted.
+    """
+    timings = {}
+    cache = DeploymentState(project_name, region)
+    roles_in_use, repositories_in_use = shared_resources_in_use(STATE_DIRECTORY, {(project_name, region)})
+    repositories_in_use = repositories_in_use.get(region, set())
+    if repositories and repositories_in_use.intersection(service_list):
+        logger.info('Keeping repositories used by other projects: ' +
+                    ', '.join(sorted(repositories_in_use.intersection(service_list))))
+
+    with region_scope(region):
+        load_balancer_arn = find_load_balancer_arn(project_name, cache.data.get('load_balancer'))
+        target_groups = index_project_target_groups(project_name, service_list, load_balancer_arn,
+                                                    cache.data.get('target_groups'))
+        logger.info('Found %d target groups to delete' % len(target_groups))
+
+        # Services drain while the load balancer is being deleted; both wait until AWS reports them gone
+        logger.info('Draining services traffics')
+        with RegionExecutor(max_workers=len(service_list) + 1) as executor:
+            task_definitions = cache.data.get('task_definitions', {})
+            futures = [executor.submit(teardown_service, project_name, service, timings,
+                                       task_definitions.get(service, {}).get('taskDefinitionArn'),
+                                       repositories and service not in repositories_in_use)
+                       for service in service_list]
+            if load_balancer_arn:
+                futures.append(executor.submit(run_timed, timings, 'load-balancer:' + project_name + '-elb',
+                                               delete_load_balancer, load_balancer_arn))
+            for future in futures:
+                future.result()
+
+        delete_target_groups(target_groups, timings)
+
+        run_timed(timings, 'stack:' + project_name, delete_ecs_cluster, project_name)
+
+        # Groups still referenced by the stack's resources can only be removed once it is gone
+        delete_target_groups(target_groups, timings)
+        if roles and roles_in_use.intersection(ROLE_NAMES.values()):
+            logger.info('Keeping roles used by other projects')
+        elif roles:
+            logger.info("Deleting roles")
+            run_timed(timings, 'roles', delete_roles, ROLE_NAMES)
+
+    logger.info('Cleanup timings:\n' + format_timing_table(timings))
+    # A retry needs the saved state to find what is left, so it is only deleted once everything is gone
+    failed = sorted(name for name, (status, seconds) in timings.items() if status == 'error')
+    if failed:
+        raise Exception('Failed to delete ' + ', '.join(failed) + '; the deployment state is kept for a retry')
+    cache.delete()
+    return timings
+
+
+def run_deployment(mode, project_name, service_list, region, build_workers=5, readiness_timeout=1800, shared=None):
+    """Runs setup, plan, apply or cleanup for one project and region of a batch and returns its one line result."""
     try:
-        delete_roles()
-    except Exception as e:
-        logger.error(e)
+        with telemetry.span('deployment:' + project_name + '@' + region):
+            if mode == 'setup':
+                return 'http://' + setup(project_name=project_name, service_list=service_list, region=region,
+                                         build_workers=build_workers, readiness_timeout=readiness_timeout,
+                                         shared=shared)
+            elif mode == 'plan':
+                return '%d planned changes' % len(plan(project_name=project_name, service_list=service_list,
+                                                       region=region))
+            elif mode == 'apply':
+                return 'http://' + apply(project_name=project_name, service_list=service_list, region=region,
+                                         build_workers=build_workers, readiness_timeout=readiness_timeout,
+                                         shared=shared)
+            elif mode == 'cleanup':
+                cleanup(project_name=project_name, service_list=service_list, region=region, roles=False,
+                        repositories=False)
+                return 'deleted'
+            raise Exception('Mode ' + mode + ' does not support several projects or regions')
+    finally:
+        if shared:
+            shared.deployment_done(region)
+
+
+def read_manifest(filename, regions, service_list):
+    """Reads the deployments of a batch from a JSON manifest.
+
+    The manifest is a list of project names, or of objects with a project_name and optionally a region and a
+    service_list. Entries without a region are deployed to every one of regions.
+    """
+    with open(filename) as f:
+        entries = json.load(f)
+    deployments = []
+    for entry in entries:
+        if not isinstance(entry, dict):
+            entry = {'project_name': entry}
+        if 'project_name' not in entry:
+            raise Exception('Manifest entry without a project_name: ' + json.dumps(entry))
+        if not entry.get('region') and not regions:
+            raise Exception('No region for ' + entry['project_name'] + ', give one in the manifest or with -r')
+        for region in ([entry['region']] if entry.get('region') else regions):
+            deployments.append({'project_name': entry['project_name'], 'region': region,
+                                'service_list': entry.get('service_list', service_list)})
+    return deployments
+
+
+def format_batch_table(results):
+    lines = ['%-32s %-16s %-8s %10s  %s' % ('Project', 'Region', 'Status', 'Seconds', 'Result')]
+    for (project_name, region), result in results.items():
+        lines.append('%-32s %-16s %-8s %10.1f  %s' % (project_name, region, result['status'], result['seconds'],
+                                                      result['result']))
+    return '\n'.join(lines)
+
+
+def deploy_batch(mode, deployments, build_workers=5, readiness_timeout=1800, max_workers=16):
+    """Runs mode for many projects and regions at once in this process and reports them together.
+
+    Deployments share the AWS clients, and with them their connection pools, the per operation rate limits and the
+    API budget set by configure_clients(api_rate=...). Each has its own deployment state. The images are built once,
+    in the first region. The IAM roles, which are global, are created once. They and the ECR repositories, which
+    every project of a region shares, are deleted after every deployment is cleaned up, unless the deployment state
+    of a project outside the batch still records them.
+    """
+    keys = [(deployment['project_name'], deployment['region']) for deployment in deployments]
+    if len(set(keys)) != len(keys):
+        raise Exception('A project can only be deployed once per region in a batch')
+    shared = SharedDeployment([deployment['region'] for deployment in deployments], ROLE_NAMES, build_services)
+
+    def run(deployment):
+        started = time.time()
+        try:
+            result = run_deployment(mode, deployment['project_name'], deployment['service_list'],
+                                    deployment['region'], build_workers, readiness_timeout, shared)
+            return {'status': 'ok', 'seconds': time.time() - started, 'result': result}
+        except Exception as e:
+            logger.error(deployment['project_name'] + '@' + deployment['region'] + ': ' + str(e))
+            return {'status': 'failed', 'seconds': time.time() - started, 'result': str(e)}
+
+    # Deployments start in submission order, so the build region ones, which the others wait for, go first
+    ordered = sorted(deployments, key=lambda deployment: deployment['region'] != shared.build_region)
+    with RegionExecutor(max_workers=min(max_workers, len(deployments))) as executor:
+        futures = dict(((deployment['project_name'], deployment['region']), executor.submit(run, deployment))
+                       for deployment in ordered)
+        results = OrderedDict((key, futures[key].result()) for key in keys)
+
+    failed = [project_name + '@' + region for (project_name, region), result in results.items()
+              if result['status'] == 'failed']
+    if mode == 'cleanup' and not failed:
+        timings = {}
+        roles_in_use, repositories_in_use = shared_resources_in_use(STATE_DIRECTORY, set(keys))
+        for region in OrderedDict.fromkeys(deployment['region'] for deployment in deployments):
+            services = list(OrderedDict.fromkeys(
+                service for deployment in deployments if deployment['region'] == region
+                for service in deployment['service_list']))
+            kept = [service for service in services if service in repositories_in_use.get(region, ())]
+            if kept:
+                logger.info('Keeping repositories used by other projects in ' + region + ': ' + ', '.join(kept))
+            logger.info("Deleting repositories in " + region)
+            with region_scope(region):
+                delete_repositories([service for service in services if service not in kept], timings)
+        if roles_in_use.intersection(ROLE_NAMES.values()):
+            logger.info('Keeping roles used by other projects')
+        else:
+            logger.info("Deleting roles")
+            with region_scope(deployments[0]['region']):
+                delete_roles(ROLE_NAMES)
+    logger.info('Batch results:\n' + format_batch_table(results))
+    if failed:
+        raise Exception('Failed in ' + ', '.join(failed))
+    return results
 
 
 def main():
     parser = argparse.ArgumentParser(description="Execute input file. Supports only python or sh file.")
-    parser.add_argument('-m', '--mode', required=True, help="execution mode -m cleanup or -m setup")
+    parser.add_argument('-m', '--mode', required=True,
+                        help="execution mode -m setup, -m plan, -m apply, -m placement, -m loadtest, -m logs or "
+                             "-m cleanup")
     parser.add_argument('-p', '--project_name', required=False, default='spring-petclinic-micro',
                         help="Name of the project")
-    parser.add_argument('-r', '--region', required=True, help="Region is required.")
+    parser.add_argument('-r', '--region', required=False, help="Region. Required unless --regions is given")
+    parser.add_argument('--projects', required=False,
+                        help="Comma separated project names deployed at once in this process, instead of -p")
+    parser.add_argument('--manifest', required=False,
+                        help="JSON list of projects to deploy at once, as names or objects with project_name and "
+                             "optionally region and service_list")
+    parser.add_argument('--batch_workers', required=False, type=int, default=16,
+                        help="Projects and regions deployed at the same time. Default 16")
+    parser.add_argument('--api_rate', required=False, type=float,
+                        help="AWS API calls per second shared by every project and region of the run. Default no "
+                             "limit")
+    parser.add_argument('--rate_limits', required=False,
+                        help="Comma separated calls per second per region for service.Operation, service or *, "
+                             "e.g. ecs.CreateService=2,iam=3. Limits adapt down on throttling errors and back up as "
+                             "calls succeed")
+    parser.add_argument('--health_profile', required=False, choices=sorted(HEALTH_PROFILES),
+                        help="Health checks, deregistration delay, slow start and grace period of the services whose "
+                             "ecs-service-config.json sets no healthProfile. Default default")
+    parser.add_argument('--regions', required=False,
+                        help="Comma separated regions deployed at once, e.g. us-west-2,eu-west-1. Images are built "
+                             "in the first one")
+    parser.add_argument('-w', '--build_workers', required=False, type=int, default=5,
+                        help="Number of service images built and pushed in parallel. Default 5")
+    parser.add_argument('--max_pool_connections', required=False, type=int, default=50,
+                        help="HTTP connections kept per AWS client. Default 50")
+    parser.add_argument('--api_timeout', required=False, type=int, default=60,
+                        help="Read timeout in seconds for AWS API calls. Default 60")
+    parser.add_argument('--trace_output', required=False, default='aws-trace.json',
+                        help="Chrome trace file of the AWS API calls and phases of the run. Default aws-trace.json")
+    parser.add_argument('--readiness_timeout', required=False, type=int, default=1800,
+                        help="Seconds to wait for every service to reach steady state, 0 to not wait. Default 1800")
+    parser.add_argument('--endpoint', required=False,
+                        help="URL to load test. Default the project's load balancer")
+    parser.add_argument('--duration', required=False, type=int, default=30,
+                        help="Seconds the load test runs. Default 30")
+    parser.add_argument('--concurrency', required=False, type=int, default=10,
+                        help="Connections the load test keeps busy. Default 10")
+    parser.add_argument('--rate', required=False, type=float,
+                        help="Total requests per second the load test sends. Default as fast as possible")
+    parser.add_argument('--loadtest_output', required=False, default='loadtest-results.json',
+                        help="JSON file the load test results are written to. Default loadtest-results.json")
+    parser.add_argument('--since', required=False, type=int, default=60,
+                        help="Seconds of past log events -m logs starts with. Default 60")
+    parser.add_argument('--log_seconds', required=False, type=int,
+                        help="Seconds -m logs keeps tailing. Default until interrupted")
     parser.add_argument('-s', '--service_list', required=False,
                         default={'spring-petclinic-rest-system': '8080','spring-petclinic-rest-owner': '8080', 'spring-petclinic-rest-pet': '8080','spring-petclinic-rest-vet': '8080','spring-petclinic-rest-visit': '8080'},
                         help="Service list. Default {'spring-petclinic-rest-owner' : '8080',"
@@ -612,20 +1716,62 @@ def main():
 
     project_name = args.project_name
     service_list = args.service_list
-    region = args.region
+    regions = [region.strip() for region in (args.regions or args.region or '').split(',') if region.strip()]
+    if not regions and not args.manifest:
+        parser.error('Region is required, use -r or --regions')
     mode = args.mode
-    os.environ["AWS_DEFAULT_REGION"] = region
+    rate_limits = dict(CLIENT_SETTINGS['rate_limits'])
+    rate_limits.update(parse_rate_limits(args.rate_limits))
+    configure_clients(max_pool_connections=args.max_pool_connections, read_timeout=args.api_timeout,
+                      api_rate=args.api_rate, rate_limits=rate_limits)
+    if args.health_profile:
+        DEFAULT_SERVICE_PROFILE['healthProfile'] = args.health_profile
+    if args.manifest:
+        deployments = read_manifest(args.manifest, regions, service_list)
+    elif args.projects:
+        deployments = [{'project_name': name.strip(), 'region': region, 'service_list': service_list}
+                       for name in args.projects.split(',') if name.strip() for region in regions]
+    else:
+        deployments = [{'project_name': project_name, 'region': region, 'service_list': service_list}
+                       for region in regions]
+    if not deployments:
+        parser.error('Nothing to deploy')
+    project_name, region, service_list = (deployments[0]['project_name'], deployments[0]['region'],
+                                          deployments[0]['service_list'])
 
     logger.info("Mode: " + mode)
 
-    if mode == 'setup':
-        setup_results = setup(project_name=project_name, service_list=service_list, region=region)
-        logger.info("Setup is complete your endpoint is http://"+setup_results)
-    elif mode == 'cleanup':
-        cleanup_results = cleanup(project_name=project_name, service_list=service_list, region=region)
-    else:
-        parser.print_help()
-        raise Exception("Not supported mode")
+    try:
+        with telemetry.span(mode):
+            if len(deployments) > 1 and mode in ('setup', 'plan', 'apply', 'cleanup'):
+                deploy_batch(mode, deployments, build_workers=args.build_workers,
+                             readiness_timeout=args.readiness_timeout, max_workers=args.batch_workers)
+            elif mode == 'setup':
+                setup_results = setup(project_name=project_name, service_list=service_list, region=region,
+                                      build_workers=args.build_workers, readiness_timeout=args.readiness_timeout)
+                logger.info("Setup is complete your endpoint is http://"+setup_results)
+            elif mode == 'plan':
+                plan(project_name=project_name, service_list=service_list, region=region)
+            elif mode == 'apply':
+                apply_results = apply(project_name=project_name, service_list=service_list, region=region,
+                                      build_workers=args.build_workers, readiness_timeout=args.readiness_timeout)
+                logger.info("Apply is complete your endpoint is http://" + apply_results)
+            elif mode == 'placement':
+                placement(project_name=project_name, service_list=service_list, region=region)
+            elif mode == 'loadtest':
+                endpoint = args.endpoint or load_test_endpoint(project_name, region)
+                load_test(endpoint, load_test_paths(service_list), duration=args.duration, concurrency=args.concurrency,
+                          rate=args.rate, output=args.loadtest_output)
+            elif mode == 'logs':
+                tail_logs(project_name, service_list, region, since=args.since, duration=args.log_seconds)
+            elif mode == 'cleanup':
+                cleanup_results = cleanup(project_name=project_name, service_list=service_list, region=region)
+            else:
+                parser.print_help()
+                raise Exception("Not supported mode")
+    finally:
+        telemetry.finish(args.trace_output)
+        logger.info('AWS API rate limits:\n' + api_limiter.format_metrics())
 
 
 if __name__ == "__main__":
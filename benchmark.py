@@ -0,0 +1,1315 @@
+#!/bin/python
+"""Benchmarks the orchestration of the setup scripts against a simulated AWS backend.
+
+Every AWS call the scripts make is answered in-process by SimulatedAWS, with a configurable latency per
+operation and CloudFormation stacks, ECS services and load balancer targets that change state over time like the
+real ones. Maven builds are replaced by a sleep. Nothing leaves the machine, so the scenarios can run in CI to
+compare changes to concurrency and waiting logic.
+"""
+import argparse
+import base64
+import hashlib
+import importlib.util
+import itertools
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from botocore.awsrequest import AWSResponse
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+MONOLITH_DIRECTORY = os.path.join(ROOT, '1_ECS_Java_Spring_PetClinic')
+MICROSERVICES_DIRECTORY = os.path.join(ROOT, '2_ECS_Java_Spring_PetClinic_Microservices')
+ACCOUNT_ID = '123456789012'
+
+# Seconds each call takes before it is answered, by 'service.Operation'; every other call takes DEFAULT_LATENCY
+DEFAULT_LATENCY = 0.05
+OPERATION_LATENCY = {
+    'cloudformation.CreateStack': 0.4,
+    'cloudformation.DeleteStack': 0.2,
+    'ecr.CreateRepository': 0.2,
+    'ecr.DeleteRepository': 0.3,
+    'ecr.GetAuthorizationToken': 0.1,
+    'ecs.CreateService': 0.3,
+    'ecs.RegisterTaskDefinition': 0.15,
+    'elbv2.CreateLoadBalancer': 0.5,
+    'elbv2.CreateTargetGroup': 0.15,
+    'elbv2.DeleteLoadBalancer': 0.2,
+    'iam.CreateRole': 0.2,
+    'iam.DeleteRole': 0.15,
+}
+
+# Most log events filter_log_events returns per page
+LOG_PAGE_SIZE = 1000
+
+# How long the simulated resources take to change state, in seconds
+DEFAULT_TIMINGS = {
+    'stack_create': 20.0,
+    'stack_delete': 10.0,
+    'task_start': 3.0,
+    'target_healthy': 5.0,
+    'service_drain': 2.0,
+    'build': 2.0,
+}
+
+
+class SimulatedError(Exception):
+    def __init__(self, code, message, status=400):
+        Exception.__init__(self, message)
+        self.code = code
+        self.message = message
+        self.status = status
+
+
+def snake_case(name):
+    return ''.join('_' + c.lower() if c.isupper() else c for c in name).lstrip('_')
+
+
+def short_id():
+    return uuid.uuid4().hex[:17]
+
+
+def utc_now():
+    return datetime.now(timezone.utc)
+
+
+class SimulatedAWS(object):
+    """In-memory CloudFormation, ECS, ECR, ELBv2, EC2, IAM, Application Auto Scaling, CloudWatch Logs and tagging APIs
+    for the calls the scripts make.
+
+    attach() hooks a boto3 client so that every call is answered by the method named <service>_<operation>
+    after sleeping the operation's latency. Responses go through botocore's after-call events and error
+    handling, so modeled exceptions, paginators, waiters and the scripts' own telemetry behave as against AWS.
+    """
+
+    def __init__(self, region='us-west-2', latency=None, latency_scale=1.0, timings=None):
+        self.region = region
+        self.latency = dict(OPERATION_LATENCY)
+        self.latency.update(latency or {})
+        self.latency_scale = latency_scale
+        self.timings = dict(DEFAULT_TIMINGS)
+        self.timings.update(timings or {})
+        self.lock = threading.RLock()
+        self.attached = set()
+        self.roles = {}
+        self.stacks = OrderedDict()
+        self.clusters = set()
+        self.subnet_vpcs = {}
+        self.repositories = OrderedDict()
+        self.images = {}
+        self.task_definitions = {}
+        self.services = OrderedDict()
+        self.load_balancers = OrderedDict()
+        self.target_groups = OrderedDict()
+        self.listeners = OrderedDict()
+        self.rules = OrderedDict()
+        self.scalable_targets = OrderedDict()
+        self.scaling_policies = OrderedDict()
+        self.log_events = {}
+        self.log_event_ids = itertools.count()
+
+    def attach(self, client):
+        if id(client) in self.attached:
+            return
+        self.attached.add(id(client))
+        client.meta.events.register('before-parameter-build', self._capture_params)
+        client.meta.events.register('before-call', self._answer)
+
+    def _capture_params(self, params, context, **kwargs):
+        context['simulated_params'] = dict(params)
+
+    def _answer(self, model, context, **kwargs):
+        service = model.service_model.service_name
+        operation = model.name
+        handler = getattr(self, service.replace('-', '_') + '_' + snake_case(operation), None)
+        if handler is None:
+            raise NotImplementedError('Simulated AWS does not implement ' + service + '.' + operation)
+        time.sleep(self.latency.get(service + '.' + operation, DEFAULT_LATENCY) * self.latency_scale)
+        try:
+            with self.lock:
+                parsed = handler(**context.pop('simulated_params', {})) or {}
+            status = 200
+        except SimulatedError as e:
+            parsed = {'Error': {'Code': e.code, 'Message': e.message}}
+            status = e.status
+        parsed['ResponseMetadata'] = {'RequestId': str(uuid.uuid4()), 'HTTPStatusCode': status, 'HTTPHeaders': {},
+                                      'RetryAttempts': 0}
+        body = json.dumps(parsed, default=str).encode('utf-8')
+        return AWSResponse('https://' + service + '.simulated', status, {'content-length': str(len(body))},
+                           None), parsed
+
+    def arn(self, service, resource):
+        return 'arn:aws:' + service + ':' + self.region + ':' + ACCOUNT_ID + ':' + resource
+
+    # IAM
+
+    def iam_create_role(self, RoleName, AssumeRolePolicyDocument, Path='/', **kwargs):
+        if RoleName in self.roles:
+            raise SimulatedError('EntityAlreadyExists', 'Role with name ' + RoleName + ' already exists.', 409)
+        self.roles[RoleName] = {'RoleName': RoleName, 'Path': Path, 'RoleId': 'AROA' + short_id().upper(),
+                                'Arn': 'arn:aws:iam::' + ACCOUNT_ID + ':role' + Path + RoleName,
+                                'CreateDate': utc_now(), 'AssumeRolePolicyDocument': AssumeRolePolicyDocument,
+                                'AttachedPolicies': []}
+        return {'Role': self._role(RoleName)}
+
+    def _role(self, name):
+        if name not in self.roles:
+            raise SimulatedError('NoSuchEntity', 'The role with name ' + name + ' cannot be found.', 404)
+        return dict((k, v) for k, v in self.roles[name].items() if k != 'AttachedPolicies')
+
+    def iam_get_role(self, RoleName):
+        return {'Role': self._role(RoleName)}
+
+    def iam_attach_role_policy(self, RoleName, PolicyArn):
+        self._role(RoleName)
+        if PolicyArn not in self.roles[RoleName]['AttachedPolicies']:
+            self.roles[RoleName]['AttachedPolicies'].append(PolicyArn)
+
+    def iam_detach_role_policy(self, RoleName, PolicyArn):
+        self._role(RoleName)
+        if PolicyArn not in self.roles[RoleName]['AttachedPolicies']:
+            raise SimulatedError('NoSuchEntity', 'Policy ' + PolicyArn + ' was not found.', 404)
+        self.roles[RoleName]['AttachedPolicies'].remove(PolicyArn)
+
+    def iam_list_attached_role_policies(self, RoleName, **kwargs):
+        self._role(RoleName)
+        return {'AttachedPolicies': [{'PolicyArn': arn, 'PolicyName': arn.split('/')[-1]}
+                                     for arn in self.roles[RoleName]['AttachedPolicies']], 'IsTruncated': False}
+
+    def iam_delete_role(self, RoleName):
+        self._role(RoleName)
+        if self.roles[RoleName]['AttachedPolicies']:
+            raise SimulatedError('DeleteConflict', 'Cannot delete entity, must detach all policies first.', 409)
+        del self.roles[RoleName]
+
+    # EC2
+
+    def ec2_describe_images(self, **kwargs):
+        return {'Images': [{'ImageId': 'ami-' + short_id(), 'Name': 'amzn-ami-2016.09.f-amazon-ecs-optimized'}]}
+
+    def ec2_create_key_pair(self, KeyName, **kwargs):
+        return {'KeyName': KeyName, 'KeyFingerprint': '00', 'KeyMaterial': 'simulated'}
+
+    def ec2_delete_key_pair(self, KeyName, **kwargs):
+        return {}
+
+    def ec2_authorize_security_group_ingress(self, **kwargs):
+        return {}
+
+    # CloudFormation
+
+    def _physical_id(self, stack_name, logical_id, resource_type, parameters):
+        prefixes = {'AWS::EC2::VPC': 'vpc-', 'AWS::EC2::Subnet': 'subnet-', 'AWS::EC2::SecurityGroup': 'sg-',
+                    'AWS::EC2::InternetGateway': 'igw-', 'AWS::EC2::RouteTable': 'rtb-'}
+        if resource_type == 'AWS::ECS::Cluster':
+            return parameters.get('EcsClusterName', stack_name)
+        if resource_type in prefixes:
+            return prefixes[resource_type] + short_id()
+        return stack_name + '-' + logical_id + '-' + short_id()[:12].upper()
+
+    def cloudformation_create_stack(self, StackName, TemplateBody, Parameters=(), **kwargs):
+        current = self.stacks.get(StackName)
+        if current is not None and self._stack_status(current) != 'DELETE_COMPLETE':
+            raise SimulatedError('AlreadyExistsException', 'Stack [' + StackName + '] already exists')
+        template = json.loads(TemplateBody)
+        parameters = dict((p['ParameterKey'], p.get('ParameterValue')) for p in Parameters)
+        stack_id = self.arn('cloudformation', 'stack/' + StackName + '/' + str(uuid.uuid4()))
+        started = time.time()
+        resources = OrderedDict()
+        names = list(template.get('Resources', {}))
+        for index, logical_id in enumerate(names):
+            resource_type = template['Resources'][logical_id]['Type']
+            resources[logical_id] = {'LogicalResourceId': logical_id, 'ResourceType': resource_type,
+                                     'PhysicalResourceId': self._physical_id(StackName, logical_id, resource_type,
+                                                                             parameters),
+                                     'started': started + self.timings['stack_create'] * index / (len(names) + 1),
+                                     'created': started + self.timings['stack_create'] * (index + 1) / (len(names) + 1)}
+        outputs = []
+        for key in template.get('Outputs', {}):
+            value = 'jdbc:mysql://simulated-db.' + self.region + '.rds.amazonaws.com:3306/petclinic' \
+                if key == 'JDBCConnectionString' else key + '-simulated'
+            outputs.append({'OutputKey': key, 'OutputValue': value})
+        stack = {'StackName': StackName, 'StackId': stack_id, 'started': started,
+                 'completed': started + self.timings['stack_create'], 'deleting': None, 'deleted': None,
+                 'resources': resources, 'outputs': outputs, 'parameters': parameters}
+        self.stacks[StackName] = stack
+        return {'StackId': stack_id}
+
+    def _stack_status(self, stack, now=None):
+        now = now or time.time()
+        if stack['deleted'] is not None and now >= stack['deleted']:
+            return 'DELETE_COMPLETE'
+        if stack['deleting'] is not None:
+            return 'DELETE_IN_PROGRESS'
+        if now >= stack['completed']:
+            return 'CREATE_COMPLETE'
+        return 'CREATE_IN_PROGRESS'
+
+    def _find_stack(self, name):
+        for stack in self.stacks.values():
+            if stack['StackId'] == name:
+                return stack
+        stack = self.stacks.get(name)
+        if stack is None or self._stack_status(stack) == 'DELETE_COMPLETE':
+            raise SimulatedError('ValidationError', 'Stack with id ' + name + ' does not exist')
+        return stack
+
+    def _stack_events(self, stack):
+        """Returns the events that already happened, newest first."""
+        now = time.time()
+        scheduled = [(stack['started'], 'AWS::CloudFormation::Stack', stack['StackName'], stack['StackId'],
+                      'CREATE_IN_PROGRESS')]
+        for resource in stack['resources'].values():
+            scheduled.append((resource['started'], resource['ResourceType'], resource['LogicalResourceId'],
+                              resource['PhysicalResourceId'], 'CREATE_IN_PROGRESS'))
+            scheduled.append((resource['created'], resource['ResourceType'], resource['LogicalResourceId'],
+                              resource['PhysicalResourceId'], 'CREATE_COMPLETE'))
+        scheduled.append((stack['completed'], 'AWS::CloudFormation::Stack', stack['StackName'], stack['StackId'],
+                          'CREATE_COMPLETE'))
+        if stack['deleting'] is not None:
+            scheduled.append((stack['deleting'], 'AWS::CloudFormation::Stack', stack['StackName'], stack['StackId'],
+                              'DELETE_IN_PROGRESS'))
+            names = list(stack['resources'])
+            for index, logical_id in enumerate(reversed(names)):
+                resource = stack['resources'][logical_id]
+                scheduled.append((stack['deleting'] + (stack['deleted'] - stack['deleting']) * (index + 1) /
+                                  (len(names) + 1), resource['ResourceType'], logical_id,
+                                  resource['PhysicalResourceId'], 'DELETE_COMPLETE'))
+            scheduled.append((stack['deleted'], 'AWS::CloudFormation::Stack', stack['StackName'], stack['StackId'],
+                              'DELETE_COMPLETE'))
+        events = []
+        for index, (at, resource_type, logical_id, physical_id, status) in enumerate(scheduled):
+            if at <= now:
+                events.append({'StackId': stack['StackId'], 'StackName': stack['StackName'],
+                               'EventId': stack['StackId'][-12:] + '-%d' % index, 'LogicalResourceId': logical_id,
+                               'PhysicalResourceId': physical_id, 'ResourceType': resource_type,
+                               'ResourceStatus': status, 'Timestamp': datetime.fromtimestamp(at, timezone.utc)})
+        return sorted(events, key=lambda event: event['Timestamp'], reverse=True)
+
+    def _stack_complete(self, stack):
+        # Resources such as the ECS cluster and subnets become usable once the stack is created
+        if self._stack_status(stack) in ('CREATE_COMPLETE', 'DELETE_IN_PROGRESS'):
+            vpc_id = next((r['PhysicalResourceId'] for r in stack['resources'].values()
+                           if r['ResourceType'] == 'AWS::EC2::VPC'), None)
+            for resource in stack['resources'].values():
+                if resource['ResourceType'] == 'AWS::ECS::Cluster':
+                    self.clusters.add(resource['PhysicalResourceId'])
+                elif resource['ResourceType'] == 'AWS::EC2::Subnet':
+                    self.subnet_vpcs[resource['PhysicalResourceId']] = vpc_id
+
+    def cloudformation_describe_stacks(self, StackName):
+        stack = self._find_stack(StackName)
+        self._stack_complete(stack)
+        status = self._stack_status(stack)
+        description = {'StackName': stack['StackName'], 'StackId': stack['StackId'], 'StackStatus': status,
+                       'CreationTime': datetime.fromtimestamp(stack['started'], timezone.utc),
+                       'Parameters': [{'ParameterKey': k, 'ParameterValue': v}
+                                      for k, v in stack['parameters'].items()]}
+        if status == 'CREATE_COMPLETE':
+            description['Outputs'] = stack['outputs']
+        return {'Stacks': [description]}
+
+    def cloudformation_describe_stack_events(self, StackName, NextToken=None):
+        events = self._stack_events(self._find_stack(StackName))
+        start = int(NextToken or 0)
+        page = {'StackEvents': events[start:start + 100]}
+        if start + 100 < len(events):
+            page['NextToken'] = str(start + 100)
+        return page
+
+    def cloudformation_list_stack_resources(self, StackName, NextToken=None):
+        stack = self._find_stack(StackName)
+        status = 'CREATE_COMPLETE' if self._stack_status(stack) == 'CREATE_COMPLETE' else 'CREATE_IN_PROGRESS'
+        summaries = [{'LogicalResourceId': r['LogicalResourceId'], 'PhysicalResourceId': r['PhysicalResourceId'],
+                      'ResourceType': r['ResourceType'], 'ResourceStatus': status,
+                      'LastUpdatedTimestamp': datetime.fromtimestamp(r['created'], timezone.utc)}
+                     for r in stack['resources'].values()]
+        start = int(NextToken or 0)
+        page = {'StackResourceSummaries': summaries[start:start + 100]}
+        if start + 100 < len(summaries):
+            page['NextToken'] = str(start + 100)
+        return page
+
+    def cloudformation_delete_stack(self, StackName):
+        stack = self.stacks.get(StackName)
+        if stack is None or stack['deleting'] is not None:
+            return {}
+        self._stack_complete(stack)
+        stack['deleting'] = max(time.time(), stack['completed'])
+        stack['deleted'] = stack['deleting'] + self.timings['stack_delete']
+        for resource in stack['resources'].values():
+            if resource['ResourceType'] == 'AWS::ECS::Cluster':
+                self.clusters.discard(resource['PhysicalResourceId'])
+        return {}
+
+    # ECR
+
+    def ecr_get_authorization_token(self, **kwargs):
+        token = base64.b64encode(b'AWS:simulated-password').decode('ascii')
+        return {'authorizationData': [{'authorizationToken': token, 'expiresAt': utc_now() + timedelta(hours=12),
+                                       'proxyEndpoint': 'https://' + self.registry_host()}]}
+
+    def registry_host(self):
+        return ACCOUNT_ID + '.dkr.ecr.' + self.region + '.amazonaws.com'
+
+    def _repository(self, name):
+        if name not in self.repositories:
+            raise SimulatedError('RepositoryNotFoundException', "The repository with name '" + name +
+                                 "' does not exist in the registry with id '" + ACCOUNT_ID + "'")
+        return self.repositories[name]
+
+    def ecr_create_repository(self, repositoryName, **kwargs):
+        if repositoryName in self.repositories:
+            raise SimulatedError('RepositoryAlreadyExistsException', "The repository with name '" + repositoryName +
+                                 "' already exists in the registry with id '" + ACCOUNT_ID + "'")
+        self.repositories[repositoryName] = {'repositoryName': repositoryName,
+                                             'repositoryArn': self.arn('ecr', 'repository/' + repositoryName),
+                                             'repositoryUri': self.registry_host() + '/' + repositoryName,
+                                             'registryId': ACCOUNT_ID, 'createdAt': utc_now()}
+        self.images[repositoryName] = {}
+        return {'repository': self.repositories[repositoryName]}
+
+    def ecr_describe_repositories(self, repositoryNames=None, **kwargs):
+        names = repositoryNames if repositoryNames is not None else list(self.repositories)
+        return {'repositories': [self._repository(name) for name in names]}
+
+    def ecr_describe_images(self, repositoryName, imageIds=(), **kwargs):
+        self._repository(repositoryName)
+        details = []
+        for image_id in imageIds:
+            tag = image_id.get('imageTag')
+            if tag not in self.images[repositoryName]:
+                raise SimulatedError('ImageNotFoundException', "The image with imageId {imageTag:'" + str(tag) +
+                                     "'} does not exist within the repository with name '" + repositoryName + "'")
+            details.append({'repositoryName': repositoryName, 'imageTags': [tag],
+                            'imageDigest': self.images[repositoryName][tag], 'registryId': ACCOUNT_ID})
+        return {'imageDetails': details}
+
+    def push_image(self, repository_name, tag):
+        with self.lock:
+            self._repository(repository_name)
+            self.images[repository_name][tag] = 'sha256:' + hashlib.sha256(
+                (repository_name + ':' + tag).encode('utf-8')).hexdigest()
+
+    def ecr_delete_repository(self, repositoryName, force=False, **kwargs):
+        repository = self._repository(repositoryName)
+        if self.images[repositoryName] and not force:
+            raise SimulatedError('RepositoryNotEmptyException', 'The repository with name ' + repositoryName +
+                                 ' cannot be deleted because it still contains images')
+        del self.repositories[repositoryName]
+        del self.images[repositoryName]
+        return {'repository': repository}
+
+    # ELBv2
+
+    def _load_balancer(self, arn):
+        if arn not in self.load_balancers:
+            raise SimulatedError('LoadBalancerNotFound', 'Load balancers \'[' + arn + ']\' not found')
+        return self.load_balancers[arn]
+
+    def elbv2_create_load_balancer(self, Name, Subnets=(), SecurityGroups=(), **kwargs):
+        if any(lb['LoadBalancerName'] == Name for lb in self.load_balancers.values()):
+            raise SimulatedError('DuplicateLoadBalancerName', 'A load balancer with the same name \'' + Name +
+                                 '\' exists, but with different settings')
+        arn = self.arn('elasticloadbalancing', 'loadbalancer/app/' + Name + '/' + short_id()[:16])
+        self.load_balancers[arn] = {
+            'LoadBalancerArn': arn, 'LoadBalancerName': Name, 'Scheme': kwargs.get('Scheme', 'internet-facing'),
+            'DNSName': Name + '-' + short_id()[:10] + '.' + self.region + '.elb.amazonaws.com',
+            'VpcId': self.subnet_vpcs.get(Subnets[0] if Subnets else None, 'vpc-' + short_id()),
+            'State': {'Code': 'active'}, 'Type': 'application', 'SecurityGroups': list(SecurityGroups),
+            'CreatedTime': utc_now()}
+        return {'LoadBalancers': [self.load_balancers[arn]]}
+
+    def elbv2_describe_load_balancers(self, LoadBalancerArns=None, Names=None, **kwargs):
+        if LoadBalancerArns:
+            return {'LoadBalancers': [self._load_balancer(arn) for arn in LoadBalancerArns]}
+        if Names:
+            found = []
+            for name in Names:
+                matches = [lb for lb in self.load_balancers.values() if lb['LoadBalancerName'] == name]
+                if not matches:
+                    raise SimulatedError('LoadBalancerNotFound', 'Load balancers \'[' + name + ']\' not found')
+                found.extend(matches)
+            return {'LoadBalancers': found}
+        return {'LoadBalancers': list(self.load_balancers.values())}
+
+    def elbv2_delete_load_balancer(self, LoadBalancerArn):
+        if LoadBalancerArn not in self.load_balancers:
+            return {}
+        del self.load_balancers[LoadBalancerArn]
+        for listener_arn in [arn for arn, l in self.listeners.items() if l['LoadBalancerArn'] == LoadBalancerArn]:
+            del self.listeners[listener_arn]
+            for rule_arn in [arn for arn, r in self.rules.items() if r['listener'] == listener_arn]:
+                del self.rules[rule_arn]
+        return {}
+
+    def _target_group_load_balancers(self, target_group_arn):
+        arns = set()
+        for listener in self.listeners.values():
+            if any(a.get('TargetGroupArn') == target_group_arn for a in listener['DefaultActions']):
+                arns.add(listener['LoadBalancerArn'])
+        for rule in self.rules.values():
+            if any(a.get('TargetGroupArn') == target_group_arn for a in rule['Actions']):
+                arns.add(self.listeners[rule['listener']]['LoadBalancerArn'])
+        return sorted(arns)
+
+    def _target_group(self, arn):
+        if arn not in self.target_groups:
+            raise SimulatedError('TargetGroupNotFound', 'Target groups \'[' + arn + ']\' not found')
+        target_group = dict(self.target_groups[arn])
+        target_group.pop('Tags')
+        target_group['LoadBalancerArns'] = self._target_group_load_balancers(arn)
+        return target_group
+
+    def elbv2_create_target_group(self, Name, Port=None, Protocol='HTTP', VpcId=None, Tags=(),
+                                                 **kwargs):
+        if any(tg['TargetGroupName'] == Name for tg in self.target_groups.values()):
+            raise SimulatedError('DuplicateTargetGroupName', 'A target group with the same name \'' + Name +
+                                 '\' exists, but with different settings')
+        arn = self.arn('elasticloadbalancing', 'targetgroup/' + Name + '/' + short_id()[:16])
+        target_group = {'TargetGroupArn': arn, 'TargetGroupName': Name, 'Protocol': Protocol, 'Port': Port,
+                        'VpcId': VpcId, 'Tags': list(Tags), 'Attributes': {}}
+        target_group.update(kwargs)
+        self.target_groups[arn] = target_group
+        return {'TargetGroups': [self._target_group(arn)]}
+
+    def elbv2_describe_target_groups(self, LoadBalancerArn=None, TargetGroupArns=None, Names=None,
+                                                    **kwargs):
+        if TargetGroupArns:
+            return {'TargetGroups': [self._target_group(arn) for arn in TargetGroupArns]}
+        if Names:
+            found = []
+            for name in Names:
+                arns = [arn for arn, tg in self.target_groups.items() if tg['TargetGroupName'] == name]
+                if not arns:
+                    raise SimulatedError('TargetGroupNotFound', 'One or more target groups not found')
+                found.extend(self._target_group(arn) for arn in arns)
+            return {'TargetGroups': found}
+        target_groups = [self._target_group(arn) for arn in self.target_groups]
+        if LoadBalancerArn:
+            self._load_balancer(LoadBalancerArn)
+            target_groups = [tg for tg in target_groups if LoadBalancerArn in tg['LoadBalancerArns']]
+        return {'TargetGroups': target_groups}
+
+    def elbv2_modify_target_group(self, TargetGroupArn, **kwargs):
+        self._target_group(TargetGroupArn)
+        self.target_groups[TargetGroupArn].update(kwargs)
+        return {'TargetGroups': [self._target_group(TargetGroupArn)]}
+
+    def elbv2_modify_target_group_attributes(self, TargetGroupArn, Attributes):
+        self._target_group(TargetGroupArn)
+        self.target_groups[TargetGroupArn]['Attributes'].update((a['Key'], a['Value']) for a in Attributes)
+        return {'Attributes': [{'Key': k, 'Value': v}
+                               for k, v in self.target_groups[TargetGroupArn]['Attributes'].items()]}
+
+    def elbv2_delete_target_group(self, TargetGroupArn):
+        if TargetGroupArn not in self.target_groups:
+            return {}
+        if self._target_group_load_balancers(TargetGroupArn):
+            raise SimulatedError('ResourceInUse', 'Target group \'' + TargetGroupArn +
+                                 '\' is currently in use by a listener or a rule')
+        del self.target_groups[TargetGroupArn]
+        return {}
+
+    def elbv2_create_listener(self, LoadBalancerArn, Port, DefaultActions, Protocol='HTTP', **kwargs):
+        self._load_balancer(LoadBalancerArn)
+        arn = self.arn('elasticloadbalancing', 'listener/app/' + LoadBalancerArn.split('/')[-2] + '/' +
+                       short_id()[:16])
+        self.listeners[arn] = {'ListenerArn': arn, 'LoadBalancerArn': LoadBalancerArn, 'Port': Port,
+                               'Protocol': Protocol, 'DefaultActions': list(DefaultActions)}
+        return {'Listeners': [self.listeners[arn]]}
+
+    def elbv2_describe_listeners(self, LoadBalancerArn=None, ListenerArns=None, **kwargs):
+        if ListenerArns:
+            return {'Listeners': [self._listener(arn) for arn in ListenerArns]}
+        self._load_balancer(LoadBalancerArn)
+        return {'Listeners': [l for l in self.listeners.values() if l['LoadBalancerArn'] == LoadBalancerArn]}
+
+    def _listener(self, arn):
+        if arn not in self.listeners:
+            raise SimulatedError('ListenerNotFound', 'One or more listeners not found')
+        return self.listeners[arn]
+
+    def _rule(self, arn):
+        rule = dict(self.rules[arn])
+        rule.pop('listener')
+        return rule
+
+    def elbv2_describe_rules(self, ListenerArn=None, RuleArns=None, Marker=None, **kwargs):
+        if RuleArns:
+            return {'Rules': [self._rule(arn) for arn in RuleArns]}
+        listener = self._listener(ListenerArn)
+        rules = [self._rule(arn) for arn, rule in self.rules.items() if rule['listener'] == ListenerArn]
+        rules.sort(key=lambda rule: int(rule['Priority']))
+        rules.append({'RuleArn': ListenerArn.replace(':listener/', ':listener-rule/') + '/default',
+                      'Priority': 'default', 'Conditions': [], 'Actions': listener['DefaultActions'],
+                      'IsDefault': True})
+        return {'Rules': rules}
+
+    def _check_priority(self, listener_arn, priority, ignore=()):
+        for arn, rule in self.rules.items():
+            if rule['listener'] == listener_arn and int(rule['Priority']) == priority and arn not in ignore:
+                raise SimulatedError('PriorityInUse', 'Priority \'' + str(priority) + '\' is currently in use')
+
+    def elbv2_create_rule(self, ListenerArn, Conditions, Priority, Actions, **kwargs):
+        self._listener(ListenerArn)
+        self._check_priority(ListenerArn, Priority)
+        arn = ListenerArn.replace(':listener/', ':listener-rule/') + '/' + short_id()[:16]
+        self.rules[arn] = {'RuleArn': arn, 'Priority': str(Priority), 'Conditions': list(Conditions),
+                           'Actions': list(Actions), 'IsDefault': False, 'listener': ListenerArn}
+        return {'Rules': [self._rule(arn)]}
+
+    def elbv2_set_rule_priorities(self, RulePriorities):
+        moving = set(change['RuleArn'] for change in RulePriorities)
+        targets = [change['Priority'] for change in RulePriorities]
+        if len(set(targets)) != len(targets):
+            raise SimulatedError('PriorityInUse', 'Priorities must be unique')
+        for change in RulePriorities:
+            if change['RuleArn'] not in self.rules:
+                raise SimulatedError('RuleNotFound', 'One or more rules not found')
+            self._check_priority(self.rules[change['RuleArn']]['listener'], change['Priority'], moving)
+        for change in RulePriorities:
+            self.rules[change['RuleArn']]['Priority'] = str(change['Priority'])
+        return {'Rules': [self._rule(change['RuleArn']) for change in RulePriorities]}
+
+    def elbv2_modify_rule(self, RuleArn, Conditions=None, Actions=None):
+        if RuleArn not in self.rules:
+            raise SimulatedError('RuleNotFound', 'One or more rules not found')
+        if Conditions is not None:
+            self.rules[RuleArn]['Conditions'] = list(Conditions)
+        if Actions is not None:
+            self.rules[RuleArn]['Actions'] = list(Actions)
+        return {'Rules': [self._rule(RuleArn)]}
+
+    def elbv2_describe_target_health(self, TargetGroupArn, **kwargs):
+        self._target_group(TargetGroupArn)
+        now = time.time()
+        descriptions = []
+        for service in self.services.values():
+            if not any(lb['targetGroupArn'] == TargetGroupArn for lb in service['loadBalancers']):
+                continue
+            for deployment in service['deployments']:
+                running = self._running_count(deployment, now)
+                healthy_at = deployment['running_at'] + self.timings['target_healthy']
+                for index in range(running):
+                    descriptions.append({'Target': {'Id': 'i-' + deployment['id'][-8:] + '%04d' % index,
+                                                    'Port': 32768 + index},
+                                         'TargetHealth': {'State': 'healthy' if now >= healthy_at else 'initial'}})
+        return {'TargetHealthDescriptions': descriptions}
+
+    # Resource Groups Tagging API
+
+    def resourcegroupstaggingapi_get_resources(self, TagFilters=(), ResourceTypeFilters=(), PaginationToken=None,
+                                               **kwargs):
+        mappings = []
+        if not ResourceTypeFilters or 'elasticloadbalancing:targetgroup' in ResourceTypeFilters:
+            for arn, target_group in self.target_groups.items():
+                tags = dict((tag['Key'], tag['Value']) for tag in target_group['Tags'])
+                if all(f['Key'] in tags and (not f.get('Values') or tags[f['Key']] in f['Values'])
+                       for f in TagFilters):
+                    mappings.append({'ResourceARN': arn, 'Tags': target_group['Tags']})
+        return {'ResourceTagMappingList': mappings, 'PaginationToken': ''}
+
+    # ECS
+
+    def _task_definition(self, name):
+        family, _, revision = name.split('/')[-1].partition(':')
+        revisions = self.task_definitions.get(family, [])
+        active = [t for t in revisions if t['status'] == 'ACTIVE']
+        if revision:
+            matches = [t for t in revisions if t['revision'] == int(revision)]
+        else:
+            matches = active[-1:]
+        if not matches:
+            raise SimulatedError('ClientException', 'Unable to describe task definition.')
+        return matches[0]
+
+    def ecs_register_task_definition(self, family, containerDefinitions, **kwargs):
+        revisions = self.task_definitions.setdefault(family, [])
+        task_definition = {'family': family, 'revision': len(revisions) + 1, 'status': 'ACTIVE',
+                           'taskDefinitionArn': self.arn('ecs', 'task-definition/' + family + ':%d'
+                                                         % (len(revisions) + 1)),
+                           'containerDefinitions': [self._registered_container(container)
+                                                    for container in containerDefinitions]}
+        task_definition.update(kwargs)
+        revisions.append(task_definition)
+        return {'taskDefinition': task_definition}
+
+    @staticmethod
+    def _registered_container(container):
+        """Returns container with the defaults ECS adds when it registers a task definition."""
+        registered = {'cpu': 0, 'essential': True, 'mountPoints': [], 'volumesFrom': []}
+        registered.update(container)
+        registered['portMappings'] = [dict({'protocol': 'tcp'}, **mapping)
+                                      for mapping in container.get('portMappings', [])]
+        return registered
+
+    def ecs_describe_task_definition(self, taskDefinition, **kwargs):
+        return {'taskDefinition': self._task_definition(taskDefinition)}
+
+    def ecs_deregister_task_definition(self, taskDefinition):
+        task_definition = self._task_definition(taskDefinition)
+        task_definition['status'] = 'INACTIVE'
+        return {'taskDefinition': task_definition}
+
+    def _cluster(self, cluster):
+        name = cluster.split('/')[-1]
+        for stack in self.stacks.values():
+            self._stack_complete(stack)
+        if name not in self.clusters:
+            raise SimulatedError('ClusterNotFoundException', 'Cluster not found.')
+        return name
+
+    def _new_deployment(self, task_definition_arn, desired_count, now):
+        return {'id': 'ecs-svc/' + short_id(), 'status': 'PRIMARY', 'taskDefinition': task_definition_arn,
+                'desiredCount': desired_count, 'createdAt': now,
+                'running_at': now + self.timings['task_start']}
+
+    def _running_count(self, deployment, now):
+        return deployment['desiredCount'] if now >= deployment['running_at'] else 0
+
+    def _service(self, service, now):
+        """Returns the service as describe_services shows it at now, retiring finished deployments."""
+        if service['status'] == 'DRAINING' and now >= service['drained_at']:
+            service['status'] = 'INACTIVE'
+            service['deployments'] = []
+        primary = service['deployments'][0] if service['deployments'] else None
+        if primary and len(service['deployments']) > 1 and \
+                now >= primary['running_at'] + self.timings['target_healthy']:
+            service['deployments'] = [primary]
+        deployments = []
+        for deployment in service['deployments']:
+            running = self._running_count(deployment, now)
+            healthy = now >= deployment['running_at'] + self.timings['target_healthy']
+            deployments.append({'id': deployment['id'], 'status': deployment['status'],
+                                'taskDefinition': deployment['taskDefinition'],
+                                'desiredCount': deployment['desiredCount'], 'runningCount': running,
+                                'pendingCount': deployment['desiredCount'] - running,
+                                'rolloutState': 'COMPLETED' if healthy and deployment is primary else 'IN_PROGRESS',
+                                'createdAt': datetime.fromtimestamp(deployment['createdAt'], timezone.utc)})
+        description = dict((k, v) for k, v in service.items() if k not in ('deployments', 'drained_at'))
+        description['deployments'] = deployments
+        description['runningCount'] = sum(d['runningCount'] for d in deployments)
+        description['pendingCount'] = sum(d['pendingCount'] for d in deployments)
+        return description
+
+    def ecs_create_service(self, cluster, serviceName, taskDefinition, desiredCount=1, loadBalancers=(),
+                           **kwargs):
+        cluster = self._cluster(cluster)
+        key = (cluster, serviceName)
+        if key in self.services and self.services[key]['status'] != 'INACTIVE':
+            raise SimulatedError('InvalidParameterException', 'Creation of service was not idempotent.')
+        now = time.time()
+        task_definition = self._task_definition(taskDefinition)
+        service = {'serviceArn': self.arn('ecs', 'service/' + cluster + '/' + serviceName),
+                   'serviceName': serviceName, 'clusterArn': self.arn('ecs', 'cluster/' + cluster),
+                   'status': 'ACTIVE', 'desiredCount': desiredCount,
+                   'taskDefinition': task_definition['taskDefinitionArn'], 'loadBalancers': list(loadBalancers),
+                   'deployments': [self._new_deployment(task_definition['taskDefinitionArn'], desiredCount, now)],
+                   'createdAt': datetime.fromtimestamp(now, timezone.utc), 'events': []}
+        for key_name in ('placementStrategy', 'placementConstraints', 'deploymentConfiguration',
+                         'healthCheckGracePeriodSeconds', 'role'):
+            if key_name in kwargs:
+                service[key_name] = kwargs[key_name]
+        self.services[key] = service
+        return {'service': self._service(service, now)}
+
+    def _active_service(self, cluster, name):
+        cluster = self._cluster(cluster)
+        service = self.services.get((cluster, name.split('/')[-1]))
+        if service is None:
+            raise SimulatedError('ServiceNotFoundException', 'Service not found.')
+        if service['status'] != 'ACTIVE':
+            raise SimulatedError('ServiceNotActiveException', 'Service was not ACTIVE.')
+        return service
+
+    def ecs_update_service(self, service, cluster='default', taskDefinition=None, desiredCount=None, **kwargs):
+        current = self._active_service(cluster, service)
+        now = time.time()
+        if desiredCount is not None:
+            current['desiredCount'] = desiredCount
+        if taskDefinition is not None:
+            arn = self._task_definition(taskDefinition)['taskDefinitionArn']
+            if arn != current['taskDefinition']:
+                for deployment in current['deployments']:
+                    deployment['status'] = 'ACTIVE'
+                current['deployments'].insert(0, self._new_deployment(arn, current['desiredCount'], now))
+                current['taskDefinition'] = arn
+        if desiredCount is not None and current['deployments']:
+            current['deployments'][0]['desiredCount'] = desiredCount
+        current.update((k, v) for k, v in kwargs.items() if k in ('placementStrategy', 'placementConstraints',
+                                                                  'deploymentConfiguration',
+                                                                  'healthCheckGracePeriodSeconds'))
+        return {'service': self._service(current, now)}
+
+    def ecs_delete_service(self, service, cluster='default', force=False):
+        current = self._active_service(cluster, service)
+        if current['desiredCount'] and not force:
+            raise SimulatedError('InvalidParameterException',
+                                 'The service cannot be stopped while it is scaled above 0.')
+        current['status'] = 'DRAINING'
+        current['drained_at'] = time.time() + self.timings['service_drain']
+        return {'service': self._service(current, time.time())}
+
+    def ecs_describe_services(self, services, cluster='default', **kwargs):
+        cluster = self._cluster(cluster)
+        now = time.time()
+        found = []
+        failures = []
+        for name in services:
+            service = self.services.get((cluster, name.split('/')[-1]))
+            if service is None:
+                failures.append({'arn': self.arn('ecs', 'service/' + cluster + '/' + name), 'reason': 'MISSING'})
+            else:
+                found.append(self._service(service, now))
+        return {'services': found, 'failures': failures}
+
+    # Application Auto Scaling
+
+    def _scalable_target(self, ResourceId, ScalableDimension):
+        target = self.scalable_targets.get((ResourceId, ScalableDimension))
+        if target is None:
+            raise SimulatedError('ObjectNotFoundException', 'No scalable target registered for ' + ResourceId)
+        return target
+
+    def application_autoscaling_register_scalable_target(self, ServiceNamespace, ResourceId, ScalableDimension,
+                                                         MinCapacity=None, MaxCapacity=None, **kwargs):
+        _, cluster, name = ResourceId.split('/')
+        service = self.services.get((self._cluster(cluster), name))
+        if service is None or service['status'] != 'ACTIVE':
+            raise SimulatedError('ValidationException', 'ECS service doesn\'t exist: ' + ResourceId)
+        target = self.scalable_targets.setdefault((ResourceId, ScalableDimension), {
+            'ServiceNamespace': ServiceNamespace, 'ResourceId': ResourceId, 'ScalableDimension': ScalableDimension,
+            'RoleARN': self.arn('iam', 'role/AWSServiceRoleForApplicationAutoScaling_ECSService'),
+            'CreationTime': utc_now()})
+        if MinCapacity is not None:
+            target['MinCapacity'] = MinCapacity
+        if MaxCapacity is not None:
+            target['MaxCapacity'] = MaxCapacity
+        return {'ScalableTargetARN': self.arn('application-autoscaling', 'scalable-target/' + short_id())}
+
+    def application_autoscaling_describe_scalable_targets(self, ServiceNamespace, ResourceIds=None,
+                                                          ScalableDimension=None, **kwargs):
+        return {'ScalableTargets': [dict(target) for (resource_id, dimension), target in
+                                    self.scalable_targets.items()
+                                    if (not ResourceIds or resource_id in ResourceIds)
+                                    and (ScalableDimension is None or dimension == ScalableDimension)]}
+
+    def application_autoscaling_put_scaling_policy(self, PolicyName, ServiceNamespace, ResourceId, ScalableDimension,
+                                                   PolicyType='StepScaling',
+                                                   TargetTrackingScalingPolicyConfiguration=None, **kwargs):
+        self._scalable_target(ResourceId, ScalableDimension)
+        metric = (TargetTrackingScalingPolicyConfiguration or {}).get('PredefinedMetricSpecification', {})
+        if metric.get('PredefinedMetricType') == 'ALBRequestCountPerTarget':
+            target_group_arn = [arn for arn in self.target_groups
+                                if arn.endswith(':' + metric['ResourceLabel'].split('/', 3)[3])]
+            if not target_group_arn or not self._target_group_load_balancers(target_group_arn[0]):
+                raise SimulatedError('ValidationException', 'The target group is not associated with a load balancer')
+        arn = self.arn('autoscaling', 'scalingPolicy:' + short_id() + ':resource/' + ResourceId + ':policyName/' +
+                       PolicyName)
+        self.scaling_policies[(ResourceId, ScalableDimension, PolicyName)] = {
+            'PolicyARN': arn, 'PolicyName': PolicyName, 'ServiceNamespace': ServiceNamespace,
+            'ResourceId': ResourceId, 'ScalableDimension': ScalableDimension, 'PolicyType': PolicyType,
+            'TargetTrackingScalingPolicyConfiguration': TargetTrackingScalingPolicyConfiguration,
+            'CreationTime': utc_now()}
+        return {'PolicyARN': arn, 'Alarms': []}
+
+    def application_autoscaling_describe_scaling_policies(self, ServiceNamespace, PolicyNames=None, ResourceId=None,
+                                                          ScalableDimension=None, **kwargs):
+        return {'ScalingPolicies': [dict(policy) for policy in self.scaling_policies.values()
+                                    if (not PolicyNames or policy['PolicyName'] in PolicyNames)
+                                    and (ResourceId is None or policy['ResourceId'] == ResourceId)]}
+
+    def application_autoscaling_delete_scaling_policy(self, PolicyName, ServiceNamespace, ResourceId,
+                                                      ScalableDimension):
+        if self.scaling_policies.pop((ResourceId, ScalableDimension, PolicyName), None) is None:
+            raise SimulatedError('ObjectNotFoundException', 'No scaling policy found for ' + PolicyName)
+        return {}
+
+    def application_autoscaling_deregister_scalable_target(self, ServiceNamespace, ResourceId, ScalableDimension):
+        self._scalable_target(ResourceId, ScalableDimension)
+        del self.scalable_targets[(ResourceId, ScalableDimension)]
+        for key in [key for key in self.scaling_policies if key[:2] == (ResourceId, ScalableDimension)]:
+            del self.scaling_policies[key]
+        return {}
+
+    # CloudWatch Logs
+
+    def put_log_events(self, group, stream, messages, lag=0.0):
+        """Appends messages to a log stream the way a task's awslogs driver does, lag seconds after they happened."""
+        with self.lock:
+            events = self.log_events.setdefault(group, [])
+            timestamp = int((time.time() - lag) * 1000)
+            for message in messages:
+                events.append({'logStreamName': stream, 'timestamp': timestamp, 'message': message,
+                               'ingestionTime': int(time.time() * 1000),
+                               'eventId': '%020d' % next(self.log_event_ids)})
+            events.sort(key=lambda event: (event['timestamp'], event['eventId']))
+
+    def logs_filter_log_events(self, logGroupName, logStreamNamePrefix='', startTime=0, endTime=None, nextToken=None,
+                               limit=None, **kwargs):
+        if logGroupName not in self.log_events:
+            raise SimulatedError('ResourceNotFoundException', 'The specified log group does not exist.')
+        after = tuple(json.loads(nextToken)) if nextToken else None
+        matching = [event for event in self.log_events[logGroupName]
+                    if event['logStreamName'].startswith(logStreamNamePrefix) and event['timestamp'] >= startTime
+                    and (endTime is None or event['timestamp'] <= endTime)
+                    and (after is None or (event['timestamp'], event['eventId']) > after)]
+        page = matching[:min(limit or LOG_PAGE_SIZE, LOG_PAGE_SIZE)]
+        response = {'events': [dict(event) for event in page], 'searchedLogStreams': []}
+        if len(matching) > len(page):
+            response['nextToken'] = json.dumps([page[-1]['timestamp'], page[-1]['eventId']])
+        return response
+
+
+def load_script(directory, name):
+    """Imports a setup.py, and the ecs_common module it imports, as fresh modules, so every scenario starts with
+    empty caches. The ecs_common copy is kept as module.ecs_common.
+    """
+    spec = importlib.util.spec_from_file_location('ecs_common', os.path.join(ROOT, 'ecs_common.py'))
+    common = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(common)
+    spec = importlib.util.spec_from_file_location(name, os.path.join(directory, 'setup.py'))
+    module = importlib.util.module_from_spec(spec)
+    with mock.patch.dict(sys.modules, {'ecs_common': common}):
+        spec.loader.exec_module(module)
+    module.ecs_common = common
+    return module
+
+
+def connect(module, backend, regional=None):
+    """Routes every client the module and its ecs_common create to backend, or to the regional backend of the
+    client's region.
+    """
+    create_client = module.ecs_common.get_client
+    regional = regional or {}
+
+    def get_client(service_name, region=None):
+        client = create_client(service_name, region)
+        regional.get(client.meta.region_name, backend).attach(client)
+        return client
+
+    module.get_client = module.ecs_common.get_client = get_client
+
+
+def simulate_maven_builds(module, backend, regional=None):
+    """Replaces the Maven builds and docker copies of the microservices script with a sleep and a push to the
+    simulated ECR of the region they run in.
+    """
+    regional = regional or {}
+
+    def build_service(service, registry_host, image_tag, running, abort, lock):
+        started = time.time()
+        if abort.is_set():
+            return {'service': service, 'status': 'cancelled', 'returncode': None, 'seconds': 0.0, 'output': ''}
+        time.sleep(backend.timings['build'])
+        regional.get(module.ecs_common.current_region(), backend).push_image(service, image_tag)
+        return {'service': service, 'status': 'ok', 'returncode': 0, 'seconds': time.time() - started,
+                'output': ''}
+
+    def replicate_image(service, source_uri, target_uri, image_tag):
+        started = time.time()
+        time.sleep(backend.timings['build'] / 4)
+        regional.get(module.ecs_common.current_region(), backend).push_image(service, image_tag)
+        return {'service': service, 'status': 'ok', 'returncode': 0, 'seconds': time.time() - started,
+                'output': ''}
+
+    module.build_service = build_service
+    module.ecs_common.replicate_image = replicate_image
+
+
+def record_task_graphs(module):
+    """Keeps every TaskGraph the module builds, so their critical paths can be reported."""
+    graphs = []
+    task_graph = module.TaskGraph
+
+    class RecordedTaskGraph(task_graph):
+        def __init__(self, *args, **kwargs):
+            task_graph.__init__(self, *args, **kwargs)
+            graphs.append(self)
+
+    module.TaskGraph = RecordedTaskGraph
+    return graphs
+
+
+def span_critical_path(spans):
+    """Returns the chain of spans, ending with the last to finish, each preceded by the latest span that had
+    finished before it started."""
+    if not spans:
+        return []
+    path = [max(spans, key=lambda s: s['started'] + s['seconds'])]
+    while True:
+        before = [s for s in spans if s['started'] < path[-1]['started'] and
+                  s['started'] + s['seconds'] <= path[-1]['started'] + 0.001]
+        if not before:
+            break
+        path.append(max(before, key=lambda s: s['started'] + s['seconds']))
+    return list(reversed(path))
+
+
+def run_scenario(name, module, func, graphs=None):
+    """Runs func() and returns its wall-clock time, API calls and critical path from the module's telemetry.
+
+    The critical path comes from the TaskGraph func ran, when graphs records one, and otherwise from the chain of
+    spans that ended last.
+    """
+    graphs = graphs if graphs is not None else []
+    graphs_before = len(graphs)
+    calls_before = len(module.telemetry.calls)
+    spans_before = len(module.telemetry.spans)
+    logger.info('Scenario ' + name)
+    started = time.time()
+    error = None
+    try:
+        func()
+    except Exception as e:
+        logger.error(e)
+        error = str(e)
+    seconds = time.time() - started
+    calls = module.telemetry.calls[calls_before:]
+    spans = module.telemetry.spans[spans_before:]
+    if len(graphs) > graphs_before:
+        graph = graphs[-1]
+        critical_path = [{'name': step, 'seconds': graph.timings[step][1] - graph.timings[step][0]}
+                         for step in graph.critical_path()]
+    else:
+        critical_path = [{'name': s['name'], 'seconds': s['seconds']} for s in span_critical_path(spans)]
+    operations = {}
+    for call in calls:
+        key = call['service'] + '.' + call['operation']
+        operations[key] = operations.get(key, 0) + 1
+    return {'scenario': name, 'status': 'failed' if error else 'ok', 'error': error, 'seconds': seconds,
+            'api_calls': len(calls), 'api_seconds': sum(call['seconds'] for call in calls),
+            'rate_limit_wait': sum(call.get('wait', 0.0) for call in calls),
+            'operations': OrderedDict(sorted(operations.items(), key=lambda item: item[1], reverse=True)),
+            'critical_path': critical_path}
+
+
+def monolith_scenarios(backend, project_name, region, state_directory):
+    module = load_script(MONOLITH_DIRECTORY, 'petclinic_monolith')
+    connect(module, backend)
+    module.STATE_DIRECTORY = state_directory
+    service_list = {'spring-petclinic-rest': '8080'}
+
+    def build_image(service, registry_host):
+        time.sleep(backend.timings['build'])
+        backend.push_image(service, 'latest')
+        return 0
+
+    module.build_image = build_image
+    yield run_scenario('monolith-setup', module,
+                       lambda: module.setup(project_name=project_name, service_list=service_list, region=region))
+    yield run_scenario('monolith-cleanup', module,
+                       lambda: module.cleanup(project_name=project_name, service_list=service_list, region=region))
+
+
+def microservices_scenarios(backend, project_name, region, state_directory):
+    module = load_script(MICROSERVICES_DIRECTORY, 'petclinic_microservices')
+    connect(module, backend)
+    simulate_maven_builds(module, backend)
+    graphs = record_task_graphs(module)
+    module.STATE_DIRECTORY = state_directory
+    service_list = OrderedDict([('spring-petclinic-rest-system', '8080'), ('spring-petclinic-rest-owner', '8080'),
+                                ('spring-petclinic-rest-pet', '8080'), ('spring-petclinic-rest-vet', '8080'),
+                                ('spring-petclinic-rest-visit', '8080')])
+    yield run_scenario('micro-setup', module,
+                       lambda: module.setup(project_name=project_name, service_list=service_list, region=region),
+                       graphs)
+
+    def plan_unchanged():
+        changes = module.plan(project_name=project_name, service_list=service_list, region=region)
+        if changes:
+            raise Exception('Plan of the unchanged project is not empty: ' + module.format_changes(changes))
+
+    def apply_unchanged():
+        calls_before = len(module.telemetry.calls)
+        module.apply(project_name=project_name, service_list=service_list, region=region)
+        writes = [call['service'] + '.' + call['operation'] for call in module.telemetry.calls[calls_before:]
+                  if call['operation'] in ('RegisterTaskDefinition', 'UpdateService')]
+        if writes:
+            raise Exception('Apply of the unchanged project called ' + ', '.join(writes))
+
+    yield run_scenario('micro-plan', module, plan_unchanged)
+    yield run_scenario('micro-apply-unchanged', module, apply_unchanged, graphs)
+    yield run_scenario('micro-cleanup', module,
+                       lambda: module.cleanup(project_name=project_name, service_list=service_list, region=region))
+
+
+def multi_region_scenarios(backend, project_name, region, state_directory, other_regions=('eu-west-1',)):
+    """Deploys the microservices to region and other_regions at once; IAM is shared like the real global service."""
+    regions = [region] + list(other_regions)
+    regional = OrderedDict([(region, backend)])
+    for other_region in other_regions:
+        regional[other_region] = SimulatedAWS(region=other_region, latency=backend.latency,
+                                              latency_scale=backend.latency_scale, timings=backend.timings)
+        regional[other_region].roles = backend.roles
+        regional[other_region].lock = backend.lock
+    module = load_script(MICROSERVICES_DIRECTORY, 'petclinic_regions')
+    connect(module, backend, regional)
+    simulate_maven_builds(module, backend, regional)
+    module.STATE_DIRECTORY = state_directory
+    service_list = OrderedDict([('spring-petclinic-rest-system', '8080'), ('spring-petclinic-rest-owner', '8080'),
+                                ('spring-petclinic-rest-pet', '8080'), ('spring-petclinic-rest-vet', '8080'),
+                                ('spring-petclinic-rest-visit', '8080')])
+    deployments = [{'project_name': project_name, 'region': region, 'service_list': service_list}
+                   for region in regions]
+    for mode in ('setup', 'plan', 'cleanup'):
+        yield run_scenario('regions-' + mode, module, lambda: module.deploy_batch(mode, deployments))
+
+
+def batch_scenarios(backend, project_name, region, state_directory, projects=4):
+    """Deploys several projects to one region at once from a single process."""
+    module = load_script(MICROSERVICES_DIRECTORY, 'petclinic_batch')
+    connect(module, backend)
+    simulate_maven_builds(module, backend)
+    module.STATE_DIRECTORY = state_directory
+    service_list = OrderedDict([('spring-petclinic-rest-system', '8080'), ('spring-petclinic-rest-owner', '8080'),
+                                ('spring-petclinic-rest-pet', '8080'), ('spring-petclinic-rest-vet', '8080'),
+                                ('spring-petclinic-rest-visit', '8080')])
+    deployments = [{'project_name': project_name + '-' + str(index), 'region': region, 'service_list': service_list}
+                   for index in range(projects)]
+    for mode in ('setup', 'cleanup'):
+        yield run_scenario('batch-' + mode, module, lambda: module.deploy_batch(mode, deployments))
+
+
+def logs_scenarios(backend, project_name, region, state_directory, tasks_per_service=10, seconds=5.0):
+    """Tails five services with ten tasks each while they write, late, and checks the merged output.
+
+    The output has to hold every event once, in time order, although events reach the log group up to two seconds
+    after their timestamp.
+    """
+    module = load_script(MICROSERVICES_DIRECTORY, 'petclinic_logs')
+    connect(module, backend)
+    service_list = OrderedDict([('spring-petclinic-rest-system', '8080'), ('spring-petclinic-rest-owner', '8080'),
+                                ('spring-petclinic-rest-pet', '8080'), ('spring-petclinic-rest-vet', '8080'),
+                                ('spring-petclinic-rest-visit', '8080')])
+    group = 'ECSLogGroup-' + project_name
+    streams = [project_name + '/' + service + '/' + uuid.uuid4().hex for service in service_list
+               for _ in range(tasks_per_service)]
+    # A backlog from before the tail starts, read through several pages
+    for stream in streams:
+        backend.put_log_events(group, stream, ['started %d' % index for index in range(50)], lag=30)
+    stop = threading.Event()
+
+    def write_logs():
+        index = 0
+        while not stop.is_set():
+            for stream in streams:
+                backend.put_log_events(group, stream, ['request %d' % index], lag=random.uniform(0, 2))
+            index += 1
+            stop.wait(0.1)
+
+    lines = []
+
+    def tail():
+        writer = threading.Thread(target=write_logs)
+        writer.start()
+        try:
+            module.tail_logs(project_name, service_list, region, since=60, duration=seconds, output=lines.append)
+        finally:
+            stop.set()
+            writer.join()
+        if len(set(lines)) != len(lines):
+            raise Exception('%d log events written more than once' % (len(lines) - len(set(lines))))
+        if lines != sorted(lines, key=lambda line: line[:12]):
+            raise Exception('Log events are out of order')
+        if len([line for line in lines if ' started ' in line]) != len(streams) * 50:
+            raise Exception('Log events from before the tail are missing')
+
+    yield run_scenario('logs-tail', module, tail)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers GET requests over keep-alive connections after the delay of their path, counting them per path."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests[self.path] = server.requests.get(self.path, 0) + 1
+        time.sleep(server.delays.get(self.path, 0.0))
+        status = 500 if self.path in server.failing else 200
+        body = b'{}'
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server(delays, failing):
+    """Starts a localhost HTTP server on a free port and returns it; delays are seconds by path."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.requests = {}
+    server.delays = delays
+    server.failing = failing
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def loadtest_scenarios(backend, project_name, region, state_directory, seconds=3.0, concurrency=8, rate=40):
+    """Load tests a localhost stub with one failing path and checks the counts, errors and latencies reported.
+
+    Every request the stub answered has to be counted once under its path, the failing path has to count as all
+    errors, and the latency percentiles have to be ordered and no lower than the stub's delay. A second, rate capped
+    run must stay within the rate.
+    """
+    module = load_script(MICROSERVICES_DIRECTORY, 'petclinic_loadtest')
+    connect(module, backend)
+    delays = OrderedDict([('/', 0.005), ('/api/owner/', 0.01), ('/api/pet/', 0.02), ('/api/error/', 0.005)])
+    server = start_stub_server(delays, {'/api/error/'})
+    endpoint = 'http://127.0.0.1:%d' % server.server_address[1]
+    output = os.path.join(state_directory, project_name + '-loadtest.json')
+    if not os.path.exists(state_directory):
+        os.makedirs(state_directory)
+
+    def check(summary, requests):
+        for path, delay in delays.items():
+            result = summary[path]
+            if result['requests'] != requests.get(path, 0):
+                raise Exception('%s: %d requests reported, the server answered %d' % (
+                    path, result['requests'], requests.get(path, 0)))
+            if not result['requests']:
+                raise Exception(path + ' was never requested')
+            expected_errors = result['requests'] if path in server.failing else 0
+            if result['errors'] != expected_errors:
+                raise Exception('%s: %d errors reported, expected %d' % (path, result['errors'], expected_errors))
+            if not delay * 1000 <= result['p50_ms'] <= result['p95_ms'] <= result['p99_ms']:
+                raise Exception('%s: latency percentiles %.1f/%.1f/%.1f ms are out of order or below the %.0f ms '
+                                'delay' % (path, result['p50_ms'], result['p95_ms'], result['p99_ms'], delay * 1000))
+        if summary['total']['requests'] != sum(requests.values()):
+            raise Exception('The total does not add up to the requests per path')
+
+    def load():
+        summary = module.load_test(endpoint, list(delays), duration=seconds, concurrency=concurrency, timeout=5,
+                                   output=output)
+        check(summary, dict(server.requests))
+        with open(output) as f:
+            if json.load(f)['paths']['total']['requests'] != summary['total']['requests']:
+                raise Exception('The results written to ' + output + ' differ from the summary')
+
+    def load_rate_capped():
+        with server.lock:
+            server.requests.clear()
+        summary = module.load_test(endpoint, list(delays), duration=seconds, concurrency=concurrency, rate=rate,
+                                   timeout=5)
+        check(summary, dict(server.requests))
+        if summary['total']['requests'] > rate * seconds + 1:
+            raise Exception('%d requests sent at a cap of %d req/s for %.0fs' % (summary['total']['requests'],
+                                                                                 rate, seconds))
+
+    try:
+        yield run_scenario('loadtest', module, load)
+        yield run_scenario('loadtest-rate', module, load_rate_capped)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+SCENARIO_GROUPS = OrderedDict([('monolith', (MONOLITH_DIRECTORY, monolith_scenarios)),
+                               ('micro', (MICROSERVICES_DIRECTORY, microservices_scenarios)),
+                               ('regions', (MICROSERVICES_DIRECTORY, multi_region_scenarios)),
+                               ('batch', (MICROSERVICES_DIRECTORY, batch_scenarios)),
+                               ('logs', (MICROSERVICES_DIRECTORY, logs_scenarios)),
+                               ('loadtest', (MICROSERVICES_DIRECTORY, loadtest_scenarios))])
+
+
+def run_benchmarks(groups, region='us-west-2', latency_scale=1.0, timings=None):
+    """Runs each scenario group against its own simulated backend and returns one result per scenario."""
+    results = []
+    home = tempfile.mkdtemp(prefix='benchmark-home-')
+    environment = {'HOME': home, 'AWS_ACCESS_KEY_ID': 'simulated', 'AWS_SECRET_ACCESS_KEY': 'simulated',
+                   'AWS_DEFAULT_REGION': region, 'AWS_EC2_METADATA_DISABLED': 'true',
+                   'AWS_CONFIG_FILE': os.path.join(home, 'config'),
+                   'AWS_SHARED_CREDENTIALS_FILE': os.path.join(home, 'credentials')}
+    working_directory = os.getcwd()
+    with mock.patch.dict(os.environ, environment):
+        for group in groups:
+            directory, scenarios = SCENARIO_GROUPS[group]
+            backend = SimulatedAWS(region=region, latency_scale=latency_scale, timings=timings)
+            os.chdir(directory)
+            try:
+                for result in scenarios(backend, 'benchmark-' + group, region, os.path.join(home, 'state')):
+                    logger.info('Scenario ' + result['scenario'] + ' ' + result['status'] +
+                                ' in %.1fs' % result['seconds'])
+                    results.append(result)
+            finally:
+                os.chdir(working_directory)
+    shutil.rmtree(home, ignore_errors=True)
+    return results
+
+
+def format_results(results):
+    lines = ['%-24s %-7s %10s %10s %10s %10s' % ('Scenario', 'Status', 'Seconds', 'API calls', 'API s',
+                                                 'Wait s')]
+    for result in results:
+        lines.append('%-24s %-7s %10.1f %10d %10.1f %10.1f' % (
+            result['scenario'], result['status'], result['seconds'], result['api_calls'], result['api_seconds'],
+            result['rate_limit_wait']))
+    for result in results:
+        lines.append('')
+        lines.append(result['scenario'] + ' critical path: ' +
+                     (' -> '.join('%s (%.1fs)' % (step['name'], step['seconds']) for step in result['critical_path'])
+                      or 'none'))
+        lines.append(result['scenario'] + ' top calls: ' +
+                     ', '.join('%s x%d' % item for item in list(result['operations'].items())[:5]))
+        if result['error']:
+            lines.append(result['scenario'] + ' error: ' + result['error'])
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the setup scripts against a simulated AWS backend.")
+    parser.add_argument('-g', '--groups', nargs='+', choices=list(SCENARIO_GROUPS), default=list(SCENARIO_GROUPS),
+                        help="Scenario groups to run. Default all")
+    parser.add_argument('--latency_scale', type=float, default=1.0,
+                        help="Multiplier applied to every simulated API latency. Default 1.0")
+    parser.add_argument('--latency', action='append', default=[], metavar='SERVICE.Operation=SECONDS',
+                        help="Latency of one operation, for example ecs.CreateService=1.5. Repeatable")
+    for key, value in DEFAULT_TIMINGS.items():
+        parser.add_argument('--' + key + '_seconds', type=float, default=value,
+                            help="Simulated %s time in seconds. Default %s" % (key.replace('_', ' '), value))
+    parser.add_argument('-o', '--output', default='benchmark-results.json',
+                        help="JSON file the results are written to. Default benchmark-results.json")
+    parser.add_argument('-v', '--verbose', action='store_true', help="Show the scripts' own log output")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        for name in ('petclinic_monolith', 'petclinic_microservices', 'petclinic_regions', 'petclinic_batch',
+                     'petclinic_logs', 'petclinic_loadtest', 'ecs_common', 'botocore', 'boto3'):
+            logging.getLogger(name).setLevel(logging.WARNING)
+    for override in args.latency:
+        operation, _, seconds = override.partition('=')
+        OPERATION_LATENCY[operation] = float(seconds)
+    timings = dict((key, getattr(args, key + '_seconds')) for key in DEFAULT_TIMINGS)
+
+    results = run_benchmarks(args.groups, latency_scale=args.latency_scale, timings=timings)
+    logger.info('Benchmark results:\n' + format_results(results))
+    with open(args.output, 'w') as f:
+        json.dump({'latency_scale': args.latency_scale, 'timings': timings, 'scenarios': results}, f, indent=2)
+    logger.info('Results written to ' + args.output)
+    if any(result['status'] != 'ok' for result in results):
+        raise Exception('Some scenarios failed')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1620 @@
+"""AWS clients, rate limiting, telemetry and the ECS building blocks shared by the setup scripts.
+
+Both setup.py scripts import from here, so the client cache, stack waiter, IAM roles, ECR images, service profiles,
+load balancers, health profiles and auto scaling behave the same for the monolith and the microservices.
+"""
+import fcntl
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from os.path import expanduser
+from random import uniform
+
+import boto3
+import botocore
+from botocore.config import Config
+
+logger = logging.getLogger(__name__)
+
+# Tag put on project resources that cleanup looks up by tag rather than by name
+PROJECT_TAG_KEY = 'Project'
+# Highest priority a listener rule can have
+MAX_RULE_PRIORITY = 50000
+# Per service settings file, in the service's directory, that overrides the script's default service profile
+SERVICE_CONFIG_FILE = 'ecs-service-config.json'
+# Container settings that come from the service profile and are left out of the definition when unset
+CONTAINER_PROFILE_KEYS = ('cpu', 'memory', 'memoryReservation', 'ulimits')
+# Seconds between scale outs and between scale ins of the target tracking policies
+SCALE_OUT_COOLDOWN = 60
+SCALE_IN_COOLDOWN = 300
+SCALABLE_DIMENSION = 'ecs:service:DesiredCount'
+# Target group health checks and attributes, and the ECS health check grace period, of each healthProfile. The grace
+# period covers Spring Boot's startup so the health checks can stay frequent: a task gets traffic after
+# HealthyThresholdCount checks once the application answers instead of after a fixed long interval
+HEALTH_PROFILES = {
+    'fast': {'HealthCheckIntervalSeconds': 10, 'HealthCheckTimeoutSeconds': 5, 'HealthyThresholdCount': 2,
+             'UnhealthyThresholdCount': 3, 'deregistration_delay.timeout_seconds': 30,
+             'slow_start.duration_seconds': 30, 'healthCheckGracePeriodSeconds': 120},
+    'default': {'HealthCheckIntervalSeconds': 15, 'HealthCheckTimeoutSeconds': 5, 'HealthyThresholdCount': 3,
+                'UnhealthyThresholdCount': 3, 'deregistration_delay.timeout_seconds': 60,
+                'slow_start.duration_seconds': 0, 'healthCheckGracePeriodSeconds': 180},
+    'conservative': {'HealthCheckIntervalSeconds': 60, 'HealthCheckTimeoutSeconds': 30, 'HealthyThresholdCount': 5,
+                     'UnhealthyThresholdCount': 3, 'deregistration_delay.timeout_seconds': 300,
+                     'slow_start.duration_seconds': 0, 'healthCheckGracePeriodSeconds': 300},
+}
+HEALTH_CHECK_KEYS = ('HealthCheckIntervalSeconds', 'HealthCheckTimeoutSeconds', 'HealthyThresholdCount',
+                     'UnhealthyThresholdCount')
+
+CLIENT_SETTINGS = {
+    'max_pool_connections': 50,
+    'connect_timeout': 10,
+    'read_timeout': 60,
+    # botocore's adaptive mode would slow throttled calls down a second time on top of ApiRateLimiter
+    'retry_mode': 'standard',
+    'max_attempts': 10,
+    # AWS API calls per second across every client of the run, None for no limit
+    'api_rate': None,
+    'api_burst': None,
+    # Steady AWS API calls per second in each region, by 'service.Operation', then 'service', then '*'
+    'rate_limits': {'*': 20, 'iam': 5,
+                    'ecs.CreateService': 5, 'ecs.UpdateService': 5, 'ecs.DeleteService': 5,
+                    'ecs.RegisterTaskDefinition': 5, 'elbv2.CreateTargetGroup': 5, 'elbv2.DeleteTargetGroup': 5,
+                    'elbv2.CreateRule': 5, 'elbv2.ModifyRule': 5, 'elbv2.SetRulePriorities': 5,
+                    # CloudWatch Logs allows 5 FilterLogEvents calls per second in each region
+                    'logs.FilterLogEvents': 3},
+}
+_sessions = {}
+_clients = {}
+_clients_lock = threading.Lock()
+_region = threading.local()
+
+
+def current_region():
+    """Returns the region of the region_scope() the calling thread runs in, None for boto3's default region."""
+    return getattr(_region, 'name', None)
+
+
+@contextmanager
+def region_scope(region):
+    """Makes get_client() and the per region caches use region in the calling thread.
+
+    Threads started through RegionExecutor inherit the region of the thread that submitted their work, so every
+    region of a multi-region run gets its own clients without touching AWS_DEFAULT_REGION.
+    """
+    previous = getattr(_region, 'name', None)
+    _region.name = region
+    try:
+        yield region
+    finally:
+        _region.name = previous
+
+
+class RegionExecutor(ThreadPoolExecutor):
+    """ThreadPoolExecutor whose work runs in the region_scope() of the thread that submitted it."""
+
+    def submit(self, fn, *args, **kwargs):
+        region = getattr(_region, 'name', None)
+
+        def run():
+            with region_scope(region):
+                return fn(*args, **kwargs)
+        return ThreadPoolExecutor.submit(self, run)
+
+
+class TokenBucket(object):
+    """Hands out rate tokens per second, and up to burst at once, to every thread that shares it."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(1.0, self.rate))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Takes a token, sleeping until it is due, and returns the seconds waited.
+
+        Tokens are reserved in order, so callers are served first come first served however many are waiting.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class AdaptiveTokenBucket(TokenBucket):
+    """TokenBucket that cuts its rate by decrease on throttling errors and, while calls succeed, climbs back to
+    max_rate over recovery_seconds.
+    """
+
+    def __init__(self, rate, burst=None, min_rate=0.5, decrease=0.7, recovery_seconds=10):
+        TokenBucket.__init__(self, rate, burst)
+        self.max_rate = self.rate
+        self.min_rate = min(min_rate, self.rate)
+        self.decrease = decrease
+        self.recovery_seconds = recovery_seconds
+        self.decreased = self.increased = time.monotonic() - 1.0
+
+    def throttled(self):
+        with self.lock:
+            now = time.monotonic()
+            # Calls that were already in flight report the same overload, so the rate is cut once for all of them
+            if now - self.decreased >= 1.0:
+                self.decreased = self.increased = now
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+
+    def succeeded(self):
+        with self.lock:
+            now = time.monotonic()
+            self.rate = min(self.max_rate,
+                            self.rate + (now - self.increased) * self.max_rate / self.recovery_seconds)
+            self.increased = now
+
+
+class ApiRateLimiter(object):
+    """Client-side rate limits in front of every client from get_client().
+
+    Each region and operation gets an AdaptiveTokenBucket at the rate CLIENT_SETTINGS['rate_limits'] gives it, and
+    every call also takes a token from the run's api_rate budget when one is set. A call waits in before-call until
+    it has its tokens, and the retry of a throttled call takes new ones in request-created, once botocore's own
+    backoff is over. metrics() reports that queue wait per operation along with the throttling errors seen and the
+    rate each bucket adapted to.
+    """
+
+    def __init__(self, limits=None, api_rate=None, api_burst=None):
+        self.lock = threading.Lock()
+        self.configure(limits, api_rate, api_burst)
+
+    def configure(self, limits=None, api_rate=None, api_burst=None):
+        with self.lock:
+            self.limits = dict(limits or {})
+            self.budget = TokenBucket(api_rate, api_burst) if api_rate else None
+            self.buckets = {}
+            self.stats = OrderedDict()
+
+    def attach(self, client):
+        region = client.meta.region_name
+        events = client.meta.events
+        events.register('before-call', lambda model, context, **kwargs: self._before_call(region, model, context))
+        events.register('needs-retry', lambda response, operation, request_dict, **kwargs: self._needs_retry(
+            region, response, operation, request_dict['context']))
+        events.register('request-created', lambda request, **kwargs: self._request_created(region, request))
+        events.register('after-call', lambda model, parsed, **kwargs: self._after_call(region, model, parsed))
+
+    def bucket(self, region, model):
+        key = (region, model.service_model.service_name + '.' + model.name)
+        with self.lock:
+            if key not in self.stats:
+                rate = self.limits.get(key[1], self.limits.get(model.service_model.service_name,
+                                                               self.limits.get('*')))
+                self.buckets[key] = AdaptiveTokenBucket(rate) if rate else None
+                self.stats[key] = {'region': region, 'operation': key[1], 'calls': 0, 'throttles': 0,
+                                   'wait_seconds': 0.0, 'max_wait': 0.0}
+            return self.buckets[key], self.stats[key]
+
+    def acquire(self, region, model, calls=1):
+        """Waits for the tokens of one attempt at model and returns the seconds waited."""
+        bucket, stats = self.bucket(region, model)
+        budget = self.budget
+        wait = bucket.acquire() if bucket else 0.0
+        if budget:
+            wait += budget.acquire()
+        with self.lock:
+            stats['calls'] += calls
+            stats['wait_seconds'] += wait
+            stats['max_wait'] = max(stats['max_wait'], wait)
+        return wait
+
+    def _before_call(self, region, model, context):
+        context['rate_limit_wait'] = self.acquire(region, model)
+
+    def _needs_retry(self, region, response, operation, context):
+        if response is not None and response[1].get('Error', {}).get('Code') in THROTTLING_ERROR_CODES:
+            bucket, stats = self.bucket(region, operation)
+            if bucket:
+                bucket.throttled()
+            with self.lock:
+                stats['throttles'] += 1
+            # The retry is one more attempt against the same limit, it takes its token when botocore creates it
+            context['rate_limit_retry'] = operation
+
+    def _request_created(self, region, request):
+        operation = getattr(request, 'context', {}).pop('rate_limit_retry', None)
+        if operation is not None:
+            self.acquire(region, operation, calls=0)
+
+    def _after_call(self, region, model, parsed):
+        if 'Error' not in parsed:
+            bucket, stats = self.bucket(region, model)
+            if bucket:
+                bucket.succeeded()
+
+    def metrics(self):
+        """Returns the queue wait and throttling of every operation called, the longest total wait first."""
+        with self.lock:
+            metrics = [dict(stats, rate=self.buckets[key].rate if self.buckets[key] else None,
+                            max_rate=self.buckets[key].max_rate if self.buckets[key] else None)
+                       for key, stats in self.stats.items()]
+        return sorted(metrics, key=lambda m: m['wait_seconds'], reverse=True)
+
+    def format_metrics(self):
+        def rate(value):
+            return '-' if value is None else '%.1f' % value
+        lines = ['%-16s %-40s %6s %9s %10s %8s %7s %7s' % ('Region', 'Operation', 'Calls', 'Throttles', 'Wait s',
+                                                          'Max s', 'Rate', 'Limit')]
+        for m in self.metrics():
+            lines.append('%-16s %-40s %6d %9d %10.2f %8.2f %7s %7s' % (
+                m['region'], m['operation'], m['calls'], m['throttles'], m['wait_seconds'], m['max_wait'],
+                rate(m['rate']), rate(m['max_rate'])))
+        return '\n'.join(lines)
+
+
+def configure_clients(**settings):
+    """Updates CLIENT_SETTINGS; clients created before the call are discarded."""
+    unknown = set(settings) - set(CLIENT_SETTINGS)
+    if unknown:
+        raise Exception('Unknown client settings: ' + ', '.join(sorted(unknown)))
+    with _clients_lock:
+        CLIENT_SETTINGS.update(settings)
+        _clients.clear()
+        api_limiter.configure(CLIENT_SETTINGS['rate_limits'], CLIENT_SETTINGS['api_rate'],
+                              CLIENT_SETTINGS['api_burst'])
+
+
+def get_client(service_name, region=None):
+    """Returns the client shared by the whole run for a service, created once per region.
+
+    Clients are thread safe, so reusing them keeps credentials, endpoints and connection pools resolved once.
+    """
+    region = region or current_region()
+    key = (region, service_name)
+    with _clients_lock:
+        if key not in _clients:
+            if region not in _sessions:
+                _sessions[region] = boto3.session.Session(region_name=region)
+            config = Config(
+                max_pool_connections=CLIENT_SETTINGS['max_pool_connections'],
+                connect_timeout=CLIENT_SETTINGS['connect_timeout'],
+                read_timeout=CLIENT_SETTINGS['read_timeout'],
+                retries={'mode': CLIENT_SETTINGS['retry_mode'], 'max_attempts': CLIENT_SETTINGS['max_attempts']}
+            )
+            _clients[key] = _sessions[region].client(service_name, config=config)
+            # Attached before telemetry, so time spent waiting for a token is not counted as API time
+            api_limiter.attach(_clients[key])
+            telemetry.attach(_clients[key])
+        return _clients[key]
+
+
+THROTTLING_ERROR_CODES = ('Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottledException',
+                          'TooManyRequestsException', 'RequestLimitExceeded', 'SlowDown', 'Throttled',
+                          'ProvisionedThroughputExceededException')
+
+
+class Telemetry(object):
+    """Records every AWS API call made through get_client() and the named spans of the run.
+
+    Calls are timed from botocore's before-call to after-call events, so retries and backoff are included in their
+    latency; throttling errors are counted from needs-retry, and the time a call queued in api_limiter is kept as
+    its wait. summary() totals them per operation and chrome_trace() lays calls and spans out on a timeline for
+    chrome://tracing or Perfetto.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.calls = []
+        self.spans = []
+
+    def attach(self, client):
+        events = client.meta.events
+        events.register('before-call', self._before_call)
+        events.register('needs-retry', self._needs_retry)
+        events.register('after-call', self._after_call)
+        events.register('after-call-error', self._after_call_error)
+
+    def _before_call(self, model, context, **kwargs):
+        context['telemetry'] = {'service': model.service_model.service_name, 'operation': model.name,
+                                'started': time.time(), 'throttles': 0,
+                                'wait': context.get('rate_limit_wait', 0.0)}
+
+    def _needs_retry(self, response, request_dict, **kwargs):
+        call = request_dict.get('context', {}).get('telemetry')
+        if call is not None and response is not None:
+            error = response[1].get('Error', {})
+            if error.get('Code') in THROTTLING_ERROR_CODES:
+                call['throttles'] += 1
+
+    def _after_call(self, http_response, parsed, model, context, **kwargs):
+        size = http_response.headers.get('content-length')
+        if size is None and not model.has_streaming_output:
+            size = len(http_response.content or b'')
+        self._record(context, parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0),
+                     parsed.get('Error', {}).get('Code'), int(size or 0))
+
+    def _after_call_error(self, context, exception, **kwargs):
+        self._record(context, 0, type(exception).__name__, 0)
+
+    def _record(self, context, retries, error, size):
+        call = context.pop('telemetry', None)
+        if call is None:
+            return
+        with self.lock:
+            self.calls.append({'service': call['service'], 'operation': call['operation'],
+                               'started': call['started'], 'seconds': time.time() - call['started'],
+                               'retries': retries, 'throttles': call['throttles'], 'error': error,
+                               'bytes': size, 'wait': call['wait'], 'thread': threading.current_thread().name})
+
+    @contextmanager
+    def span(self, name):
+        """Records how long the with block named name takes."""
+        started = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.spans.append({'name': name, 'started': started, 'seconds': time.time() - started,
+                                   'thread': threading.current_thread().name})
+
+    def summary(self):
+        """Returns per-operation totals, the operations that took longest in total first."""
+        operations = {}
+        with self.lock:
+            calls = list(self.calls)
+        for call in calls:
+            key = call['service'] + '.' + call['operation']
+            operation = operations.setdefault(key, {'operation': key, 'calls': 0, 'errors': 0, 'retries': 0,
+                                                    'throttles': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                                                    'bytes': 0, 'wait_seconds': 0.0})
+            operation['calls'] += 1
+            operation['errors'] += 1 if call['error'] else 0
+            operation['retries'] += call['retries']
+            operation['throttles'] += call['throttles']
+            operation['seconds'] += call['seconds']
+            operation['max_seconds'] = max(operation['max_seconds'], call['seconds'])
+            operation['bytes'] += call['bytes']
+            operation['wait_seconds'] += call['wait']
+        return sorted(operations.values(), key=lambda o: o['seconds'], reverse=True)
+
+    def format_summary(self):
+        summary = self.summary()
+        lines = ['%-50s %6s %6s %7s %9s %10s %8s %10s %8s' % ('Operation', 'Calls', 'Errors', 'Retries',
+                                                               'Throttles', 'Seconds', 'Max s', 'Bytes', 'Wait s')]
+        for o in summary:
+            lines.append('%-50s %6d %6d %7d %9d %10.2f %8.2f %10d %8.2f' % (
+                o['operation'], o['calls'], o['errors'], o['retries'], o['throttles'], o['seconds'],
+                o['max_seconds'], o['bytes'], o['wait_seconds']))
+        lines.append('%-50s %6d %6d %7d %9d %10.2f %8s %10d %8.2f' % (
+            'total (run %.1fs)' % (time.time() - self.started), sum(o['calls'] for o in summary),
+            sum(o['errors'] for o in summary), sum(o['retries'] for o in summary),
+            sum(o['throttles'] for o in summary), sum(o['seconds'] for o in summary), '',
+            sum(o['bytes'] for o in summary), sum(o['wait_seconds'] for o in summary)))
+        return '\n'.join(lines)
+
+    def chrome_trace(self):
+        """Returns the run in Chrome trace event format, one row per thread."""
+        with self.lock:
+            calls = list(self.calls)
+            spans = list(self.spans)
+        threads = {}
+        events = []
+        for category, name, item, args in ([('phase', s['name'], s, {}) for s in spans] +
+                                           [('api', c['service'] + '.' + c['operation'], c,
+                                             dict((key, c[key])
+                                                  for key in ('retries', 'throttles', 'error', 'bytes', 'wait')))
+                                            for c in calls]):
+            events.append({'name': name, 'cat': category, 'ph': 'X', 'pid': os.getpid(),
+                           'tid': threads.setdefault(item['thread'], len(threads) + 1),
+                           'ts': int((item['started'] - self.started) * 1e6), 'dur': int(item['seconds'] * 1e6),
+                           'args': args})
+        for thread, tid in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid,
+                           'args': {'name': thread}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms',
+                'otherData': {'operations': self.summary()}}
+
+    def finish(self, trace_filename=None):
+        """Logs the summary table and writes the Chrome trace to trace_filename when given."""
+        logger.info('AWS API calls:\n' + self.format_summary())
+        if trace_filename:
+            with open(trace_filename, 'w') as f:
+                json.dump(self.chrome_trace(), f)
+            logger.info('Trace written to ' + trace_filename + ', open it in chrome://tracing or ui.perfetto.dev')
+
+
+telemetry = Telemetry()
+api_limiter = ApiRateLimiter(CLIENT_SETTINGS['rate_limits'])
+
+
+def is_stack_in_progress(status):
+    return status.endswith('_IN_PROGRESS')
+
+
+def read_new_stack_events(cf_client, stack_id, last_event_id):
+    """Returns the stack events newer than last_event_id, oldest first.
+
+    Events are listed newest first, so paging stops at the last event already seen. Without a last event id
+    only the first page is read.
+    """
+    events = []
+    kwargs = {'StackName': stack_id}
+    while True:
+        page = cf_client.describe_stack_events(**kwargs)
+        for event in page['StackEvents']:
+            if event['EventId'] == last_event_id:
+                return list(reversed(events))
+            events.append(event)
+        if last_event_id is None or not page.get('NextToken'):
+            return list(reversed(events))
+        kwargs['NextToken'] = page['NextToken']
+
+
+def wait_for_stack(stack_name, min_delay=2, max_delay=30, timeout=7200):
+    """Waits until a stack leaves its *_IN_PROGRESS state and returns its final description.
+
+    Polls describe_stack_events with jittered exponential backoff, logging only the events that are new since
+    the previous poll and the resource that has been in progress the longest. The delay drops back to min_delay
+    whenever the stack makes progress. Returns None when the stack does not exist (anymore).
+    """
+    cf_client = get_client('cloudformation')
+    try:
+        stack = cf_client.describe_stacks(StackName=stack_name)['Stacks'][0]
+    except botocore.exceptions.ClientError as e:
+        if 'does not exist' in str(e):
+            return None
+        raise
+    if not is_stack_in_progress(stack['StackStatus']):
+        return stack
+
+    stack_id = stack['StackId']
+    resources = {}
+    finished = False
+    # Seed resource state from the latest page of events without logging old history
+    events = read_new_stack_events(cf_client, stack_id, None)
+    last_event_id = events[-1]['EventId'] if events else None
+    for event in events:
+        resources[event['LogicalResourceId']] = event
+        if event.get('PhysicalResourceId') == stack_id:
+            finished = not is_stack_in_progress(event['ResourceStatus'])
+
+    deadline = time.time() + timeout
+    delay = min_delay
+    polls = 0
+    failures = []
+    while not finished:
+        if time.time() > deadline:
+            raise Exception('Timed out waiting for stack ' + stack_name)
+        time.sleep(uniform(delay / 2.0, delay))
+        polls += 1
+        events = read_new_stack_events(cf_client, stack_id, last_event_id)
+        for event in events:
+            last_event_id = event['EventId']
+            resources[event['LogicalResourceId']] = event
+            logger.info('Stack event: ' + event['LogicalResourceId'] + ' (' + event['ResourceType'] + ') ' +
+                        event['ResourceStatus'] + (' - ' + event['ResourceStatusReason']
+                                                   if event.get('ResourceStatusReason') else ''))
+            if event.get('PhysicalResourceId') == stack_id:
+                finished = not is_stack_in_progress(event['ResourceStatus'])
+            elif event['ResourceStatus'].endswith('_FAILED'):
+                failures.append(event)
+        if finished:
+            break
+
+        if events:
+            delay = min_delay
+        else:
+            delay = min(delay * 2, max_delay)
+        in_progress = [event for event in resources.values()
+                       if event.get('PhysicalResourceId') != stack_id and is_stack_in_progress(event['ResourceStatus'])]
+        if in_progress:
+            holdup = min(in_progress, key=lambda event: event['Timestamp'])
+            waited = datetime.now(holdup['Timestamp'].tzinfo) - holdup['Timestamp']
+            logger.info('Waiting on ' + holdup['LogicalResourceId'] + ' (' + holdup['ResourceType'] + ') ' +
+                        holdup['ResourceStatus'] + ' for %ds' % waited.total_seconds())
+
+    stack = cf_client.describe_stacks(StackName=stack_id)['Stacks'][0]
+    logger.info('Stack ' + stack_name + ' is ' + stack['StackStatus'] + ' after %d polls' % polls)
+    for event in failures:
+        logger.error('Failed resource: ' + event['LogicalResourceId'] + ' (' + event['ResourceType'] + ') ' +
+                     event.get('ResourceStatusReason', ''))
+    return stack
+
+
+class StackResources(object):
+    """Resources and outputs of a CloudFormation stack, indexed by logical id, resource type and output key."""
+
+    def __init__(self, stack, resources):
+        self.stack_name = stack['StackName']
+        self.stack_id = stack['StackId']
+        self.status = stack['StackStatus']
+        self.by_logical_id = OrderedDict()
+        self.by_type = {}
+        for resource in resources:
+            self.by_logical_id[resource['LogicalResourceId']] = resource
+            self.by_type.setdefault(resource['ResourceType'], []).append(resource)
+        self.outputs = dict((output['OutputKey'], output['OutputValue']) for output in stack.get('Outputs', []))
+
+    @classmethod
+    def fetch(cls, stack_name, stack=None):
+        """Reads every resource with list_stack_resources; stack is the describe_stacks entry if already known."""
+        cf_client = get_client('cloudformation')
+        if stack is None:
+            stack = cf_client.describe_stacks(StackName=stack_name)['Stacks'][0]
+        resources = []
+        for page in cf_client.get_paginator('list_stack_resources').paginate(StackName=stack['StackId']):
+            resources.extend(page['StackResourceSummaries'])
+        return cls(stack, resources)
+
+    def physical_id(self, logical_id):
+        return self.by_logical_id[logical_id]['PhysicalResourceId']
+
+    def physical_ids(self, resource_type):
+        return [resource['PhysicalResourceId'] for resource in self.by_type.get(resource_type, [])]
+
+    def output(self, key):
+        return self.outputs[key]
+
+
+_stack_resources = {}
+_stack_resources_lock = threading.Lock()
+
+
+def cache_stack_resources(stack_name, stack_resources):
+    """Stores StackResources read elsewhere, such as from deployment state, for get_stack_resources()."""
+    with _stack_resources_lock:
+        _stack_resources[(current_region(), stack_name)] = stack_resources
+
+
+def get_stack_resources(stack_name, stack=None, refresh=False):
+    """Returns the StackResources of a stack in the current region, fetched once per run unless refresh is set."""
+    key = (current_region(), stack_name)
+    with _stack_resources_lock:
+        if refresh or key not in _stack_resources:
+            _stack_resources[key] = StackResources.fetch(stack_name, stack)
+        return _stack_resources[key]
+
+
+def delete_ecs_cluster(stack_name):
+    cf_client = get_client('cloudformation')
+    ec2_client = get_client('ec2')
+
+    try:
+        response = cf_client.delete_stack(StackName=stack_name)
+        logger.info("Delete stack: " + json.dumps(response))
+        stack = wait_for_stack(stack_name)
+        if stack is not None and stack['StackStatus'] == 'DELETE_FAILED':
+            logger.warning('Delete failed. Retry delete')
+            resources = cf_client.delete_stack(StackName=stack_name)
+            return resources
+        logger.info("Delete cluster complete")
+    except Exception as e:
+        logger.error(e)
+
+    try:
+        response = ec2_client.delete_key_pair(KeyName=stack_name + 'key')
+        logger.info("Delete key: " + json.dumps(response))
+    except Exception as e:
+        logger.error(e)
+
+
+def create_ecs_cluster(stack_name, instance_type, cluster_size):
+    """Creates the cluster stack of ./ecs-cluster.cf with cluster_size container instances of instance_type."""
+    cf_client = get_client('cloudformation')
+    ec2_client = get_client('ec2')
+
+    filename = './ecs-cluster.cf'
+    with open(filename, 'r+') as f:
+        cloudformation_json = json.load(f)
+
+    describe_images_response = ec2_client.describe_images(
+        DryRun=False,
+        Owners=[
+            'amazon',
+        ],
+        Filters=[
+            {
+                'Name': 'name',
+                'Values': [
+                    'amzn-ami-2016.09.f-amazon-ecs-optimized',
+                ]
+            },
+        ]
+    )
+    try:
+        ec2_client.create_key_pair(
+            DryRun=False,
+            KeyName=stack_name + 'key'
+        )
+    except Exception as e:
+        pass
+
+    try:
+        response = cf_client.create_stack(
+            StackName=stack_name,
+            TemplateBody=json.dumps(cloudformation_json),
+            Parameters=[
+                {
+                    'ParameterKey': 'AsgMaxSize',
+                    'ParameterValue': str(cluster_size),
+                    'UsePreviousValue': True
+                },
+                {
+                    'ParameterKey': 'EcsAmiId',
+                    'ParameterValue': describe_images_response['Images'][0]['ImageId'],
+                    'UsePreviousValue': True
+                },
+                {
+                    'ParameterKey': 'EcsClusterName',
+                    'ParameterValue': stack_name,
+                    'UsePreviousValue': True
+                },
+                {
+                    'ParameterKey': 'KeyName',
+                    'ParameterValue': stack_name + 'key',
+                    'UsePreviousValue': True
+                },
+                {
+                    'ParameterKey': 'EcsInstanceType',
+                    'ParameterValue': instance_type,
+                    'UsePreviousValue': True
+                },
+                {
+                    'ParameterKey': 'DBUsername',
+                    'ParameterValue': 'PetClinicDB'
+                },
+                {
+                    'ParameterKey': 'DBPassword',
+                    'ParameterValue': 'PetClinicPassw0rd'
+                }
+            ],
+            TimeoutInMinutes=123,
+            Capabilities=[
+                'CAPABILITY_IAM',
+            ],
+            OnFailure='DELETE',
+            Tags=[
+                {
+                    'Key': 'Name',
+                    'Value': stack_name
+                },
+            ]
+        )
+
+    except cf_client.exceptions.AlreadyExistsException:
+        logger.warning("CF Stack already exists")
+        pass
+
+
+def assume_role_policy(service_principal):
+    return {
+        'Statement': [
+            {
+                'Principal': {
+                    'Service': [service_principal]
+                },
+                'Effect': 'Allow',
+                'Action': ['sts:AssumeRole']
+            },
+        ]
+    }
+
+
+def wait_for_role(role_name, policy_arn=None, min_delay=0.5, max_delay=5, timeout=120):
+    """Waits until IAM reads return a new role, and its attached policy, instead of sleeping a fixed time."""
+    iam_client = get_client('iam')
+    delay = min_delay
+    deadline = time.time() + timeout
+    while True:
+        try:
+            iam_client.get_role(RoleName=role_name)
+            if policy_arn is None:
+                return
+            attached = iam_client.list_attached_role_policies(RoleName=role_name)['AttachedPolicies']
+            if policy_arn in [policy['PolicyArn'] for policy in attached]:
+                return
+        except iam_client.exceptions.NoSuchEntityException:
+            pass
+        if time.time() > deadline:
+            raise Exception('Role ' + role_name + ' did not propagate within %ds' % timeout)
+        time.sleep(delay)
+        delay = min(max_delay, delay * 2)
+
+
+def ensure_role(role_name, service_principal, policy_arn=None):
+    """Returns the ARN of role_name, reusing the role when it exists and creating it otherwise."""
+    iam_client = get_client('iam')
+    created = False
+    try:
+        role = iam_client.get_role(RoleName=role_name)['Role']
+        logger.info("Reuse role: " + role['Arn'])
+    except iam_client.exceptions.NoSuchEntityException:
+        try:
+            role = iam_client.create_role(
+                Path='/',
+                RoleName=role_name,
+                AssumeRolePolicyDocument=json.dumps(assume_role_policy(service_principal))
+            )['Role']
+            created = True
+            logger.info("Role created: " + role['Arn'])
+        except iam_client.exceptions.EntityAlreadyExistsException:
+            # Another run created it in the meantime
+            role = iam_client.get_role(RoleName=role_name)['Role']
+    if policy_arn:
+        # Attaching an attached policy is a no-op, so a reused role gets its policy back if it was detached
+        iam_client.attach_role_policy(RoleName=role_name, PolicyArn=policy_arn)
+    if created:
+        wait_for_role(role_name, policy_arn)
+    return role['Arn']
+
+
+def delete_role(role_name):
+    """Detaches every managed policy of role_name and deletes it; a role that does not exist is skipped."""
+    iam_client = get_client('iam')
+    try:
+        for page in iam_client.get_paginator('list_attached_role_policies').paginate(RoleName=role_name):
+            for policy in page['AttachedPolicies']:
+                iam_client.detach_role_policy(RoleName=role_name, PolicyArn=policy['PolicyArn'])
+        iam_client.delete_role(RoleName=role_name)
+        logger.info("Role deleted: " + role_name)
+    except iam_client.exceptions.NoSuchEntityException:
+        logger.info("Role already deleted: " + role_name)
+
+
+def delete_roles(role_names):
+    """Deletes the three project roles, named by role_names as in create_roles(), in parallel."""
+    with RegionExecutor(max_workers=len(role_names)) as executor:
+        list(executor.map(delete_role, role_names.values()))
+    logger.info("Roles deleted")
+
+
+def create_roles(role_names, task_role_policy=None,
+                 ecs_role_policy='arn:aws:iam::aws:policy/AmazonEC2ContainerServiceFullAccess',
+                 ecs_agent_role_policy='arn:aws:iam::aws:policy/service-role/AmazonEC2ContainerServiceforEC2Role'):
+    """Returns the ARNs of the ECS service, task and agent roles, reusing existing roles and creating the others
+    in parallel. role_names maps 'ecsrolearn', 'taskrolearn' and 'ecsagentrolearn' to the role names.
+    """
+    roles = OrderedDict([('ecsrolearn', ('ecs.amazonaws.com', ecs_role_policy)),
+                         ('taskrolearn', ('ecs-tasks.amazonaws.com', task_role_policy)),
+                         ('ecsagentrolearn', ('ec2.amazonaws.com', ecs_agent_role_policy))])
+    with RegionExecutor(max_workers=len(roles)) as executor:
+        futures = OrderedDict((key, executor.submit(ensure_role, role_names[key], principal, policy_arn))
+                              for key, (principal, policy_arn) in roles.items())
+        return dict((key, future.result()) for key, future in futures.items())
+
+
+# Refresh an ECR token once it has less than this many seconds left; tokens are valid for 12 hours
+ECR_TOKEN_REFRESH_SECONDS = 30 * 60
+_ecr_tokens = {}
+_ecr_tokens_lock = threading.Lock()
+
+
+def get_ecr_authorization(registry_id=None, region=None):
+    """Returns the authorizationData of a registry, reusing the cached token until it is close to its expiresAt."""
+    region = region or current_region()
+    key = (region, registry_id)
+    with _ecr_tokens_lock:
+        authorization = _ecr_tokens.get(key)
+        if authorization is not None:
+            remaining = authorization['expiresAt'] - datetime.now(authorization['expiresAt'].tzinfo)
+            if remaining.total_seconds() > ECR_TOKEN_REFRESH_SECONDS:
+                return authorization
+        kwargs = {'registryIds': [registry_id]} if registry_id else {}
+        authorization = get_client('ecr', region).get_authorization_token(**kwargs)['authorizationData'][0]
+        _ecr_tokens[key] = authorization
+        return authorization
+
+
+@contextmanager
+def file_lock(filename):
+    """Holds an exclusive lock on filename.lock so concurrent runs do not interleave read-modify-write cycles."""
+    with open(filename + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def write_json_atomically(filename, data):
+    """Writes data to a temporary file next to filename and renames it over filename."""
+    handle, temporary = tempfile.mkstemp(dir=os.path.dirname(filename), prefix=os.path.basename(filename) + '.')
+    try:
+        with os.fdopen(handle, 'w') as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(temporary, 0o600)
+        os.replace(temporary, filename)
+    except Exception:
+        os.remove(temporary)
+        raise
+
+
+def shared_resources_in_use(state_directory, exclude):
+    """Returns the IAM role names, and the ECR repositories by region, that the deployment state of any project but
+    the (project_name, region) pairs in exclude still records under state_directory.
+    """
+    roles = set()
+    repositories = {}
+    if not os.path.isdir(state_directory):
+        return roles, repositories
+    for region in os.listdir(state_directory):
+        if not os.path.isdir(os.path.join(state_directory, region)):
+            continue
+        for filename in os.listdir(os.path.join(state_directory, region)):
+            # Skips the .lock files and the temporary files of writes in progress
+            if not filename.endswith('.json') or (filename[:-len('.json')], region) in exclude:
+                continue
+            try:
+                with open(os.path.join(state_directory, region, filename)) as f:
+                    data = json.load(f)
+            except (IOError, ValueError):
+                continue
+            roles.update(data.get('roles', {}))
+            repositories.setdefault(region, set()).update(data.get('repositories', {}))
+    return roles, repositories
+
+
+def docker_login_config(region=None):
+    # Get latest authorization token and put it in ~/.docker/config.json
+    authorization = get_ecr_authorization(region=region)
+    ecr_login_token = authorization['authorizationToken']
+    hostname = authorization['proxyEndpoint'][len('https://'):]
+
+    home = expanduser("~")
+    filename = os.path.join(home, '.docker', 'config.json')
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    with file_lock(filename):
+        data = {}
+        if os.path.exists(filename):
+            with open(filename) as f:
+                data = json.load(f)
+        auth = data.setdefault('auths', {}).setdefault(hostname, {})
+        if auth.get('auth') != ecr_login_token:
+            auth['auth'] = ecr_login_token
+            write_json_atomically(filename, data)
+    return hostname
+
+
+def image_digest(service, image_tag):
+    """Returns the digest of service:image_tag in ECR, or None when there is no such image."""
+    ecr_client = get_client('ecr')
+    try:
+        images = ecr_client.describe_images(repositoryName=service, imageIds=[{'imageTag': image_tag}])
+        return images['imageDetails'][0]['imageDigest']
+    except ecr_client.exceptions.ImageNotFoundException:
+        return None
+
+
+def image_exists(service, image_tag):
+    return image_digest(service, image_tag) is not None
+
+
+def find_repositories(services):
+    ecr_client = get_client('ecr')
+    try:
+        repositories = ecr_client.describe_repositories(repositoryNames=services)['repositories']
+    except ecr_client.exceptions.RepositoryNotFoundException:
+        # The batch call fails as a whole when one repository is missing
+        repositories = []
+        for service in services:
+            try:
+                repositories.extend(ecr_client.describe_repositories(repositoryNames=[service])['repositories'])
+            except ecr_client.exceptions.RepositoryNotFoundException:
+                pass
+    return dict((repository['repositoryName'], repository['repositoryUri']) for repository in repositories)
+
+
+def format_build_table(results):
+    lines = ['%-40s %-10s %-6s %10s' % ('Service', 'Status', 'Exit', 'Seconds')]
+    for result in sorted(results, key=lambda r: r['seconds'], reverse=True):
+        returncode = '-' if result['returncode'] is None else str(result['returncode'])
+        lines.append('%-40s %-10s %-6s %10.1f' % (result['service'], result['status'], returncode, result['seconds']))
+    return '\n'.join(lines)
+
+
+def replicate_image(service, source_uri, target_uri, image_tag):
+    """Pushes service:image_tag from the repository at source_uri to the one at target_uri through docker."""
+    started = time.time()
+    result = {'service': service, 'status': 'ok', 'returncode': 0, 'seconds': 0.0, 'output': ''}
+    # The pull is a no-op when the image was built on this machine
+    for command in (['docker', 'pull', source_uri + ':' + image_tag],
+                    ['docker', 'tag', source_uri + ':' + image_tag, target_uri + ':' + image_tag],
+                    ['docker', 'push', target_uri + ':' + image_tag]):
+        process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        result['output'] += process.stdout
+        result['returncode'] = process.returncode
+        if process.returncode != 0:
+            result['status'] = 'failed'
+            break
+    result['seconds'] = time.time() - started
+    return result
+
+
+def replicate_images(source_region, source_uris, repository_uris, image_tags, max_workers=5):
+    """Copies, in parallel, every service image of source_region whose digest this region's ECR does not have.
+
+    A tag such as latest that was pushed again in source_region is copied again. Returns the per service results
+    like a build and raises when an image is missing from source_region or fails to copy.
+    """
+    with region_scope(source_region):
+        with RegionExecutor(max_workers=len(repository_uris)) as executor:
+            source_digests = dict(zip(repository_uris, executor.map(
+                lambda service: image_digest(service, image_tags[service]), repository_uris)))
+    missing = [service for service in repository_uris if not source_digests[service]]
+    if missing:
+        raise Exception('No image to copy from ' + source_region + ' for ' + ', '.join(missing))
+    with RegionExecutor(max_workers=len(repository_uris)) as executor:
+        digests = dict(zip(repository_uris, executor.map(lambda service: image_digest(service, image_tags[service]),
+                                                         repository_uris)))
+    results = [{'service': service, 'status': 'skipped', 'returncode': None, 'seconds': 0.0, 'output': '',
+                'digest': digests[service]}
+               for service in repository_uris if digests[service] == source_digests[service]]
+    to_copy = [service for service in repository_uris if digests[service] != source_digests[service]]
+    if not to_copy:
+        return results
+
+    with region_scope(source_region):
+        docker_login_config()
+    logger.info('Copy images from ' + source_region + ' for ' + ', '.join(to_copy))
+    with RegionExecutor(max_workers=max(1, min(max_workers, len(to_copy)))) as executor:
+        results.extend(executor.map(lambda service: replicate_image(service, source_uris[service],
+                                                                    repository_uris[service], image_tags[service]),
+                                    to_copy))
+
+    logger.info('Copy timings:\n' + format_build_table(results))
+    failed = [result for result in results if result['status'] == 'failed']
+    for result in failed:
+        logger.error('Copy output for ' + result['service'] + ':\n' + result['output'][-4000:])
+    if failed:
+        raise Exception('Failed to copy ' + ', '.join(result['service'] for result in failed))
+    for result in results:
+        if 'digest' not in result:
+            result['digest'] = image_digest(result['service'], image_tags[result['service']])
+    return sorted(results, key=lambda r: r['seconds'], reverse=True)
+
+
+class SharedDeployment(object):
+    """The work a batch of deployments does once for all of them.
+
+    IAM roles are global, so they are looked up or created by the first deployment that needs them. Images are
+    built in the first region only, by build(repository_uris, image_tags, max_workers), the script's own build that
+    raises when an image fails; every other region waits for that build and copies the images to its own ECR.
+    Deployments in the same region take turns, so only the first one builds or copies and the others find the
+    images in place.
+    """
+
+    def __init__(self, regions, role_names, build):
+        self.build_region = regions[0]
+        self.role_names = role_names
+        self.build = build
+        self.lock = threading.Lock()
+        self.role_arns = None
+        self.built = threading.Event()
+        self.build_failed = False
+        self.repository_uris = None
+        self.pending_builds = regions.count(self.build_region)
+        self.region_locks = dict((region, threading.Lock()) for region in regions)
+
+    def roles(self):
+        with self.lock:
+            if self.role_arns is None:
+                self.role_arns = create_roles(self.role_names)
+            return self.role_arns
+
+    def builds(self, region, repository_uris, image_tags, max_workers=5):
+        with self.region_locks[region]:
+            if region == self.build_region:
+                try:
+                    results = self.build(repository_uris, image_tags, max_workers)
+                    self.repository_uris = repository_uris
+                    self.build_failed = False
+                    return results
+                except Exception:
+                    # The other regions fail instead of copying the image a failed build left behind
+                    self.build_failed = True
+                    raise
+                finally:
+                    self.built.set()
+            logger.info('Waiting for the images built in ' + self.build_region)
+            self.built.wait()
+            if self.build_failed:
+                raise Exception('No images to copy, the build in ' + self.build_region + ' failed')
+            source_uris = self.repository_uris
+            if source_uris is None:
+                # The build region had nothing to change, its repositories hold the images already
+                with region_scope(self.build_region):
+                    source_uris = find_repositories(list(repository_uris))
+            return replicate_images(self.build_region, source_uris, repository_uris, image_tags, max_workers)
+
+    def deployment_done(self, region):
+        """Releases the regions waiting for images once every build region deployment finished without building."""
+        if region == self.build_region:
+            with self.lock:
+                self.pending_builds -= 1
+                if self.pending_builds == 0:
+                    self.built.set()
+
+
+def setup_securitygroups_permission(ecs_security_group, elb_security_group):
+    client = get_client('ec2')
+    logger.info('Security Group allow internet access to ELB port 80')
+    # Allow internet access to ELB:80
+    client.authorize_security_group_ingress(
+        GroupId=elb_security_group,
+        IpProtocol='tcp',
+        FromPort=80,
+        ToPort=80,
+        CidrIp='0.0.0.0/0'
+    )
+    logger.info('Security Group allow ELB to access ECS ports 31000-61000')
+    # Allow ECS allows inbound from ELB
+    client.authorize_security_group_ingress(
+        GroupId=ecs_security_group,
+        IpPermissions=[
+            {'IpProtocol': 'tcp',
+             'FromPort': 31000,
+             'ToPort': 61000,
+             'UserIdGroupPairs': [{'GroupId': elb_security_group}]}
+        ],
+    )
+
+
+def parse_placement(service, kind, value):
+    """Returns a placement strategy or constraint in the form create_service takes.
+
+    value is either that form or a 'type:field' string such as 'spread:attribute:ecs.availability-zone',
+    'binpack:memory', 'random', 'distinctInstance' or 'memberOf:attribute:ecs.instance-type =~ c4.*'.
+    """
+    if not isinstance(value, dict):
+        placement_type, _, argument = value.partition(':')
+        key = 'field' if kind == 'strategy' else 'expression'
+        value = dict([('type', placement_type)] + ([(key, argument)] if argument else []))
+    if kind == 'strategy':
+        if value['type'] not in ('spread', 'binpack', 'random') \
+                or value['type'] == 'binpack' and value.get('field') not in ('cpu', 'memory') \
+                or value['type'] == 'spread' and not value.get('field'):
+            raise Exception('Invalid placement strategy for ' + service + ': ' + json.dumps(value))
+        return dict((key, value[key]) for key in ('type', 'field') if value.get(key))
+    if value['type'] not in ('distinctInstance', 'memberOf') \
+            or value['type'] == 'memberOf' and not value.get('expression'):
+        raise Exception('Invalid placement constraint for ' + service + ': ' + json.dumps(value))
+    return dict((key, value[key]) for key in ('type', 'expression') if value.get(key))
+
+
+def parse_service_profile(service, config, defaults):
+    """Returns the resource profile of service from its config over the script's defaults, with integer values."""
+    profile = dict(defaults)
+    profile.update((key, config[key]) for key in defaults if key in config)
+    try:
+        for key in ('cpu', 'memory', 'memoryReservation', 'count', 'minCount', 'maxCount'):
+            if profile[key] is not None:
+                profile[key] = int(profile[key])
+        for key in ('cpuTarget', 'requestsPerTarget'):
+            if profile[key] is not None:
+                profile[key] = float(profile[key])
+        profile['ulimits'] = [{'name': ulimit['name'], 'softLimit': int(ulimit['softLimit']),
+                               'hardLimit': int(ulimit['hardLimit'])} for ulimit in profile['ulimits']]
+        profile['placementStrategy'] = [parse_placement(service, 'strategy', strategy)
+                                        for strategy in profile['placementStrategy']]
+        profile['placementConstraints'] = [parse_placement(service, 'constraint', constraint)
+                                           for constraint in profile['placementConstraints']]
+    except (KeyError, TypeError, ValueError) as e:
+        raise Exception('Invalid resource profile for ' + service + ': ' + repr(e))
+    if profile['memory'] is None and profile['memoryReservation'] is None:
+        raise Exception('Resource profile for ' + service + ' needs memory or memoryReservation')
+    if profile['memory'] is not None and profile['memoryReservation'] is not None \
+            and profile['memoryReservation'] > profile['memory']:
+        raise Exception('Resource profile for ' + service + ' reserves more memory than its limit')
+    if profile['minCount'] is None:
+        profile['minCount'] = profile['count']
+    if not 0 <= profile['minCount'] <= profile['count'] <= profile['maxCount']:
+        raise Exception('Resource profile for ' + service + ' needs 0 <= minCount <= count <= maxCount')
+    if profile['healthProfile'] not in HEALTH_PROFILES:
+        raise Exception('Unknown health profile for ' + service + ': ' + str(profile['healthProfile']))
+    return profile
+
+
+def read_service_config(directory):
+    """Returns the settings in <directory>/ecs-service-config.json, or {} when there is none."""
+    filename = os.path.join(directory, SERVICE_CONFIG_FILE)
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as f:
+        return json.load(f)
+
+
+def service_profile(service, defaults, directory=None):
+    """Returns the resources, count, auto scaling, placement and health profile to deploy service with.
+
+    They are read from the ecs-service-config.json in directory, the service's own directory by default.
+    """
+    return parse_service_profile(service, read_service_config(service if directory is None else directory),
+                                 defaults)
+
+
+def set_health_attributes(target_group_arn, health):
+    """Sets the deregistration delay and slow start of a target group, which create_target_group does not take."""
+    get_client('elbv2').modify_target_group_attributes(
+        TargetGroupArn=target_group_arn,
+        Attributes=[{'Key': key, 'Value': str(health[key])}
+                    for key in ('deregistration_delay.timeout_seconds', 'slow_start.duration_seconds')])
+
+
+def apply_health_profile(target_group_arn, health):
+    """Sets the health check, deregistration delay and slow start of an existing target group to a health profile."""
+    get_client('elbv2').modify_target_group(TargetGroupArn=target_group_arn,
+                                            **dict((key, health[key]) for key in HEALTH_CHECK_KEYS))
+    set_health_attributes(target_group_arn, health)
+
+
+def health_checks_match(current, health):
+    """True when a target group's health check, as described, already follows a health profile.
+
+    Every profile has its own health check settings, so these also tell whether its attributes were set.
+    """
+    return current is not None and all(current.get(key) == health[key] for key in HEALTH_CHECK_KEYS)
+
+
+def create_target_group(project_name, target_group_name, port, vpc_id, health):
+    """Creates a target group tagged with the project, with the health checks and attributes of health."""
+    elb_client = get_client('elbv2')
+    create_target_group_response = elb_client.create_target_group(
+        Name=target_group_name,
+        Protocol='HTTP',
+        Port=int(port),
+        VpcId=vpc_id,
+        HealthCheckPath='/',
+        HealthCheckIntervalSeconds=health['HealthCheckIntervalSeconds'],
+        HealthCheckTimeoutSeconds=health['HealthCheckTimeoutSeconds'],
+        HealthyThresholdCount=health['HealthyThresholdCount'],
+        UnhealthyThresholdCount=health['UnhealthyThresholdCount'],
+        Matcher={
+            'HttpCode': '200'
+        },
+        Tags=[
+            {
+                'Key': PROJECT_TAG_KEY,
+                'Value': project_name
+            },
+        ]
+    )
+    target_group_arn = create_target_group_response['TargetGroups'][0]['TargetGroupArn']
+    set_health_attributes(target_group_arn, health)
+    logger.info("ELB Target Group created: " + target_group_name)
+    return target_group_arn
+
+
+def create_load_balancer(project_name, stack, health, name_tag):
+    """Creates the load balancer, its port 80 listener and the default target group, with the health profile of the
+    service it routes to, reusing the listener when the load balancer already has one. Returns the ARNs, the DNS name
+    and the VPC of the load balancer.
+    """
+    elb_client = get_client('elbv2')
+
+    logger.info("Creating ELB")
+    elb_name = project_name + '-elb'
+    # Create an ELBv2
+    create_elb_response = elb_client.create_load_balancer(
+        Name=elb_name,
+        Subnets=[stack.physical_id('PubELBSubnetAz1'), stack.physical_id('PubELBSubnetAz2'),
+                 stack.physical_id('PubELBSubnetAz3')],
+        SecurityGroups=[stack.physical_id('ElbSecurityGroup')],
+        Scheme='internet-facing',
+        Tags=[
+            {
+                'Key': 'Name',
+                'Value': name_tag
+            },
+        ],
+        IpAddressType='ipv4'
+    )
+    elb_arn = create_elb_response['LoadBalancers'][0]['LoadBalancerArn']
+    elb_dns = create_elb_response['LoadBalancers'][0]['DNSName']
+
+    # Create default / target group
+    default_target_group_arn = create_target_group(project_name, project_name + '-elb-tg', 80,
+                                                   stack.physical_id('Vpc'), health)
+    # A rerun gets the existing load balancer back from create_load_balancer, with the listener it made then
+    listeners = [listener for listener in elb_client.describe_listeners(LoadBalancerArn=elb_arn)['Listeners']
+                 if listener['Port'] == 80]
+    if listeners:
+        listener_arn = listeners[0]['ListenerArn']
+        logger.info("ELB Listener already exists: " + listener_arn)
+    else:
+        # Create ELB listener for port 80
+        create_listener_response = elb_client.create_listener(
+            LoadBalancerArn=elb_arn,
+            Protocol='HTTP',
+            Port=80,
+            DefaultActions=[
+                {
+                    'Type': 'forward',
+                    'TargetGroupArn': default_target_group_arn
+                },
+            ]
+        )
+        listener_arn = create_listener_response['Listeners'][0]['ListenerArn']
+        logger.info("ELB Listener Created: " + json.dumps(create_listener_response))
+
+    return {'arn': elb_arn, 'dns_name': elb_dns, 'listener_arn': listener_arn,
+            'default_target_group_arn': default_target_group_arn, 'vpc_id': stack.physical_id('Vpc')}
+
+
+def scaling_resource_id(project_name, service):
+    return 'service/' + project_name + '/' + service
+
+
+def desired_scaling(service, profile, load_balancer_arn=None, target_group_arn=None):
+    """Returns the scalable target and target tracking policies the profile of service asks for, None for a fixed count.
+
+    The request count policy is only added with the target group the service's tasks are registered in.
+    """
+    if profile['minCount'] == profile['maxCount']:
+        return None
+    metrics = OrderedDict()
+    if profile['cpuTarget']:
+        metrics[service + '-cpu'] = (profile['cpuTarget'],
+                                     {'PredefinedMetricType': 'ECSServiceAverageCPUUtilization'})
+    if profile['requestsPerTarget'] and load_balancer_arn and target_group_arn:
+        # app/<load balancer name>/<id>/targetgroup/<target group name>/<id>
+        label = load_balancer_arn.split(':loadbalancer/')[1] + '/' + target_group_arn.split(':')[-1]
+        metrics[service + '-requests'] = (profile['requestsPerTarget'],
+                                          {'PredefinedMetricType': 'ALBRequestCountPerTarget', 'ResourceLabel': label})
+    policies = OrderedDict((name, {'TargetValue': target, 'PredefinedMetricSpecification': metric,
+                                   'ScaleOutCooldown': SCALE_OUT_COOLDOWN, 'ScaleInCooldown': SCALE_IN_COOLDOWN})
+                           for name, (target, metric) in metrics.items())
+    return {'min': profile['minCount'], 'max': profile['maxCount'], 'policies': policies}
+
+
+def scaling_matches(current, desired):
+    """True when the registered scalable target and policies of a service already carry every desired setting."""
+    if current is None or desired is None:
+        return current == desired
+    if (current['min'], current['max']) != (desired['min'], desired['max']) \
+            or set(current['policies']) != set(desired['policies']):
+        return False
+    return all(current['policies'][name].get(key) == value
+               for name, configuration in desired['policies'].items() for key, value in configuration.items())
+
+
+def configure_service_scaling(project_name, service, desired, current=None):
+    """Registers service with Application Auto Scaling and puts its target tracking policies, or deregisters it when
+    desired is None. Both calls update in place, so nothing is deleted while a policy changes.
+    """
+    if scaling_matches(current, desired):
+        return desired
+    if desired is None:
+        deregister_service_scaling(project_name, service)
+        return None
+    scaling_client = get_client('application-autoscaling')
+    resource_id = scaling_resource_id(project_name, service)
+    scaling_client.register_scalable_target(ServiceNamespace='ecs', ResourceId=resource_id,
+                                            ScalableDimension=SCALABLE_DIMENSION, MinCapacity=desired['min'],
+                                            MaxCapacity=desired['max'])
+    for name, configuration in desired['policies'].items():
+        scaling_client.put_scaling_policy(PolicyName=name, ServiceNamespace='ecs', ResourceId=resource_id,
+                                          ScalableDimension=SCALABLE_DIMENSION, PolicyType='TargetTrackingScaling',
+                                          TargetTrackingScalingPolicyConfiguration=configuration)
+    for name in set(current['policies'] if current else ()) - set(desired['policies']):
+        scaling_client.delete_scaling_policy(PolicyName=name, ServiceNamespace='ecs', ResourceId=resource_id,
+                                             ScalableDimension=SCALABLE_DIMENSION)
+    logger.info('Auto scaling ' + service + ' between %d and %d tasks' % (desired['min'], desired['max']))
+    return desired
+
+
+def deregister_service_scaling(project_name, service):
+    """Deregisters the scalable target of service, which also deletes its policies; a missing target is skipped."""
+    scaling_client = get_client('application-autoscaling')
+    try:
+        scaling_client.deregister_scalable_target(ServiceNamespace='ecs',
+                                                  ResourceId=scaling_resource_id(project_name, service),
+                                                  ScalableDimension=SCALABLE_DIMENSION)
+        logger.info('Deregistered auto scaling for: ' + service)
+    except scaling_client.exceptions.ObjectNotFoundException:
+        pass
+
+
+def parse_rate_limits(value):
+    """Parses service.Operation=rate,service=rate,... into a rate_limits dict."""
+    limits = {}
+    for item in (value or '').split(','):
+        if not item.strip():
+            continue
+        if '=' not in item:
+            raise Exception('Rate limits are given as name=calls per second, not ' + item)
+        name, rate = item.split('=', 1)
+        limits[name.strip()] = float(rate)
+    return limits
+
+
+def run_timed(timings, name, func, *args, **kwargs):
+    """Runs one teardown step, logging instead of raising errors, and records how long it took under name."""
+    started = time.time()
+    try:
+        with telemetry.span(name):
+            result = func(*args, **kwargs)
+        timings[name] = ('deleted', time.time() - started)
+        return result
+    except Exception as e:
+        logger.error(e)
+        timings[name] = ('error', time.time() - started)
+
+
+def format_timing_table(timings):
+    lines = ['%-60s %-8s %10s' % ('Resource', 'Status', 'Seconds')]
+    for name, (status, seconds) in sorted(timings.items(), key=lambda item: item[1][1], reverse=True):
+        lines.append('%-60s %-8s %10.1f' % (name, status, seconds))
+    return '\n'.join(lines)
+
+
+def deregister_task_definition(service, task_definition_arn=None):
+    """Deregisters the latest task definition of service, or task_definition_arn; a missing family is skipped."""
+    ecs_client = get_client('ecs')
+    if task_definition_arn is None:
+        try:
+            task_definition = ecs_client.describe_task_definition(taskDefinition=service)
+        except ecs_client.exceptions.ClientException:
+            logger.info('No task definition to deregister for: ' + service)
+            return
+        task_definition_arn = task_definition['taskDefinition']['taskDefinitionArn']
+    ecs_client.deregister_task_definition(taskDefinition=task_definition_arn)
+
+
+def delete_ecs_service(project_name, service):
+    """Scales service to 0, deletes it and waits until it is inactive; a service that is already gone is skipped."""
+    ecs_client = get_client('ecs')
+    try:
+        ecs_client.update_service(cluster=project_name, service=service, desiredCount=0)
+        ecs_client.delete_service(cluster=project_name, service=service)
+    except (ecs_client.exceptions.ClusterNotFoundException, ecs_client.exceptions.ServiceNotFoundException,
+            ecs_client.exceptions.ServiceNotActiveException):
+        logger.info('Service already deleted: ' + service)
+        return
+    ecs_client.get_waiter('services_inactive').wait(cluster=project_name, services=[service],
+                                                    WaiterConfig={'Delay': 5, 'MaxAttempts': 120})
+    logger.info('Deleted service: ' + service)
+
+
+def delete_repository(service):
+    """Deletes the ECR repository of service with its images; a repository that does not exist is skipped."""
+    ecr_client = get_client('ecr')
+    try:
+        ecr_client.delete_repository(repositoryName=service, force=True)
+    except ecr_client.exceptions.RepositoryNotFoundException:
+        logger.info('Repository already deleted: ' + service)
+
+
+def teardown_service(project_name, service, timings, task_definition_arn=None, repository=True):
+    if repository:
+        run_timed(timings, 'ecr-repository:' + service, delete_repository, service)
+    run_timed(timings, 'task-definition:' + service, deregister_task_definition, service, task_definition_arn)
+    # Deregistered first, so auto scaling cannot raise the count again while the service drains
+    run_timed(timings, 'auto-scaling:' + service, deregister_service_scaling, project_name, service)
+    run_timed(timings, 'ecs-service:' + service, delete_ecs_service, project_name, service)
+
+
+def find_load_balancer_arn(project_name, cached=None):
+    """Returns the ARN of the project's load balancer, the cached one when given, None when it cannot be found."""
+    if cached:
+        return cached['arn']
+    try:
+        load_balancer = get_client('elbv2').describe_load_balancers(Names=[project_name + '-elb'])
+        return load_balancer['LoadBalancers'][0]['LoadBalancerArn']
+    except Exception as e:
+        logger.error(e)
+
+
+def delete_load_balancer(load_balancer_arn):
+    elbv2_client = get_client('elbv2')
+    try:
+        elbv2_client.delete_load_balancer(LoadBalancerArn=load_balancer_arn)
+    except elbv2_client.exceptions.LoadBalancerNotFoundException:
+        logger.info('ELBv2 already deleted: ' + load_balancer_arn)
+        return
+    elbv2_client.get_waiter('load_balancers_deleted').wait(LoadBalancerArns=[load_balancer_arn],
+                                                           WaiterConfig={'Delay': 5, 'MaxAttempts': 60})
+    logger.info('Deleted ELBv2: ' + load_balancer_arn)
+
+
+def index_project_target_groups(project_name, service_list, load_balancer_arn=None, cached=None):
+    """Returns {target group arn: name} for the target groups of a project.
+
+    Collects the groups attached to the project's load balancer, the groups tagged with the project, and the
+    groups with the names setup() gives them, paging through every result instead of scanning the account.
+    """
+    elbv2_client = get_client('elbv2')
+    index = {}
+    for name, arn in (cached or {}).items():
+        index[arn] = name
+    if load_balancer_arn:
+        for page in elbv2_client.get_paginator('describe_target_groups').paginate(LoadBalancerArn=load_balancer_arn):
+            for target_group in page['TargetGroups']:
+                index[target_group['TargetGroupArn']] = target_group['TargetGroupName']
+
+    tagging_client = get_client('resourcegroupstaggingapi')
+    for page in tagging_client.get_paginator('get_resources').paginate(
+            TagFilters=[{'Key': PROJECT_TAG_KEY, 'Values': [project_name]}],
+            ResourceTypeFilters=['elasticloadbalancing:targetgroup']):
+        for resource in page['ResourceTagMappingList']:
+            # arn:aws:elasticloadbalancing:<region>:<account>:targetgroup/<name>/<id>
+            index[resource['ResourceARN']] = resource['ResourceARN'].split('/')[-2]
+
+    # Untagged groups left behind by older runs
+    names = [project_name + '-elb-tg'] + [project_name + str(i) + '-tg' for i in range(len(service_list))]
+    for name in names:
+        if name in index.values():
+            continue
+        try:
+            for target_group in elbv2_client.describe_target_groups(Names=[name])['TargetGroups']:
+                index[target_group['TargetGroupArn']] = target_group['TargetGroupName']
+        except elbv2_client.exceptions.TargetGroupNotFoundException:
+            pass
+    return index
+
+
+def delete_target_groups(target_groups, timings):
+    """Deletes the indexed target groups concurrently and drops the deleted ones from the index."""
+    def delete_target_group(arn, name):
+        logger.info('Deleting target group ' + name)
+        elb_client = get_client('elbv2')
+        try:
+            elb_client.delete_target_group(TargetGroupArn=arn)
+        except elb_client.exceptions.TargetGroupNotFoundException:
+            logger.info('Target group already deleted: ' + name)
+        return arn
+
+    if not target_groups:
+        return
+    with RegionExecutor(max_workers=len(target_groups)) as executor:
+        futures = [executor.submit(run_timed, timings, 'target-group:' + name, delete_target_group, arn, name)
+                   for arn, name in target_groups.items()]
+        for future in futures:
+            arn = future.result()
+            if arn:
+                target_groups.pop(arn)
+
+
+def read_listener_rules(listener_arn):
+    """Returns {path pattern: {'arn', 'priority', 'target_group_arn'}} for the path rules of a listener."""
+    elb_client = get_client('elbv2')
+    rules = {}
+    kwargs = {'ListenerArn': listener_arn}
+    while True:
+        page = elb_client.describe_rules(**kwargs)
+        for rule in page['Rules']:
+            for condition in rule['Conditions']:
+                if condition['Field'] == 'path-pattern':
+                    for value in condition['Values']:
+                        rules[value] = {'arn': rule['RuleArn'], 'priority': rule['Priority'],
+                                        'target_group_arn': rule['Actions'][0].get('TargetGroupArn')}
+        if not page.get('NextMarker'):
+            break
+        kwargs['Marker'] = page['NextMarker']
+    return rules
+
+
+class ListenerRules(object):
+    """The path rules of a listener, read once, with deterministic priorities for the rules setup() manages.
+
+    Priorities come from each service's ecs-service-config.json when set and free, then from the rule already in
+    place, then from the lowest priority no other rule uses, so rules never collide and reruns assign the same
+    numbers.
+    """
+
+    def __init__(self, listener_arn, rules=None):
+        self.listener_arn = listener_arn
+        self.rules = rules if rules is not None else read_listener_rules(listener_arn)
+
+    def assign_priorities(self, desired):
+        """Returns {path pattern: priority} for desired, an ordered {path pattern: configured priority or None}."""
+        used = set(int(rule['priority']) for path, rule in self.rules.items()
+                   if path not in desired and rule['priority'] != 'default')
+        priorities = {}
+        for path, priority in desired.items():
+            if priority is None:
+                continue
+            if priority in used:
+                logger.info('Priority ' + str(priority) + ' of ' + path + ' is already taken, allocating another')
+                continue
+            priorities[path] = priority
+            used.add(priority)
+        for path in desired:
+            if path not in priorities and path in self.rules and int(self.rules[path]['priority']) not in used:
+                priorities[path] = int(self.rules[path]['priority'])
+                used.add(priorities[path])
+        candidate = 1
+        for path in desired:
+            if path in priorities:
+                continue
+            while candidate in used:
+                candidate += 1
+            if candidate > MAX_RULE_PRIORITY:
+                raise Exception('No listener rule priority left for ' + path)
+            priorities[path] = candidate
+            used.add(candidate)
+        return priorities
+
+    def changes(self, desired, target_groups=None):
+        """Returns the (action, path pattern, priority) changes apply() would make."""
+        target_groups = target_groups or {}
+        changes = []
+        for path, priority in sorted(self.assign_priorities(desired).items(), key=lambda item: item[1]):
+            rule = self.rules.get(path)
+            if rule is None:
+                changes.append(('create', path, priority))
+                continue
+            if int(rule['priority']) != priority:
+                changes.append(('reorder', path, priority))
+            if path in target_groups and rule['target_group_arn'] != target_groups[path]:
+                changes.append(('modify', path, priority))
+        return changes
+
+    def apply(self, desired, target_groups):
+        """Creates, reorders and re-targets the rules for desired; target_groups maps path pattern to group ARN.
+
+        All reorders go out in one set_rule_priorities call before the new rules are created concurrently.
+        """
+        elb_client = get_client('elbv2')
+        changes = self.changes(desired, target_groups)
+        reorders = [{'RuleArn': self.rules[path]['arn'], 'Priority': priority}
+                    for action, path, priority in changes if action == 'reorder']
+        if reorders:
+            logger.info('Reordering %d listener rules' % len(reorders))
+            elb_client.set_rule_priorities(RulePriorities=reorders)
+            for change in reorders:
+                for rule in self.rules.values():
+                    if rule['arn'] == change['RuleArn']:
+                        rule['priority'] = str(change['Priority'])
+
+        def modify_rule(path):
+            logger.info('Pointing rule ' + path + ' to its target group')
+            elb_client.modify_rule(RuleArn=self.rules[path]['arn'],
+                                   Actions=[{'Type': 'forward', 'TargetGroupArn': target_groups[path]}])
+            self.rules[path]['target_group_arn'] = target_groups[path]
+
+        def create_rule(path, priority):
+            logger.info('Create rule ' + path + ' with priority ' + str(priority))
+            rule = elb_client.create_rule(
+                ListenerArn=self.listener_arn,
+                Conditions=[
+                    {
+                        'Field': 'path-pattern',
+                        'Values': [
+                            path
+                        ]
+                    },
+                ],
+                Priority=priority,
+                Actions=[
+                    {
+                        'Type': 'forward',
+                        'TargetGroupArn': target_groups[path]
+                    },
+                ]
+            )['Rules'][0]
+            self.rules[path] = {'arn': rule['RuleArn'], 'priority': str(priority),
+                                'target_group_arn': target_groups[path]}
+
+        pending = [(action, path, priority) for action, path, priority in changes if action in ('create', 'modify')]
+        if pending:
+            with RegionExecutor(max_workers=len(pending)) as executor:
+                futures = [executor.submit(create_rule, path, priority) if action == 'create'
+                           else executor.submit(modify_rule, path)
+                           for action, path, priority in pending]
+                for future in futures:
+                    future.result()
+        return dict((path, self.rules[path]['arn']) for path in desired)